@@ -7,13 +7,13 @@ import asyncio
 import collections
 import copy
 import itertools
-import json
 import logging
 import sys
 from enum import Flag, auto
 
 import websockets
 from cobras.common.auth_hash import computeHash
+from cobras.common.pdu_codecs import JSON_CODEC, JSON_SUBPROTOCOL, getCodec
 from cobras.common.task_cleanup import addTaskCleanup
 
 
@@ -29,6 +29,12 @@ class ActionException(Exception):
     pass
 
 
+# Fire-and-forget publishes use ids from their own namespace, so that their
+# errors can be told apart from the responses someone is waiting for
+NO_ACK_ID_PREFIX = 'no_ack::'
+MAX_PUBLISH_ERRORS = 1000
+
+
 class ActionFlow(Flag):
     CONTINUE = auto()
     STOP = auto()
@@ -39,9 +45,18 @@ class Connection(object):
     '''FIXME: leaking queues
     '''
 
-    def __init__(self, url, creds):
+    def __init__(self, url, creds, publishAck=True, encoding=JSON_SUBPROTOCOL):
+        '''With publishAck set to False, the server does not acknowledge
+        successful publishes, and publish does not wait for them.
+
+        encoding is the pdu encoding asked to the server (json or cbor),
+        servers which do not support it fall back to json.
+        '''
         self.url = url
         self.creds = creds
+        self.publishAck = publishAck
+        self.encoding = encoding
+        self.codec = JSON_CODEC
         self.idIterator = itertools.count()
         self.connectionId = None
         self.serverVersion = 'na'
@@ -53,12 +68,21 @@ class Connection(object):
 
         self.subscriptions = set()
 
+        # Errors of fire-and-forget publishes, most recent last
+        self.publishErrors = collections.deque(maxlen=MAX_PUBLISH_ERRORS)
+
     def __del__(self):
         if self.task is not None:
             self.task.cancel()
 
     async def connect(self):
-        self.websocket = await websockets.connect(self.url)
+        subprotocols = [self.encoding]
+        if self.encoding != JSON_SUBPROTOCOL:
+            subprotocols.append(JSON_SUBPROTOCOL)
+
+        self.websocket = await websockets.connect(self.url, subprotocols=subprotocols)
+        self.codec = getCodec(self.websocket.subprotocol)
+
         self.task = asyncio.ensure_future(self.waitForResponses())
         addTaskCleanup(self.task)
 
@@ -75,9 +99,14 @@ class Connection(object):
             "action": "auth/handshake",
             "body": {"data": {"role": role}, "method": "role_secret"},
         }
+        if not self.publishAck:
+            handshake['body']['data']['publish_ack'] = False
 
         response = await self.send(handshake)
 
+        # Older servers always acknowledge publishes
+        self.publishAck = response['body']['data'].get('publish_ack', True)
+
         self.serverVersion = response['body']['data']['version']
         self.connectionId = response['body']['data']['connection_id']
 
@@ -99,12 +128,16 @@ class Connection(object):
                 response = await self.websocket.recv()
 
                 logging.debug(f'< {response}')
-                data = json.loads(response)
+                data = self.codec.decode(response)
 
                 msgId = data.get('id')
                 if msgId is None:
                     raise ActionException('server bug: incoming message has no id')
 
+                if isinstance(msgId, str) and msgId.startswith(NO_ACK_ID_PREFIX):
+                    self.handleNoAckResponse(data)
+                    continue
+
                 action = data['action']
                 action = '/'.join(action.split('/')[:2])
                 actionId = action + '::' + str(msgId)
@@ -127,6 +160,18 @@ class Connection(object):
             if len(self.queues) != 0:
                 logging.warning(f'connection has pending queues: {self.queues}')
 
+    def handleNoAckResponse(self, data):
+        '''Nobody waits for those, errors are kept for getPublishErrors'''
+        if data['action'].endswith('/error'):
+            logging.warning(f'publish error: {data}')
+            self.publishErrors.append(data)
+
+    def getPublishErrors(self):
+        '''Return and forget the errors of fire-and-forget publishes'''
+        errors = list(self.publishErrors)
+        self.publishErrors.clear()
+        return errors
+
     def getQueue(self, action):
         q = self.queues[action]
         return q
@@ -180,8 +225,8 @@ class Connection(object):
         # Compute the action id
         actionId = self.computeDefaultActionId(pdu)
 
-        data = json.dumps(pdu)
-        logging.info(f"client > {data}")
+        data = self.codec.encode(pdu)
+        logging.info(f"client > {pdu}")
         await self.websocket.send(data)
 
         # get the response
@@ -272,10 +317,81 @@ class Connection(object):
 
         self.subscriptions.remove(subscriptionId)
 
-    async def publish(self, channel, msg):
+    async def publish(self, channel, msg, messageId=None):
+        '''With a messageId, retries are dropped by servers with publish
+        dedup enabled.
+        '''
+        if not self.publishAck:
+            await self.publishNoAck(channel, msg, messageId)
+            return
+
         pdu = {"action": "rtm/publish", "body": {"channel": channel, "message": msg}}
+        if messageId is not None:
+            pdu['body']['message_id'] = messageId
+
         await self.send(pdu)
 
+    async def publishNoAck(self, channel, msg, messageId=None):
+        '''Return once the pdu is written, without waiting for the server.
+        Errors are collected, see getPublishErrors.
+        '''
+        pdu = {
+            "action": "rtm/publish",
+            "id": NO_ACK_ID_PREFIX + str(next(self.idIterator)),
+            "body": {"channel": channel, "message": msg, "ack": False},
+        }
+        if messageId is not None:
+            pdu['body']['message_id'] = messageId
+
+        logging.debug(f"client > {pdu}")
+        await self.websocket.send(self.codec.encode(pdu))
+
+    async def publishBatch(self, channel, messages, messageIds=None):
+        '''Publish many messages with one pdu and one redis round-trip.
+        Returns the body of the response, or None when publishes are not
+        acknowledged.
+        '''
+        body = {"channel": channel, "messages": messages}
+        if messageIds is not None:
+            body['message_ids'] = messageIds
+
+        if not self.publishAck:
+            body['ack'] = False
+            pdu = {
+                "action": "rtm/publish",
+                "id": NO_ACK_ID_PREFIX + str(next(self.idIterator)),
+                "body": body,
+            }
+            logging.debug(f"client > {pdu}")
+            await self.websocket.send(self.codec.encode(pdu))
+            return None
+
+        data = await self.send({"action": "rtm/publish", "body": body})
+        return data['body']
+
+    async def sendBatch(self, pdus):
+        '''Send many pdus in one websocket frame, and return their responses.
+        Raise ActionException once all of them are received, if any failed.
+        '''
+        actionIds = []
+        for pdu in pdus:
+            pdu["id"] = next(self.idIterator)
+            actionIds.append(self.computeDefaultActionId(pdu))
+
+        data = self.codec.encode(pdus)
+        logging.info(f"client > {pdus}")
+        await self.websocket.send(data)
+
+        responses = []
+        for actionId in actionIds:
+            responses.append(await self.getActionResponse(actionId))
+
+        for pdu, data in zip(pdus, responses):
+            if data.get('action') != (pdu['action'] + '/ok'):
+                raise ActionException(data.get('body', {}).get('error'))
+
+        return responses
+
     async def write(self, channel, msg):
         pdu = {"action": "rtm/write", "body": {"channel": channel, "message": msg}}
         await self.send(pdu)
@@ -16,12 +16,36 @@ from typing import List
 
 import yaml
 
+from cobras.common.channel_builder import compileRules
+
 STATS_APPKEY = '_stats'
 HEALTH_APPKEY = '_health'
 ADMIN_APPKEY = '_admin'
 PUBSUB_APPKEY = '_pubsub'
 PULSAR_APPKEY = '_pulsar'
 
+# What to do when a subscriber outbound queue is full
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+JUMP_TO_HEAD = 'jump_to_head'
+DISCONNECT = 'disconnect'
+SLOW_CONSUMER_POLICIES = (DROP_OLDEST, DROP_NEWEST, JUMP_TO_HEAD, DISCONNECT)
+
+DEFAULT_SUBSCRIPTION_QUEUE_MAX_SIZE = 10000
+DEFAULT_SLOW_CONSUMER_POLICY = DROP_OLDEST
+
+# Publish dedup modes
+PUBLISH_DEDUP_MEMORY = 'memory'
+PUBLISH_DEDUP_REDIS = 'redis'
+PUBLISH_DEDUP_MODES = (PUBLISH_DEDUP_MEMORY, PUBLISH_DEDUP_REDIS)
+
+DEFAULT_PUBLISH_DEDUP_WINDOW_MS = 60 * 1000
+DEFAULT_PUBLISH_DEDUP_MAX_KEYS = 10000
+
+# Requests of a connection handled concurrently, apps opt into pipelining
+# as their clients need to match out of order responses
+DEFAULT_MAX_INFLIGHT_REQUESTS = 1
+
 
 class AppsConfig:
     def __init__(self, path: str) -> None:
@@ -29,6 +53,9 @@ class AppsConfig:
         self.data = {}
         self.apps = {}
 
+        # Compiled channel builder rules, per app
+        self.channelBuilders = {}
+
         if os.path.exists(self.path):
             with open(self.path) as f:
                 self.data = yaml.load(f.read(), Loader=yaml.FullLoader) or {}
@@ -52,6 +79,42 @@ class AppsConfig:
                 if role.get('secret') is None:
                     raise ValueError(f'role "{roleName}" is missing a secret')
 
+            policy = self.apps[app].get('slow_consumer_policy')
+            if policy is not None and policy not in SLOW_CONSUMER_POLICIES:
+                raise ValueError(f'app "{app}": invalid slow consumer policy {policy}')
+
+            queueMaxSize = self.apps[app].get('subscription_queue_max_size')
+            if queueMaxSize is not None and (
+                not isinstance(queueMaxSize, int) or queueMaxSize <= 0
+            ):
+                raise ValueError(
+                    f'app "{app}": invalid subscription queue max size {queueMaxSize}'
+                )
+
+            try:
+                self.channelBuilders[app] = compileRules(
+                    self.apps[app].get('channel_builder')
+                )
+            except ValueError as e:
+                raise ValueError(f'app "{app}": {e}')
+
+            localDelivery = self.apps[app].get('local_delivery')
+            if localDelivery is not None and not isinstance(localDelivery, bool):
+                raise ValueError(f'app "{app}": invalid local delivery {localDelivery}')
+
+            dedupMode = self.apps[app].get('publish_dedup')
+            if dedupMode is not None and dedupMode not in PUBLISH_DEDUP_MODES:
+                raise ValueError(f'app "{app}": invalid publish dedup mode {dedupMode}')
+
+            for key in (
+                'publish_dedup_window_ms',
+                'publish_dedup_max_keys',
+                'max_inflight_requests',
+            ):
+                val = self.apps[app].get(key)
+                if val is not None and (not isinstance(val, int) or val <= 0):
+                    raise ValueError(f'app "{app}": invalid {key} {val}')
+
     def isAppKeyValid(self, appkey: str) -> bool:
         return self.apps.get(appkey) is not None
 
@@ -93,9 +156,52 @@ class AppsConfig:
         batchPublish = self.apps.get(appkey, {}).get('batch_publish', False)
         return batchPublish
 
+    def isLocalDeliveryEnabled(self, appkey: str) -> bool:
+        '''Messages published on a node are handed to its subscribers
+        without a redis round-trip'''
+        app = self.apps.get(appkey) or {}
+        return app.get('local_delivery', False)
+
+    def getSubscriptionQueueMaxSize(self, appkey: str) -> int:
+        app = self.apps.get(appkey) or {}
+        return app.get(
+            'subscription_queue_max_size', DEFAULT_SUBSCRIPTION_QUEUE_MAX_SIZE
+        )
+
+    def getSlowConsumerPolicy(self, appkey: str) -> str:
+        app = self.apps.get(appkey) or {}
+        return app.get('slow_consumer_policy', DEFAULT_SLOW_CONSUMER_POLICY)
+
+    def getPublishDedupMode(self, appkey: str):
+        '''memory, redis, or None when disabled'''
+        app = self.apps.get(appkey) or {}
+        return app.get('publish_dedup')
+
+    def getPublishDedupWindow(self, appkey: str) -> float:
+        '''In seconds'''
+        app = self.apps.get(appkey) or {}
+        window = app.get('publish_dedup_window_ms', DEFAULT_PUBLISH_DEDUP_WINDOW_MS)
+        return window / 1000
+
+    def getPublishDedupMaxKeys(self, appkey: str) -> int:
+        app = self.apps.get(appkey) or {}
+        return app.get('publish_dedup_max_keys', DEFAULT_PUBLISH_DEDUP_MAX_KEYS)
+
+    def getMaxInFlightRequests(self, appkey: str) -> int:
+        app = self.apps.get(appkey) or {}
+        return app.get('max_inflight_requests', DEFAULT_MAX_INFLIGHT_REQUESTS)
+
     def getBatchPublishSize(self):
         return self.data.get('batch_publish_size', -1)
 
+    def getBatchPublishMaxLinger(self):
+        '''In seconds, None for the publisher default'''
+        maxLinger = self.data.get('batch_publish_max_linger_ms')
+        if maxLinger is None:
+            return None
+
+        return maxLinger / 1000
+
     def getChannelMaxLength(self):
         return self.data.get('channel_max_length', 1000)
 
@@ -164,12 +270,23 @@ class AppsConfig:
         role = roles.get(roleName, {})
         return role.get('secret', '')
 
-    def getChannelBuilderRules(self, app) -> list:
-        try:
-            rules = self.data['apps'][app].get('channel_builder', {})
-            return rules
-        except KeyError:
-            return []
+    def getChannelBuilderRules(self, app):
+        '''The compiled rules of an app, or None when it has no rules'''
+        builder = self.channelBuilders.get(app)
+        if builder is None and app not in self.channelBuilders:
+            # Apps which were not validated
+            appConfig = (self.apps or {}).get(app) or {}
+            try:
+                builder = compileRules(appConfig.get('channel_builder'))
+            except ValueError as e:
+                logging.error(f'app "{app}": {e}')
+
+            self.channelBuilders[app] = builder
+
+        if builder is None or len(builder) == 0:
+            return None
+
+        return builder
 
 
 def generateAppsConfig(apps_config_path_content) -> str:
@@ -1,17 +1,226 @@
 '''Manipulate and create extra channel names based on rules defined in apps config
 
+Rules are compiled once, when the apps config is loaded, into a list of steps
+which are run on each published message. Invalid rules are rejected at that
+time.
+
+Rule kinds:
+* compose: a channel made of message fields, '{device.game}_{id}'
+* compose2: the same with two fields, field1 + separator + field2
+* add: a fixed channel
+* add_shard: one of N channels, picked at random ('channel_{shard}')
+* remove: drop the channels starting with a prefix
+
 Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
 '''
 
-import logging
 import random
-from cobras.common.algorithm import extractAttributeFromDict
+import string
+
+MISSING = object()
+
+
+def extractField(message, path):
+    '''path is a tuple of keys, MISSING when a key is not there'''
+    try:
+        for component in path:
+            message = message[component]
+    except (KeyError, TypeError):
+        return MISSING
+
+    # None and empty dicts were treated as missing fields historically
+    if message is None or message == {}:
+        return MISSING
+
+    return message
+
+
+def getString(rule, name, key):
+    val = rule.get(key)
+    if not isinstance(val, str):
+        raise ValueError(f'Invalid rule \'{name}\', \'{key}\' should be a string')
+
+    return val
+
+
+def escapeTemplate(text):
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+def makeCompose(paths, fmt):
+    def compose(message, channels):
+        values = []
+        for path in paths:
+            value = extractField(message, path)
+            if value is MISSING:
+                return channels
+
+            values.append(value)
+
+        channels.append(fmt.format(*values))
+        return channels
+
+    return compose
+
+
+def compileCompose(name, rule):
+    template = getString(rule, name, 'template')
+
+    paths = []
+    fmt = []
+    try:
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            fmt.append(escapeTemplate(literal))
+            if field is None:
+                continue
+
+            if not field or spec or conversion:
+                raise ValueError(f'Invalid rule \'{name}\', bad field in {template}')
+
+            paths.append(tuple(field.split('.')))
+            fmt.append('{}')
+    except ValueError as e:
+        raise ValueError(f'Invalid rule \'{name}\', bad template {template}: {e}')
+
+    if not paths:
+        raise ValueError(f'Invalid rule \'{name}\', no field in {template}')
+
+    return makeCompose(paths, ''.join(fmt))
+
+
+def compileCompose2(name, rule):
+    separator = getString(rule, name, 'separator')
+    paths = [
+        tuple(getString(rule, name, key).split('.')) for key in ('field1', 'field2')
+    ]
+    return makeCompose(paths, '{}' + escapeTemplate(separator) + '{}')
+
+
+def compileAdd(name, rule):
+    channel = getString(rule, name, 'channel')
+
+    def add(message, channels):
+        channels.append(channel)
+        return channels
+
+    add.channels = [channel]
+    return add
+
+
+def fuseAdds(steps):
+    '''Consecutive add rules become a single step'''
+    fused = []
+    for step in steps:
+        previous = fused[-1] if fused else None
+        if not hasattr(step, 'channels') or not hasattr(previous, 'channels'):
+            fused.append(step)
+            continue
+
+        addedChannels = previous.channels + step.channels
+
+        def add(message, channels, addedChannels=addedChannels):
+            channels.extend(addedChannels)
+            return channels
+
+        add.channels = addedChannels
+        fused[-1] = add
+
+    return fused
+
+
+def compileAddShard(name, rule):
+    channel = getString(rule, name, 'channel')
+
+    shards = rule.get('shards')
+    if not str(shards).isdigit() or int(shards) == 0:
+        raise ValueError(
+            f'Invalid rule \'{name}\', \'shards\' should be a positive integer'
+        )
+
+    shards = int(shards)
+    try:
+        shardChannels = [channel.format(shard=shard) for shard in range(shards)]
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError(f'Invalid rule \'{name}\', bad channel {channel}: {e}')
+
+    def addShard(message, channels):
+        channels.append(shardChannels[random.randrange(shards)])
+        return channels
+
+    return addShard
+
+
+def compileRemove(name, rule):
+    prefix = getString(rule, name, 'prefix')
+
+    def remove(message, channels):
+        return [chan for chan in channels if not chan.startswith(prefix)]
+
+    return remove
+
+
+RULE_COMPILERS = {
+    'compose': compileCompose,
+    'compose2': compileCompose2,
+    'add': compileAdd,
+    'add_shard': compileAddShard,
+    'remove': compileRemove,
+}
+
+
+class ChannelBuilder:
+    '''The compiled rules of an app'''
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    def __len__(self):
+        return len(self.steps)
+
+    def build(self, message, channels):
+        '''Returns the channels a message should be published to'''
+        for step in self.steps:
+            channels = step(message, channels)
+
+        # Drop the duplicates, keeping the order
+        return list(dict.fromkeys(channels))
+
+
+def compileRules(rules) -> ChannelBuilder:
+    '''Raise ValueError for invalid rules'''
+    if rules is None:
+        rules = {}
+
+    if not isinstance(rules, dict):
+        raise ValueError('channel builder rules should be a dict')
+
+    steps = []
+    for name, rule in rules.items():
+        if not isinstance(name, str):
+            raise ValueError(f'Invalid rule name \'{name}\', should be a string')
+
+        if not isinstance(rule, dict):
+            raise ValueError(f'Invalid rule \'{name}\', should be a dict')
+
+        compileRule = RULE_COMPILERS.get(rule.get('kind'))
+        if compileRule is None:
+            raise ValueError(
+                f'Invalid rule \'{name}\', unknown kind {rule.get("kind")}'
+            )
+
+        steps.append(compileRule(name, rule))
+
+    return ChannelBuilder(fuseAdds(steps))
 
 
 def updateMsg(rules, msg):
+    '''rules are usually compiled, see AppsConfig.getChannelBuilderRules'''
     if rules is None or len(rules) == 0:
         return msg
 
+    if not isinstance(rules, ChannelBuilder):
+        rules = compileRules(rules)
+
     body = msg.get('body')
     if body is None:  # invalid cobra schema
         return msg
@@ -24,83 +233,11 @@ def updateMsg(rules, msg):
     if channels is not None and not isinstance(channels, list):  # invalid cobra schema
         return msg
 
-    if channels is None:
-        channels = []
+    channels = [] if channels is None else list(channels)
 
     channel = body.get('channel')
     if channel is not None:
         channels.append(channel)
 
-    # Now loop through each rules in the app config
-    # TODO extract the rule validation so it only executes once to sanitize the input
-    # instead of every time we update a message
-    for ruleName, rule in rules.items():
-        if not isinstance(ruleName, str):
-            logging.warning(f'Invalid rule name \'{ruleName}\', should be a string')
-            continue
-
-        if rule is None or not isinstance(rule, dict):
-            logging.warning(f'Invalid rule \'{rule}\', should be a dict')
-            continue
-
-        kind = rule.get('kind')
-        if not isinstance(kind, str):
-            logging.warning(f'Invalid rule kind \'{kind}\', should be a string')
-            continue
-
-        if kind == 'compose2':
-            separator = rule.get('separator')
-            field1 = rule.get('field1')
-            field2 = rule.get('field2')
-
-            if separator is None or field1 is None or field2 is None:
-                logging.warning(f'Invalid compose2 rule \'{rule}\'')
-            else:
-                field1 = extractAttributeFromDict(message, field1)
-                if field1 is None or field1 == {}:
-                    continue
-
-                field2 = extractAttributeFromDict(message, field2)
-                if field2 is None or field2 == {}:
-                    continue
-
-                channel = f'{field1}{separator}{field2}'
-            channels.append(channel)
-
-        elif kind == 'add_shard':
-            shards = rule.get('shards')
-            if not (isinstance(kind, (int, str)) and str(shards).isdigit()):
-                logging.warning(
-                    f'Invalid {kind} rule, " \
-                                "\'shards\' should be a positive integer, got {shards}'
-                )
-                continue
-
-            channel = rule.get('channel')
-            if not isinstance(channel, str):
-                logging.warning(f'Invalid {kind} rule, \'channel\' should be a string')
-                continue
-
-            shard = random.randrange(start=0, stop=shards)
-            channels.append(channel.format(shard=shard))
-
-        elif kind == 'add':
-            channel = rule.get('channel')
-            if not isinstance(channel, str):
-                logging.warning(f'Invalid {kind} rule, \'channel\' should be a string')
-                continue
-
-            channels.append(channel)
-
-        elif kind == 'remove':
-            prefix = rule.get('prefix')
-            channels = {chan for chan in channels if not chan.startswith(prefix)}
-            channels = list(channels)
-
-        else:
-            logging.warning(f'Invalid rule kind \'{kind}\'')
-            continue
-
-    msg['body']['channels'] = list(set(channels))
-
+    body['channels'] = rules.build(message, channels)
     return msg
@@ -3,7 +3,10 @@
 Copyright (c) 2018-2019 Machine Zone, Inc. All rights reserved.
 '''
 
-from typing import Any, Dict
+from typing import Any, Dict, Union
 
 JsonDict = Dict[str, Any]
 YamlDict = Dict[str, Any]
+
+# Pdus are handed to the handlers as they were received
+SerializedPdu = Union[str, bytes]
@@ -0,0 +1,92 @@
+'''JSON encoding and decoding for the hot paths.
+
+orjson is used when it is installed, the json module of the standard library
+otherwise. COBRA_JSON_BACKEND=json forces the standard library.
+
+Both backends decode to the same values and raise the same exceptions
+(json.JSONDecodeError, TypeError), orjson falls back to the standard
+library for the documents it does not support (NaN and Infinity, integers
+over 64 bits). orjson encodes non-finite floats as null without complaining,
+so documents with a null are checked for them. The encoded documents are
+equivalent, but not byte for byte identical: orjson does not put spaces after
+separators.
+
+loads accepts bytes as well as str, so that websocket frames and redis
+replies do not need to be decoded first (orjson parses utf-8 directly).
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import json
+import math
+import os
+
+try:
+    import orjson
+except ImportError:  # orjson is optional
+    orjson = None
+
+JSONDecodeError = json.JSONDecodeError
+
+BACKEND = os.getenv('COBRA_JSON_BACKEND', 'orjson' if orjson else 'json')
+if BACKEND not in ('orjson', 'json') or (BACKEND == 'orjson' and orjson is None):
+    BACKEND = 'json'
+
+
+def stdlibLoads(data):
+    # Faster than letting json.loads detect the encoding of bytes
+    if isinstance(data, bytes):
+        data = data.decode()
+
+    return json.loads(data)
+
+
+def orjsonLoads(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # Raise the same error, or decode NaN, Infinity and big integers
+        return json.loads(data)
+
+
+def hasNonFiniteFloat(obj) -> bool:
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+
+    if isinstance(obj, dict):
+        return any(hasNonFiniteFloat(val) for val in obj.values())
+
+    if isinstance(obj, (list, tuple)):
+        return any(hasNonFiniteFloat(val) for val in obj)
+
+    return False
+
+
+def stdlibDumps(obj, sortKeys=False) -> str:
+    return json.dumps(obj, sort_keys=sortKeys)
+
+
+def orjsonDumps(obj, sortKeys=False) -> str:
+    option = orjson.OPT_NON_STR_KEYS
+    if sortKeys:
+        option |= orjson.OPT_SORT_KEYS
+
+    try:
+        data = orjson.dumps(obj, option=option)
+    except TypeError:
+        # Integers over 64 bits, or a genuine error
+        return stdlibDumps(obj, sortKeys)
+
+    # NaN and Infinity were turned into null
+    if b'null' in data and hasNonFiniteFloat(obj):
+        return stdlibDumps(obj, sortKeys)
+
+    return data.decode()
+
+
+if BACKEND == 'orjson':
+    loads = orjsonLoads
+    dumps = orjsonDumps
+else:
+    loads = stdlibLoads
+    dumps = stdlibDumps
@@ -0,0 +1,136 @@
+'''PDU encodings, picked per connection from the websocket subprotocol.
+
+json is always available, cbor requires the cbor2 package.
+
+Subscription data pdus are assembled from messages, subscription ids and
+positions which were encoded beforehand, so that a message is encoded once
+for all the subscribers using the same encoding.
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import struct
+
+try:
+    import cbor2
+except ImportError:  # cbor is optional
+    cbor2 = None
+
+from cobras.common.fast_json import dumps, loads
+
+JSON_SUBPROTOCOL = 'json'
+CBOR_SUBPROTOCOL = 'cbor'
+
+# It decodes to the same pdu as dumps(pdu), laid out like json.dumps output.
+SUBSCRIPTION_DATA_TEMPLATE = (
+    '{{"action": "rtm/subscription/data", "id": {}, '
+    + '"body": {{"subscription_id": {}, "messages": [{}], "position": {}}}}}'
+)
+
+
+class JsonCodec:
+    subprotocol = JSON_SUBPROTOCOL
+    binary = False
+
+    def encode(self, pdu) -> str:
+        return dumps(pdu)
+
+    def decode(self, data):
+        '''Raise ValueError for malformed pdus'''
+        return loads(data)
+
+    def encodeValue(self, value) -> str:
+        return dumps(value)
+
+    def encodeSubscriptionData(
+        self, msgId: int, encodedSubscriptionId, messages, encodedPosition
+    ) -> str:
+        return SUBSCRIPTION_DATA_TEMPLATE.format(
+            msgId, encodedSubscriptionId, ', '.join(messages), encodedPosition
+        )
+
+
+def encodeCborArrayHeader(length: int) -> bytes:
+    '''Major type 4, followed by the items'''
+    if length < 24:
+        return bytes([0x80 | length])
+    elif length < 0x100:
+        return struct.pack('>BB', 0x98, length)
+    elif length < 0x10000:
+        return struct.pack('>BH', 0x99, length)
+    elif length < 0x100000000:
+        return struct.pack('>BL', 0x9A, length)
+    else:
+        return struct.pack('>BQ', 0x9B, length)
+
+
+class CborCodec:
+    subprotocol = CBOR_SUBPROTOCOL
+    binary = True
+
+    def __init__(self):
+        dumps = cbor2.dumps
+
+        # {"action": "rtm/subscription/data", "id": .. "body": {
+        #     "subscription_id": .., "messages": [..], "position": ..}}
+        self.subscriptionDataHeader = (
+            b'\xa3' + dumps('action') + dumps('rtm/subscription/data') + dumps('id')
+        )
+        self.subscriptionDataBody = dumps('body') + b'\xa3' + dumps('subscription_id')
+        self.messagesKey = dumps('messages')
+        self.positionKey = dumps('position')
+
+    def encode(self, pdu) -> bytes:
+        return cbor2.dumps(pdu)
+
+    def decode(self, data):
+        '''Raise ValueError for malformed pdus'''
+        if isinstance(data, str):
+            raise ValueError('cbor pdus must be sent in binary frames')
+
+        try:
+            return cbor2.loads(data)
+        except cbor2.CBORDecodeError as e:
+            # Truncated pdus raise an EOFError
+            raise ValueError(f'malformed cbor pdu: {e}')
+
+    def encodeValue(self, value) -> bytes:
+        return cbor2.dumps(value)
+
+    def encodeSubscriptionData(
+        self, msgId: int, encodedSubscriptionId, messages, encodedPosition
+    ) -> bytes:
+        return b''.join(
+            [
+                self.subscriptionDataHeader,
+                cbor2.dumps(msgId),
+                self.subscriptionDataBody,
+                encodedSubscriptionId,
+                self.messagesKey,
+                encodeCborArrayHeader(len(messages)),
+                *messages,
+                self.positionKey,
+                encodedPosition,
+            ]
+        )
+
+
+JSON_CODEC = JsonCodec()
+
+CODECS = {JSON_SUBPROTOCOL: JSON_CODEC}
+if cbor2 is not None:
+    CODECS[CBOR_SUBPROTOCOL] = CborCodec()
+
+SUBPROTOCOLS = list(CODECS)
+
+
+def getCodec(subprotocol):
+    '''Clients which did not ask for a subprotocol speak json'''
+    if subprotocol is None:
+        return JSON_CODEC
+
+    codec = CODECS.get(subprotocol)
+    if codec is None:
+        raise ValueError(f'Unsupported pdu encoding: {subprotocol}')
+
+    return codec
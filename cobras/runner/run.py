@@ -18,6 +18,13 @@ from cobras.common.apps_config import (
 )
 from cobras.common.version import getVersion
 from cobras.server.app import AppRunner
+from cobras.server.redis_pool import DEFAULT_REDIS_POOL_SIZE
+from cobras.server.replica_routing import (
+    DEFAULT_REPLICA_MAX_LAG,
+    READ_FROM_MASTER,
+    READ_POLICIES,
+)
+from cobras.server.workers import forkWorkers, installUvloop, pinWorkerToCpu
 
 
 @click.command()
@@ -33,6 +40,12 @@ from cobras.server.app import AppRunner
 )
 @click.option('--redis_password', envvar='COBRA_REDIS_PASSWORD')
 @click.option('--redis_cluster', is_flag=True, envvar='COBRA_REDIS_CLUSTER')
+@click.option(
+    '--redis_sharding',
+    is_flag=True,
+    envvar='COBRA_REDIS_SHARDING',
+    help='Spread channels over the redis urls with a consistent hash ring',
+)
 @click.option(
     '--apps_config_path', envvar='COBRA_APPS_CONFIG', default=getDefaultAppsConfigPath()
 )
@@ -76,12 +89,50 @@ from cobras.server.app import AppRunner
     default=getDefaultMessageMaxSize(),
 )
 @click.option('--pidfile', envvar='COBRA_PID_FILE')
+@click.option(
+    '--redis_pool_size',
+    envvar='COBRA_REDIS_POOL_SIZE',
+    default=DEFAULT_REDIS_POOL_SIZE,
+    help='Redis connections kept open for reads and deletes',
+)
+@click.option(
+    '--redis_read_from',
+    envvar='COBRA_REDIS_READ_FROM',
+    default=READ_FROM_MASTER,
+    type=click.Choice(READ_POLICIES),
+    help='Serve subscriptions and reads from the masters or their replicas',
+)
+@click.option(
+    '--redis_replica_max_lag',
+    envvar='COBRA_REDIS_REPLICA_MAX_LAG',
+    default=DEFAULT_REPLICA_MAX_LAG,
+    help='Replicas more bytes of replication stream behind are skipped',
+)
+@click.option(
+    '--workers',
+    envvar='COBRA_WORKERS',
+    default=1,
+    help='Number of worker processes, sharing the port with SO_REUSEPORT',
+)
+@click.option(
+    '--cpu_affinity',
+    envvar='COBRA_CPU_AFFINITY',
+    is_flag=True,
+    help='Pin each worker to its own cpu',
+)
+@click.option(
+    '--uvloop',
+    envvar='COBRA_UVLOOP',
+    is_flag=True,
+    help='Use the uvloop event loop (pip install uvloop)',
+)
 def run(
     host,
     port,
     redis_urls,
     redis_password,
     redis_cluster,
+    redis_sharding,
     apps_config_path,
     apps_config_path_content,
     debug_memory,
@@ -98,24 +149,32 @@ def run(
     environment,
     message_max_size,
     pidfile,
+    redis_pool_size,
+    redis_read_from,
+    redis_replica_max_lag,
+    workers,
+    cpu_affinity,
+    uvloop,
 ):
     '''Run the cobra server
 
     \b
     cobra run --redis_urls 'redis://localhost:7001;redis://localhost:7002'
     \b
+    cobra run --redis_sharding -r 'redis://redis1;redis://redis2;redis://redis3'
+    \b
     env COBRA_REDIS_PASSWORD=foobared cobra run
+    \b
+    cobra run --workers 4 --cpu_affinity
+    \b
+    cobra run --redis_read_from replica_max_lag --redis_replica_max_lag 65536
     '''
     if prod:
         os.environ['COBRA_PROD'] = '1'
 
-    if sentry and sentry_url:
-        sentry_sdk.init(
-            sentry_url,
-            release=getVersion(),
-            environment=environment,
-            attach_stacktrace=True,
-        )
+    if redis_cluster and redis_sharding:
+        logging.error('--redis_cluster and --redis_sharding cannot be used together')
+        sys.exit(1)
 
     if pidfile:
         pid = str(os.getpid())
@@ -135,6 +194,25 @@ def run(
         apps_config_path_content = '<cleared>'
         os.environ['COBRA_APPS_CONFIG'] = apps_config_path
 
+    # Fork before starting any thread or event loop
+    workerId = 0
+    if workers > 1:
+        workerId = forkWorkers(workers)
+
+    if cpu_affinity:
+        pinWorkerToCpu(workerId)
+
+    if uvloop:
+        installUvloop()
+
+    if sentry and sentry_url:
+        sentry_sdk.init(
+            sentry_url,
+            release=getVersion(),
+            environment=environment,
+            attach_stacktrace=True,
+        )
+
     print('runServer', locals())
 
     runner = AppRunner(
@@ -153,12 +231,24 @@ def run(
         probeRedisOnStartup=not disable_redis_startup_probing,
         redisStartupProbingTimeout=redis_startup_probing_timeout,
         messageMaxSize=message_max_size,
+        reusePort=workers > 1,
+        workerId=workerId,
+        workerCount=workers,
+        redisPoolSize=redis_pool_size,
+        redisSharding=redis_sharding,
+        redisReadFrom=redis_read_from,
+        redisReplicaMaxLag=redis_replica_max_lag,
     )
 
     loop = asyncio.get_event_loop()
     stop = loop.create_future()
 
-    asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, stop.set_result, None)
+    def onTerminate():
+        # Workers can be signaled by the parent process and their process group
+        if not stop.done():
+            stop.set_result(None)
+
+    asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, onTerminate)
 
     try:
         runner.run(stop)
@@ -21,13 +21,23 @@ from sentry_sdk.hub import Hub
 
 from cobras.common.apps_config import STATS_APPKEY, PULSAR_APPKEY, AppsConfig
 from cobras.common.memory_debugger import MemoryDebugger
+from cobras.common.pdu_codecs import SUBPROTOCOLS, getCodec
 from cobras.common.task_cleanup import addTaskCleanup
 from cobras.common.version import getVersion
 from cobras.common.banner import getBanner
 from cobras.server.connection_state import ConnectionState
 from cobras.server.protocol import processCobraMessage
 from cobras.server.stats import ServerStats
+from cobras.server.pipelined_publishers import PipelinedPublishers
+from cobras.server.publish_dedup import PublishDeduplicators
+from cobras.server.rcc_client import RedisClientRcc
 from cobras.server.redis_clients import RedisClients
+from cobras.server.redis_pool import DEFAULT_REDIS_POOL_SIZE
+from cobras.server.replica_routing import DEFAULT_REPLICA_MAX_LAG, READ_FROM_MASTER
+from cobras.server.request_pipeline import RequestPipeline
+from cobras.server.stream_multiplexer import StreamMultiplexer
+from cobras.server.subscription_hub import SubscriptionHub
+from cobras.server.workers import WorkerRegistry
 from cobras.server.pulsar import processPulsarMessage
 
 
@@ -73,6 +83,13 @@ async def cobraHandler(websocket, path, app, redisUrls: str, userAgent: str):
     websocket.connection_id = state.connection_id
     websocket.connection_state = state
 
+    # The pdu encoding was negotiated during the websocket handshake
+    state.codec = getCodec(websocket.subprotocol)
+
+    maxInFlight = app['apps_config'].getMaxInFlightRequests(appkey)
+    if maxInFlight > 1:
+        state.requestPipeline = RequestPipeline(maxInFlight)
+
     key = state.connection_id
     app['connections'][key] = (state, websocket)
 
@@ -90,9 +107,6 @@ async def cobraHandler(websocket, path, app, redisUrls: str, userAgent: str):
             async for message in websocket:
                 state.msgCount += 1
 
-                if isinstance(message, bytes):
-                    message = message.decode()
-
                 await processCobraMessage(state, websocket, app, message)
 
                 if not state.ok:
@@ -109,6 +123,10 @@ async def cobraHandler(websocket, path, app, redisUrls: str, userAgent: str):
         print(e)
         print('Generic Exception caught in {}'.format(traceback.format_exc()))
     finally:
+        # Let the requests in flight complete
+        if state.requestPipeline is not None:
+            await state.requestPipeline.close()
+
         del app['connections'][key]
 
         subCount = len(state.subscriptions)
@@ -154,6 +172,14 @@ class ServerProtocol(websockets.WebSocketServerProtocol):
 
         self.requestHeaders = request_headers
 
+    def select_subprotocol(self, client_subprotocols, server_subprotocols):
+        '''Pick the first pdu encoding the client asked for that we support'''
+        for subprotocol in client_subprotocols:
+            if subprotocol in server_subprotocols:
+                return subprotocol
+
+        return None
+
     async def read_message(self):
         '''Override that method for debugging'''
 
@@ -193,6 +219,13 @@ class AppRunner:
         probeRedisOnStartup,
         redisStartupProbingTimeout,
         messageMaxSize,
+        reusePort=False,
+        workerId=0,
+        workerCount=1,
+        redisPoolSize=DEFAULT_REDIS_POOL_SIZE,
+        redisSharding=False,
+        redisReadFrom=READ_FROM_MASTER,
+        redisReplicaMaxLag=DEFAULT_REPLICA_MAX_LAG,
     ):
         self.app = {}
         self.app['connections'] = {}
@@ -206,6 +239,8 @@ class AppRunner:
         self.app['redis_urls'] = redisUrls
         self.app['redis_password'] = redisPassword
         self.app['redis_cluster'] = redisCluster
+        self.app['redis_sharding'] = redisSharding
+        self.app['redis_read_from'] = redisReadFrom
 
         self.host = host
         self.port = port
@@ -216,16 +251,40 @@ class AppRunner:
         self.redisStartupProbingTimeout = redisStartupProbingTimeout
         self.messageMaxSize = messageMaxSize
 
+        # Multi-process mode, workers share the port with SO_REUSEPORT
+        self.reusePort = reusePort
+        self.workerId = workerId
+        self.workerCount = workerCount
+
         appsConfig = AppsConfig(appsConfigPath)
         self.app['apps_config'] = appsConfig
 
         # Create app redis connection handler, one per apps to avoid one busy
         # app blocking others
         self.redisClients = RedisClients(
-            redisUrls, redisPassword, redisCluster, appsConfig
+            redisUrls,
+            redisPassword,
+            redisCluster,
+            appsConfig,
+            redisPoolSize,
+            redisSharding,
+            redisReadFrom,
+            redisReplicaMaxLag,
         )
         self.app['redis_clients'] = self.redisClients
 
+        # Blocking stream reads, shared by subscriptions and pulsar consumers
+        self.app['stream_multiplexer'] = StreamMultiplexer(
+            redisUrls,
+            redisPassword,
+            redisCluster,
+            self.redisClients.router,
+            self.redisClients.readRouter,
+        )
+        self.app['subscription_hub'] = SubscriptionHub(
+            self.redisClients, self.app['stream_multiplexer']
+        )
+
         try:
             appsConfig.validateConfig()
         except ValueError as e:
@@ -234,6 +293,17 @@ class AppRunner:
 
         self.app['batch_publish_size'] = appsConfig.getBatchPublishSize()
         self.app['channel_max_length'] = appsConfig.getChannelMaxLength()
+
+        # Publishes of apps with batch_publish enabled are pipelined together
+        self.app['pipelined_publishers'] = PipelinedPublishers(
+            self.redisClients,
+            self.app['batch_publish_size'],
+            self.app['channel_max_length'],
+            appsConfig.getBatchPublishMaxLinger(),
+        )
+        self.app['publish_deduplicators'] = PublishDeduplicators(
+            appsConfig, self.redisClients
+        )
         self.server = None
 
     async def waitForAllConnectionsToBeReady(self, timeout: float):
@@ -249,8 +319,11 @@ class AppRunner:
                 sys.stderr.flush()
 
                 try:
-                    redis = self.redisClients.makeRedisClient()
+                    redis = RedisClientRcc(
+                        url, self.redisPassword, self.app['redis_cluster']
+                    )
                     await redis.ping()
+                    redis.close()
                     break
                 except Exception:
                     if time.time() - start > timeout:
@@ -276,11 +349,39 @@ class AppRunner:
                 timeout=self.redisStartupProbingTimeout
             )
 
+        # Know where the keys live before routing any command
+        if self.app['redis_cluster']:
+            await self.redisClients.router.refresh()
+
+        # ... and where they are replicated
+        if self.redisClients.readsFromReplicas():
+            await self.redisClients.readRouter.refresh()
+
+        # Connect the clients used for reads and deletes ahead of time
+        await self.redisClients.pool.warm()
+        if self.redisClients.readsFromReplicas():
+            await self.redisClients.readPool.warm()
+
         redis = self.redisClients.getRedisClient(STATS_APPKEY)
 
         serverStats = ServerStats(redis, STATS_APPKEY)
         self.app['stats'] = serverStats
 
+        if self.workerCount > 1:
+            workerRegistry = WorkerRegistry(
+                redis,
+                self.app['stream_multiplexer'],
+                serverStats.node,
+                self.workerId,
+                self.workerCount,
+                self.app['connections'],
+            )
+            self.app['worker_registry'] = workerRegistry
+            serverStats.workerRegistry = workerRegistry
+
+            self.workerRegistryTask = asyncio.ensure_future(workerRegistry.run())
+            addTaskCleanup(self.workerRegistryTask)
+
         if self.enableStats:
             self.serverStatsTask = asyncio.ensure_future(serverStats.run())
             addTaskCleanup(self.serverStatsTask)
@@ -297,14 +398,23 @@ class AppRunner:
 
     async def cleanup(self):
         # FIXME: we could speed this up
+        await self.app['pipelined_publishers'].close()
+
         if self.enableStats:
             self.app['stats'].terminate()
             await self.serverStatsTask
 
+        if self.app.get('worker_registry'):
+            self.app['worker_registry'].terminate()
+            await self.workerRegistryTask
+
         if self.app.get('memory_debugger'):
             self.app['memory_debugger'].terminate()
             await self.memoryDebuggerTask
 
+        self.redisClients.pool.close()
+        self.redisClients.readPool.close()
+
     async def setup(self, stop=None, block=False):
         '''It would be good to unify better unittest mode versus command mode,
            and get rid of block
@@ -327,11 +437,12 @@ class AppRunner:
                 self.host,
                 self.port,
                 create_protocol=ServerProtocol,
-                subprotocols=['json'],
+                subprotocols=SUBPROTOCOLS,
                 ping_timeout=None,
                 ping_interval=None,
                 max_size=self.messageMaxSize,
                 extra_headers=extraHeaders,
+                reuse_port=self.reusePort,
             ) as self.server:
                 await stop
                 await self.cleanup()
@@ -341,11 +452,12 @@ class AppRunner:
                 self.host,
                 self.port,
                 create_protocol=ServerProtocol,
-                subprotocols=['json'],
+                subprotocols=SUBPROTOCOLS,
                 ping_timeout=None,
                 ping_interval=None,
                 max_size=self.messageMaxSize,
                 extra_headers=extraHeaders,
+                reuse_port=self.reusePort,
             )
 
     def run(self, stop):
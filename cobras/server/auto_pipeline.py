@@ -0,0 +1,118 @@
+'''Automatic pipelining of the commands sent to a redis connection.
+
+Commands are queued instead of being written right away, and all the commands
+queued during an event loop iteration are written with a single write, once
+the coroutines which issued them are suspended. A reader task resolves the
+replies in order. Many coroutines sharing a client do not wait for each
+other's round-trips anymore, and pay for one write syscall per loop iteration
+instead of one per command.
+
+Replies are returned as read, redis errors (hiredis.ReplyError) included, so
+that the client can follow redirections. Connection errors fail all the
+commands in flight on the connection, which is re-opened by the next command.
+
+Read connections to cluster replicas send READONLY first, each time they
+connect; its reply is skipped.
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import collections
+
+from cobras.common.task_cleanup import addTaskCleanup
+from cobras.server.replica_routing import READONLY_COMMAND
+
+
+class AutoPipeline:
+    def __init__(self, connection, readOnly: bool = False):
+        '''connection is a rcc connection'''
+        self.connection = connection
+        self.readOnly = readOnly
+
+        # Packed commands which are not written yet, and their futures
+        self.pending = []
+
+        # Futures of the commands written, waiting for their reply (None for
+        # READONLY)
+        self.waiters = collections.deque()
+
+        self.flushTask = None
+        self.readerTask = None
+
+    def connected(self):
+        return self.connection.connected()
+
+    def submit(self, command: bytes) -> asyncio.Future:
+        '''Queue a RESP encoded command, see packCommand'''
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((command, future))
+
+        if self.flushTask is None:
+            self.flushTask = asyncio.ensure_future(self.flush())
+            addTaskCleanup(self.flushTask)
+
+        return future
+
+    async def flush(self):
+        try:
+            while self.pending:
+                if not self.connection.connected():
+                    await self.connection.connect()
+
+                    if self.readOnly:
+                        self.pending.insert(0, (READONLY_COMMAND, None))
+
+                pending, self.pending = self.pending, []
+                writer = self.connection.writer
+                writer.write(b''.join(command for command, _ in pending))
+                self.waiters.extend(future for _, future in pending)
+
+                if self.readerTask is None:
+                    self.readerTask = asyncio.ensure_future(self.readReplies())
+                    addTaskCleanup(self.readerTask)
+
+                await writer.drain()
+        except asyncio.CancelledError:
+            self.fail(ConnectionError('redis connection closed'))
+            raise
+        except Exception as e:
+            self.fail(e)
+        finally:
+            self.flushTask = None
+
+    async def readReplies(self):
+        try:
+            while self.waiters:
+                response = await self.connection.readResponse()
+
+                # Cancelled commands still have their reply read
+                future = self.waiters.popleft()
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.readerTask = None
+            self.fail(e)
+            return
+
+        self.readerTask = None
+
+    def fail(self, error):
+        self.connection.close()
+
+        if self.readerTask is not None:
+            self.readerTask.cancel()
+            self.readerTask = None
+
+        futures = list(self.waiters) + [future for _, future in self.pending]
+        self.waiters.clear()
+        self.pending = []
+
+        for future in futures:
+            if future is not None and not future.done():
+                future.set_exception(error)
+
+    def close(self):
+        self.fail(ConnectionError('redis connection closed'))
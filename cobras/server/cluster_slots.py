@@ -0,0 +1,183 @@
+'''Client side routing of redis cluster commands.
+
+The hash slot of a key is computed locally (CRC16), and the node owning a
+slot is looked up in a table which is shared by all the redis clients of the
+process, so that routing a command does not cost a round-trip.
+
+The table is loaded with CLUSTER SLOTS. It is refreshed in the background
+every SLOT_MAP_REFRESH_INTERVAL seconds and when a node answers with a MOVED
+redirection, in which case the moved slot is updated right away. ASK
+redirections are temporary (a slot being migrated) and do not change the
+table.
+
+When redis is not running in cluster mode every key maps to the configured
+url, unless a MOVED redirection says otherwise.
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import logging
+import time
+from binascii import crc_hqx
+from urllib.parse import urlparse
+
+import hiredis
+from rcc.connection import Connection
+
+from cobras.common.task_cleanup import addTaskCleanup
+
+SLOT_COUNT = 16384
+SLOT_MAP_REFRESH_INTERVAL = 30  # seconds
+
+
+def getHashSlot(key) -> int:
+    '''CRC16 of the key, or of its {hash tag} when it has one'''
+    if isinstance(key, str):
+        key = key.encode()
+
+    start = key.find(b'{')
+    if start != -1:
+        begin = start + 1
+        end = key.find(b'}', begin)
+        if end > begin:
+            key = key[begin:end]
+
+    return crc_hqx(key, 0) % SLOT_COUNT
+
+
+def parseRedirection(response):
+    '''MOVED 3999 127.0.0.1:6381 -> ('MOVED', 3999, 'redis://127.0.0.1:6381')
+    None for other errors.
+    '''
+    tokens = str(response).split()
+    if len(tokens) != 3 or tokens[0] not in ('MOVED', 'ASK'):
+        return None
+
+    return tokens[0], int(tokens[1]), 'redis://' + tokens[2]
+
+
+def getNodeName(url: str) -> str:
+    '''redis://127.0.0.1 -> 127.0.0.1:6379'''
+    host, _, port = urlparse(url).netloc.partition(':')
+    return f'{host}:{port or 6379}'
+
+
+def parseClusterSlots(slots, defaultHost: str):
+    '''CLUSTER SLOTS reply -> [(start, end, url), ...], for the masters'''
+    ranges = []
+    for start, end, master, *replicas in slots:
+        host = master[0]
+        if isinstance(host, bytes):
+            host = host.decode()
+
+        # Unknown endpoints are the node which answered
+        if host in ('', '?'):
+            host = defaultHost
+
+        ranges.append((start, end, f'redis://{host}:{master[1]}'))
+
+    return ranges
+
+
+class SlotMap:
+    def __init__(self, url: str, password, cluster: bool):
+        self.url = url
+        self.password = password
+        self.cluster = cluster
+
+        # Slot -> url of the master owning it
+        self.urls = [url] * SLOT_COUNT
+
+        # Every key maps to self.url, no need to hash
+        self.single = True
+
+        # Masters serve reads without READONLY
+        self.readOnly = False
+
+        self.refreshedAt = None
+        self.refreshTask = None
+
+    def getSlotUrl(self, slot: int) -> str:
+        if self.cluster:
+            self.checkFreshness()
+
+        return self.urls[slot]
+
+    def getUrl(self, key) -> str:
+        if self.cluster:
+            self.checkFreshness()
+
+        if self.single or key is None:
+            return self.url
+
+        return self.urls[getHashSlot(key)]
+
+    def getNode(self, key) -> str:
+        '''host:port of the node owning a key'''
+        return getNodeName(self.getUrl(key))
+
+    def getUrls(self):
+        '''The masters'''
+        return set(self.urls)
+
+    def onMoved(self, slot: int, url: str):
+        if self.urls[slot] == url:
+            return
+
+        self.urls[slot] = url
+        self.single = False
+        self.scheduleRefresh()
+
+    def checkFreshness(self):
+        now = time.monotonic()
+        if (
+            self.refreshedAt is None
+            or now - self.refreshedAt > SLOT_MAP_REFRESH_INTERVAL
+        ):
+            self.scheduleRefresh()
+
+    def scheduleRefresh(self):
+        if self.refreshTask is not None and not self.refreshTask.done():
+            return
+
+        # Set before the refresh completes, so that failures are not retried
+        # on every command
+        self.refreshedAt = time.monotonic()
+
+        self.refreshTask = asyncio.ensure_future(self.refresh())
+        addTaskCleanup(self.refreshTask)
+
+    async def refresh(self):
+        '''Load the table from the first node which answers'''
+        self.refreshedAt = time.monotonic()
+
+        urls = [self.url] + sorted(set(self.urls) - {self.url})
+        for url in urls:
+            connection = Connection(url, self.password)
+            try:
+                await connection.send('CLUSTER', 'SLOTS')
+                response = await connection.readResponse()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f'slot map: cannot connect to {url}: {e}')
+                continue
+            finally:
+                connection.close()
+
+            if isinstance(response, hiredis.ReplyError):
+                logging.warning(f'slot map: CLUSTER SLOTS failed on {url}: {response}')
+                return
+
+            self.update(parseClusterSlots(response, connection.host))
+            return
+
+    def update(self, ranges):
+        urls = list(self.urls)
+        for start, end, url in ranges:
+            stop = end + 1
+            urls[start:stop] = [url] * (stop - start)
+
+        self.urls = urls
+        self.single = set(urls) == {self.url}
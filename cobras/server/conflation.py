@@ -0,0 +1,110 @@
+'''Conflated subscriptions: only the latest message per key is delivered.
+
+The key is a comma separated list of message fields, with the StreamSQL dotted
+notation for nested fields (device.android_id). Messages are held for a flush
+interval, a newer message for the same key replaces the pending one, and the
+survivors are sent in position order when the interval expires.
+
+Messages missing the key fields are never conflated.
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import collections
+
+from cobras.common.fast_json import dumps
+
+DEFAULT_CONFLATE_INTERVAL = 1  # seconds
+
+
+class InvalidConflateKeyError(Exception):
+    pass
+
+
+class ConflateKey:
+    def __init__(self, expression: str):
+        if not isinstance(expression, str):
+            raise InvalidConflateKeyError(f'Invalid conflate key: {expression}')
+
+        self.paths = []
+        for field in expression.split(','):
+            components = field.strip().split('.')
+            if any(component == '' or ' ' in component for component in components):
+                raise InvalidConflateKeyError(f'Invalid conflate key: {expression}')
+
+            self.paths.append(components)
+
+    def extract(self, msg):
+        '''Return None if one of the fields is missing'''
+        if isinstance(msg, list) and len(msg) != 0:
+            msg = msg[0]
+
+        values = []
+        for components in self.paths:
+            val = msg
+            for component in components:
+                if not isinstance(val, dict):
+                    return None
+
+                val = val.get(component)
+
+            if val is None:
+                return None
+
+            if isinstance(val, (dict, list)):
+                val = dumps(val, sortKeys=True)
+
+            values.append(val)
+
+        return tuple(values)
+
+
+class Conflater:
+    def __init__(self, key: ConflateKey, interval: float, maxKeys: int, flush):
+        '''flush is called with each message which survived conflation,
+        and its position. More than maxKeys pending keys trigger a flush.
+        '''
+        self.key = key
+        self.interval = interval
+        self.maxKeys = maxKeys
+        self.flush = flush
+
+        # key -> (message, encodedPosition), ordered by position
+        self.pending = collections.OrderedDict()
+        self.timer = None
+
+    def add(self, msg, message: str, encodedPosition: str):
+        key = self.key.extract(msg)
+        if key is None:
+            key = object()
+
+        # Move it to the end, to keep the pending messages in position order
+        if key in self.pending:
+            del self.pending[key]
+
+        self.pending[key] = (message, encodedPosition)
+
+        if len(self.pending) > self.maxKeys:
+            self.flushPending()
+        elif self.timer is None:
+            loop = asyncio.get_event_loop()
+            self.timer = loop.call_later(self.interval, self.flushPending)
+
+    def flushPending(self):
+        self.cancelTimer()
+
+        pending = self.pending
+        self.pending = collections.OrderedDict()
+
+        for message, encodedPosition in pending.values():
+            self.flush(message, encodedPosition)
+
+    def cancelTimer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def close(self):
+        self.cancelTimer()
+        self.pending.clear()
@@ -3,13 +3,13 @@
 Copyright (c) 2018-2019 Machine Zone, Inc. All rights reserved.
 '''
 
-import json
 import logging
 import os
 import tempfile
 import uuid
 
 import websockets
+from cobras.common.pdu_codecs import JSON_CODEC
 
 
 class ConnectionState:
@@ -24,6 +24,15 @@ class ConnectionState:
         self.authenticated = False
         self.permissions = []
 
+        # Successful publishes are acknowledged, unless disabled at handshake
+        self.publishAck = True
+
+        # Negotiated with the websocket subprotocol
+        self.codec = JSON_CODEC
+
+        # Concurrent requests, None when they are handled one at a time
+        self.requestPipeline = None
+
         self.nonce = None
         self.error = 'na'
         self.msgCount = 0
@@ -41,8 +50,8 @@ class ConnectionState:
                 f.write(log + '\n')
 
     async def respond(self, ws, data):
-        response = json.dumps(data)
-        self.log(f"> {response}")
+        response = self.codec.encode(data)
+        self.log(f"> {data if self.codec.binary else response}")
 
         try:
             await ws.send(response)
@@ -6,7 +6,7 @@ Copyright (c) 2018-2019 Machine Zone, Inc. All rights reserved.
 import logging
 from typing import Dict
 
-from cobras.common.cobra_types import JsonDict
+from cobras.common.cobra_types import JsonDict, SerializedPdu
 from cobras.server.connection_state import ConnectionState
 
 
@@ -14,10 +14,16 @@ from cobras.server.connection_state import ConnectionState
 # Admin operations
 #
 async def handleAdminGetConnections(
-    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: str
+    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: SerializedPdu
 ):
     action = pdu['action']
-    connections = list(app['connections'].keys())
+
+    # In multi-process mode, list the connections of all the workers
+    workerRegistry = app.get('worker_registry')
+    if workerRegistry is not None:
+        connections = await workerRegistry.getConnections()
+    else:
+        connections = list(app['connections'].keys())
 
     response = {
         "action": f"{action}/ok",
@@ -28,7 +34,7 @@ async def handleAdminGetConnections(
 
 
 async def handleAdminCloseConnection(
-    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: str
+    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: SerializedPdu
 ):
     action = pdu['action']
     body = pdu.get('body', {})
@@ -81,7 +87,7 @@ async def toggleFileLogging(state: ConnectionState, app: Dict, params: JsonDict)
 
 # FIXME (should close current connection)
 async def handleAdminCloseAllConnection(
-    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: str
+    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: SerializedPdu
 ):
     action = pdu['action']
 
@@ -7,7 +7,7 @@ import platform
 import logging
 from typing import Dict
 
-from cobras.common.cobra_types import JsonDict
+from cobras.common.cobra_types import JsonDict, SerializedPdu
 from cobras.server.connection_state import ConnectionState
 from cobras.common.apps_config import generateNonce
 from cobras.common.auth_hash import computeHash
@@ -15,7 +15,7 @@ from cobras.common.version import getVersion
 
 
 async def handleHandshake(
-    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: str
+    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: SerializedPdu
 ):
     authMethod = pdu.get('body', {}).get('method')
     if authMethod != 'role_secret':
@@ -29,10 +29,25 @@ async def handleHandshake(
         await state.respond(ws, response)
         return
 
-    role = pdu.get('body', {}).get('data', {}).get('role')
+    data = pdu.get('body', {}).get('data', {})
+    role = data.get('role')
     state.role = role
     state.nonce = generateNonce()
 
+    publishAck = data.get('publish_ack', True)
+    if not isinstance(publishAck, bool):
+        errMsg = f'invalid publish_ack: {publishAck}'
+        logging.warning(errMsg)
+        response = {
+            "action": "auth/handshake/error",
+            "id": pdu.get('id', 1),
+            "body": {"error": errMsg},
+        }
+        await state.respond(ws, response)
+        return
+
+    state.publishAck = publishAck
+
     response = {
         "action": "auth/handshake/ok",
         "id": pdu.get('id', 1),
@@ -42,6 +57,7 @@ async def handleHandshake(
                 "version": getVersion(),
                 "connection_id": state.connection_id,
                 "node": platform.uname().node,
+                "publish_ack": state.publishAck,
             }
         },
     }
@@ -49,7 +65,7 @@ async def handleHandshake(
 
 
 async def handleAuth(
-    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: str
+    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: SerializedPdu
 ):
     try:
         secret = app['apps_config'].getRoleSecret(state.appkey, state.role)
@@ -7,11 +7,11 @@ FIXME: missing delete
 '''
 
 import asyncio
-import json
 import logging
 from typing import Dict, Optional
 
-from cobras.common.cobra_types import JsonDict
+from cobras.common.cobra_types import JsonDict, SerializedPdu
+from cobras.common.fast_json import dumps, loads
 from cobras.server.connection_state import ConnectionState
 
 
@@ -34,7 +34,7 @@ async def kvStoreRead(redis, stream: str, position: Optional[str], logger):
         msg = result[1]
         data = msg[b'json']
 
-        msg = json.loads(data)
+        msg = loads(data)
         return msg
 
     except asyncio.CancelledError:
@@ -44,7 +44,7 @@ async def kvStoreRead(redis, stream: str, position: Optional[str], logger):
 
 # FIXME error handling
 async def handleRead(
-    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: str
+    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: SerializedPdu
 ):
 
     body = pdu.get('body', {})
@@ -53,11 +53,10 @@ async def handleRead(
 
     appChannel = '{}::{}'.format(state.appkey, channel)
 
-    redis = app['redis_clients'].makeRedisClient()
-
     try:
-        # Handle read
-        message = await kvStoreRead(redis, appChannel, position, state.log)
+        # Handle read, possibly from a replica
+        async with app['redis_clients'].readPool.client() as redis:
+            message = await kvStoreRead(redis, appChannel, position, state.log)
     except Exception as e:
         errMsg = f'read: cannot connect to redis {e}'
         logging.warning(errMsg)
@@ -81,7 +80,7 @@ async def handleRead(
 
 
 async def handleWrite(
-    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: str
+    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: SerializedPdu
 ):
     # Missing message
     message = pdu.get('body', {}).get('message')
@@ -118,7 +117,7 @@ async def handleWrite(
     try:
         appChannel = '{}::{}'.format(state.appkey, channel)
 
-        serializedPdu = json.dumps(message)
+        serializedPdu = dumps(message)
         streamId = await redis.xadd(appChannel, 'json', serializedPdu, maxLen=1)
 
     except Exception as e:
@@ -144,7 +143,7 @@ async def handleWrite(
 
 
 async def handleDelete(
-    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: str
+    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: SerializedPdu
 ):
     # Missing channel
     channel = pdu.get('body', {}).get('channel')
@@ -161,11 +160,9 @@ async def handleDelete(
 
     appChannel = '{}::{}'.format(state.appkey, channel)
 
-    appkey = state.appkey
-    redis = app['redis_clients'].getRedisClient(appkey)
-
     try:
-        await redis.delete(appChannel)
+        async with app['redis_clients'].pool.client() as redis:
+            await redis.delete(appChannel)
     except Exception as e:
         errMsg = f'delete: cannot connect to redis {e}'
         logging.warning(errMsg)
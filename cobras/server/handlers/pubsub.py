@@ -4,29 +4,49 @@ Copyright (c) 2018-2019 Machine Zone, Inc. All rights reserved.
 '''
 import asyncio
 import itertools
-import json
 import logging
 from typing import Dict
 
 from cobras.common.channel_builder import updateMsg
-from cobras.common.cobra_types import JsonDict
+from cobras.common.cobra_types import JsonDict, SerializedPdu
+from cobras.common.fast_json import dumps
 from cobras.common.task_cleanup import addTaskCleanup
 from cobras.common.throttle import Throttle
+from cobras.server.conflation import (
+    DEFAULT_CONFLATE_INTERVAL,
+    ConflateKey,
+    Conflater,
+    InvalidConflateKeyError,
+)
 from cobras.server.connection_state import ConnectionState
+from cobras.server.publish_dedup import getDedupKey
+from cobras.server.request_pipeline import markOrdered
 from rcc.subscriber import (
     RedisSubscriberMessageHandlerClass,
     redisSubscriber,
     validatePosition,
 )
-from cobras.server.stream_sql import InvalidStreamSQLError, StreamSqlFilter
+from cobras.server.stream_sql import InvalidStreamSQLError, getStreamSqlFilter
+from cobras.server.subscription_batcher import (
+    DEFAULT_ADAPTIVE_MAX_BATCH_SIZE,
+    SlowConsumerError,
+    SubscriptionBatcher,
+)
+from cobras.server.subscription_hub import StreamBatch, StreamEntry
 
 
 async def handlePublish(
-    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: str
+    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: SerializedPdu
 ):
-    '''Here we don't write back a result to the client for efficiency.
-    Client doesn't really needs it.
+    '''Successful publishes are not acknowledged when the client asked so,
+    at handshake time or with ack set to false in the pdu. Errors are always
+    sent back.
     '''
+    # Many messages in one publish
+    if 'messages' in pdu.get('body', {}):
+        await handleBatchPublish(state, ws, app, pdu)
+        return
+
     # Potentially add extra channels with channel builder rules
     rules = app['apps_config'].getChannelBuilderRules(state.appkey)
     pdu = updateMsg(rules, pdu)
@@ -61,51 +81,405 @@ async def handlePublish(
     if channels is None:
         channels = [channel]
 
-    streams = {}
+    # Unfiltered subscribers forward it as is
+    serializedMessage = dumps(message)
 
     appkey = state.appkey
-    redis = app['redis_clients'].getRedisClient(appkey)
 
-    for chan in channels:
+    # sanity check to skip empty channels
+    publishedChannels = [chan for chan in channels if chan is not None]
+    streams = ['{}::{}'.format(appkey, chan) for chan in publishedChannels]
 
-        # sanity check to skip empty channels
-        if chan is None:
-            continue
+    # Drop the channels which already got that message (retries)
+    duplicateChannels = []
+    deduplicator = app['publish_deduplicators'].get(appkey)
+    if deduplicator is not None:
+        dedupKey = getDedupKey(pdu.get('body', {}), serializedMessage)
+        fresh = await deduplicator.claim(streams, dedupKey)
 
-        try:
-            maxLen = app['channel_max_length']
-            stream = '{}::{}'.format(appkey, chan)
-            streamId = await redis.xadd(stream, 'json', serializedPdu, maxLen)
+        duplicateChannels = [
+            chan for chan, isNew in zip(publishedChannels, fresh) if not isNew
+        ]
+        publishedChannels = list(itertools.compress(publishedChannels, fresh))
+        streams = list(itertools.compress(streams, fresh))
 
-            streams[chan] = streamId
-        except Exception as e:
-            # await publishers.erasePublisher(appkey, chan)  # FIXME
+        app['stats'].updatePublishDuplicates(state.role, len(duplicateChannels))
 
-            errMsg = f'publish: cannot connect to redis {e}'
-            logging.warning(errMsg)
-            response = {
-                "action": "rtm/publish/error",
-                "id": pdu.get('id', 1),
-                "body": {"error": errMsg},
-            }
-            await state.respond(ws, response)
-            return
+    # Apps with batch publish enabled share a pipeline across connections
+    batchPublish = app['apps_config'].isBatchPublishEnabled(appkey)
+    publisher = app['pipelined_publishers'].get(appkey)
 
+    try:
+        # One round-trip for all the channels
+        if streams:
+            job = (streams, serializedPdu, serializedMessage)
+            published = publisher.submit(job, batchPublish)
+
+            # The next publishes of the connection can be queued behind ours
+            markOrdered()
+            streamIds = await published
+
+            if app['apps_config'].isLocalDeliveryEnabled(appkey):
+                app['subscription_hub'].deliverLocal(
+                    streams, streamIds, serializedPdu, serializedMessage
+                )
+    except Exception as e:
+        # The message was not published, it can be retried
+        if deduplicator is not None:
+            await deduplicator.release(streams, dedupKey)
+
+        errMsg = f'publish: cannot connect to redis {e}'
+        logging.warning(errMsg)
+        response = {
+            "action": "rtm/publish/error",
+            "id": pdu.get('id', 1),
+            "body": {"error": errMsg},
+        }
+        await state.respond(ws, response)
+        return
+
+    for chan in publishedChannels:
         app['stats'].updateChannelPublished(chan, len(serializedPdu))
 
-    response = {
-        "action": "rtm/publish/ok",
-        "id": pdu.get('id', 1),
-        "body": {'channels': channels},
-    }
-    await state.respond(ws, response)
+    ack = pdu.get('body', {}).get('ack')
+    if ack is None:
+        ack = state.publishAck
+
+    if ack:
+        response = {
+            "action": "rtm/publish/ok",
+            "id": pdu.get('id', 1),
+            "body": {'channels': channels},
+        }
+        if duplicateChannels:
+            response['body']['duplicate_channels'] = duplicateChannels
+
+        await state.respond(ws, response)
 
     # Stats
     app['stats'].updatePublished(state.role, len(serializedPdu))
 
 
+async def handleBatchPublish(state: ConnectionState, ws, app: Dict, pdu: JsonDict):
+    '''Publish the messages of a body to its channels, as if they were
+    published one by one, with a single redis round-trip. An optional
+    message_ids list identifies the messages for publish dedup.
+    '''
+    body = pdu['body']
+    messages = body['messages']
+    messageIds = body.get('message_ids')
+
+    errMsg = None
+    if not isinstance(messages, list) or len(messages) == 0:
+        errMsg = 'publish: messages should be a non empty list'
+    elif any(message is None for message in messages):
+        errMsg = 'publish: empty message'
+    elif body.get('channel') is None and body.get('channels') is None:
+        errMsg = 'publish: no channel or channels field'
+    elif messageIds is not None and (
+        not isinstance(messageIds, list) or len(messageIds) != len(messages)
+    ):
+        errMsg = 'publish: message_ids should be a list as long as messages'
+
+    if errMsg is not None:
+        logging.warning(errMsg)
+        response = {
+            "action": "rtm/publish/error",
+            "id": pdu.get('id', 1),
+            "body": {"error": errMsg},
+        }
+        await state.respond(ws, response)
+        return
+
+    appkey = state.appkey
+    rules = app['apps_config'].getChannelBuilderRules(appkey)
+    deduplicator = app['publish_deduplicators'].get(appkey)
+
+    # Each message is stored with its own publish pdu
+    itemBody = {
+        key: val for key, val in body.items() if key not in ('messages', 'message_ids')
+    }
+
+    items = []
+    for i, message in enumerate(messages):
+        item = {
+            'action': pdu['action'],
+            'id': pdu.get('id', 1),
+            'body': dict(itemBody, message=message),
+        }
+        if isinstance(item['body'].get('channels'), list):
+            item['body']['channels'] = list(item['body']['channels'])
+        if messageIds is not None:
+            item['body']['message_id'] = messageIds[i]
+
+        item = updateMsg(rules, item)
+
+        channels = item['body'].get('channels')
+        if channels is None:
+            channels = [item['body']['channel']]
+
+        channels = [chan for chan in channels if chan is not None]
+        streams = ['{}::{}'.format(appkey, chan) for chan in channels]
+        items.append((item, channels, streams, dumps(message)))
+
+    # The dedup keys of all the messages are claimed in one round-trip
+    claims = []
+    if deduplicator is not None:
+        claims = [
+            (streams, getDedupKey(item['body'], serializedMessage))
+            for item, _, streams, serializedMessage in items
+        ]
+        claimed = await deduplicator.claimMany(claims)
+
+    jobs = []
+    publishedChannels = []
+    duplicates = []
+    for i, (item, channels, streams, serializedMessage) in enumerate(items):
+        if deduplicator is not None:
+            fresh = claimed[i]
+
+            duplicateChannels = [
+                chan for chan, isNew in zip(channels, fresh) if not isNew
+            ]
+            if duplicateChannels:
+                duplicates.append({'index': i, 'channels': duplicateChannels})
+                app['stats'].updatePublishDuplicates(state.role, len(duplicateChannels))
+
+            channels = list(itertools.compress(channels, fresh))
+            streams = list(itertools.compress(streams, fresh))
+
+            # Only the fresh keys are released when the publish fails
+            claims[i] = (streams, claims[i][1])
+
+        if streams:
+            jobs.append((streams, dumps(item), serializedMessage))
+            publishedChannels.append(channels)
+
+    # Apps with batch publish enabled share a pipeline across connections
+    batchPublish = app['apps_config'].isBatchPublishEnabled(appkey)
+    publisher = app['pipelined_publishers'].get(appkey)
+
+    try:
+        if jobs:
+            published = publisher.submitMany(jobs, batchPublish)
+
+            # The next publishes of the connection can be queued behind ours
+            markOrdered()
+            results = await published
+
+            if app['apps_config'].isLocalDeliveryEnabled(appkey):
+                hub = app['subscription_hub']
+                for (streams, data, serializedMessage), streamIds in zip(jobs, results):
+                    hub.deliverLocal(streams, streamIds, data, serializedMessage)
+    except Exception as e:
+        # The messages were not published, they can be retried
+        if deduplicator is not None:
+            await deduplicator.releaseMany(claims)
+
+        errMsg = f'publish: cannot connect to redis {e}'
+        logging.warning(errMsg)
+        response = {
+            "action": "rtm/publish/error",
+            "id": pdu.get('id', 1),
+            "body": {"error": errMsg},
+        }
+        await state.respond(ws, response)
+        return
+
+    for job, channels in zip(jobs, publishedChannels):
+        size = len(job[1])
+        for chan in channels:
+            app['stats'].updateChannelPublished(chan, size)
+
+        app['stats'].updatePublished(state.role, size)
+
+    ack = body.get('ack')
+    if ack is None:
+        ack = state.publishAck
+
+    if ack:
+        channels = body.get('channels')
+        if channels is None:
+            channels = [body['channel']]
+
+        response = {
+            "action": "rtm/publish/ok",
+            "id": pdu.get('id', 1),
+            "body": {'channels': channels, 'count': len(messages)},
+        }
+        if duplicates:
+            response['body']['duplicates'] = duplicates
+
+        await state.respond(ws, response)
+
+
+class MessageHandlerClass(RedisSubscriberMessageHandlerClass):
+    def __init__(self, args):
+        self.cnt = 0
+        self.cntPerSec = 0
+        self.throttle = Throttle(seconds=1)
+        self.ws = args['ws']
+        self.subscriptionId = args['subscription_id']
+        self.hasFilter = args['has_filter']
+        self.streamSQLFilter = args['stream_sql_filter']
+        self.appkey = args['appkey']
+        self.serverStats = args['stats']
+        self.state = args['state']
+        self.subscribeResponse = args['subscribe_response']
+        self.app = args['app']
+        self.channel = args['channel']
+        self.idIterator = itertools.count()
+
+        # Subscription data pdus are assembled from encoded messages, which
+        # are shared by every subscriber of a channel using the same codec
+        self.codec = self.state.codec
+        self.encodedSubscriptionId = self.codec.encodeValue(self.subscriptionId)
+
+        # Bounded queue of serialized messages, waiting to be sent
+        appsConfig = self.app['apps_config']
+        queueMaxSize = appsConfig.getSubscriptionQueueMaxSize(self.appkey)
+        self.batcher = SubscriptionBatcher(
+            self.sendMessages,
+            args['batch_size'],
+            args['batch_max_bytes'],
+            args['batch_max_linger'],
+            args['batch_adaptive'],
+            queueMaxSize,
+            appsConfig.getSlowConsumerPolicy(self.appkey),
+            self.onSendError,
+        )
+
+        # Latest message per key only, held back for the conflate interval
+        self.conflater = None
+        if args['conflate_key'] is not None:
+            self.conflater = Conflater(
+                args['conflate_key'],
+                args['conflate_interval'],
+                queueMaxSize,
+                self.enqueue,
+            )
+
+    def log(self, msg):
+        self.state.log(msg)
+
+    async def on_init(self, initInfo):
+        response = self.subscribeResponse
+        response['body'].update(initInfo)
+
+        if not initInfo.get('success', False):
+            msgId = response['id']
+            response = {
+                'action': 'rtm/subscribe/error',
+                'id': msgId,
+                'body': {'error': 'subscribe error: server cannot connect to redis'},
+            }
+
+        # Send response.
+        await self.state.respond(self.ws, response)
+
+    async def handleMsg(self, msg: dict, position: str, payloadSize: int) -> bool:
+        entry = StreamEntry(msg, position, payloadSize)
+        return await self.handleEntries(StreamBatch([entry]))
+
+    async def handleEntries(self, batch: StreamBatch) -> bool:
+        for entry in batch.entries:
+            self.serverStats.updateSubscribed(self.state.role, entry.payloadSize)
+            self.serverStats.updateChannelSubscribed(self.channel, entry.payloadSize)
+
+        if self.hasFilter:
+            # Evaluated once per batch, for all the subscribers with this filter
+            matches = batch.match(self.streamSQLFilter, self.codec)
+            for entry, msg, message in matches:
+                if not self.deliver(entry, msg, message):
+                    return False
+        else:
+            for entry in batch.entries:
+                # Shared between all the subscribers of the entry. The publish
+                # pdu is only decoded when the conflation key is needed.
+                message = entry.encodedMessage(self.codec)
+                msg = entry.message() if self.conflater is not None else None
+                if not self.deliver(entry, msg, message):
+                    return False
+
+        return True
+
+    def deliver(self, entry: StreamEntry, msg, message) -> bool:
+        assert entry.position is not None
+
+        encodedPosition = entry.encodedPosition(self.codec)
+        if self.conflater is not None:
+            self.conflater.add(msg, message, encodedPosition)
+            return True
+
+        return self.enqueue(message, encodedPosition)
+
+    def enqueue(self, message, encodedPosition) -> bool:
+        # Never wait for the client here, this would hold back the reader
+        try:
+            dropped = self.batcher.add(message, encodedPosition)
+        except SlowConsumerError as e:
+            self.state.log(f'disconnecting slow consumer: {e}')
+            self.serverStats.incrSlowConsumerDisconnections(self.state.role)
+            self.close()
+
+            task = asyncio.ensure_future(self.ws.close(1008, 'slow consumer'))
+            addTaskCleanup(task)
+            return False
+
+        if dropped != 0:
+            self.serverStats.updateSubscriptionDropped(
+                self.state.role, self.channel, dropped
+            )
+
+        self.serverStats.updateSubscriptionQueueSize(
+            self.state.role, self.batcher.queueSize()
+        )
+        return True
+
+    def onSendError(self, error):
+        '''The batcher is closed, the client would not get any more messages'''
+        self.close()
+
+        task = asyncio.ensure_future(self.ws.close(1011, 'cannot send messages'))
+        addTaskCleanup(task)
+
+    async def sendMessages(self, messages, encodedPosition) -> bool:
+        serializedPdu = self.codec.encodeSubscriptionData(
+            next(self.idIterator),
+            self.encodedSubscriptionId,
+            messages,
+            encodedPosition,
+        )
+        self.state.log(f"> {serializedPdu} at position {encodedPosition}")
+
+        await self.ws.send(serializedPdu)
+
+        self.cnt += len(messages)
+        self.cntPerSec += len(messages)
+
+        if not self.throttle.exceedRate():
+            self.state.log(f"#messages {self.cnt} msg/s {self.cntPerSec}")
+            self.cntPerSec = 0
+
+        # Data which did not make it to the socket yet, the client is behind
+        transport = self.ws.transport
+        return transport is not None and transport.get_write_buffer_size() > 0
+
+    def close(self):
+        if self.conflater is not None:
+            self.conflater.close()
+
+        self.batcher.close()
+
+
+def closeMessageHandler(task):
+    '''redisSubscriber returns its message handler, even when cancelled'''
+    if not task.cancelled() and task.exception() is None:
+        task.result().close()
+
+
 async def handleSubscribe(
-    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: str
+    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: SerializedPdu
 ):
     '''
     Client doesn't really needs it.
@@ -150,7 +524,7 @@ async def handleSubscribe(
     hasFilter = filterStr not in ('', None)
 
     try:
-        streamSQLFilter = StreamSqlFilter(filterStr) if hasFilter else None
+        streamSQLFilter = getStreamSqlFilter(filterStr) if hasFilter else None
     except InvalidStreamSQLError:
         errMsg = f'Invalid SQL expression {filterStr}'
         logging.warning(errMsg)
@@ -183,6 +557,8 @@ async def handleSubscribe(
     batchSize = body.get('batch_size', 1)
     try:
         batchSize = int(batchSize)
+        if batchSize < 1:
+            raise ValueError(batchSize)
     except ValueError:
         errMsg = f'Invalid batch size: {batchSize}'
         logging.warning(errMsg)
@@ -196,6 +572,66 @@ async def handleSubscribe(
         await state.respond(ws, response)
         return
 
+    batchAdaptive = body.get('batch_adaptive', False)
+    if not isinstance(batchAdaptive, bool):
+        errMsg = f'Invalid batch adaptive flag: {batchAdaptive}'
+        logging.warning(errMsg)
+        response = {
+            "action": "rtm/subscribe/error",
+            "id": pdu.get('id', 1),
+            "body": {"error": errMsg},
+        }
+        state.ok = False
+        state.error = response
+        await state.respond(ws, response)
+        return
+
+    # In adaptive mode batch_size is the upper bound
+    if batchAdaptive and 'batch_size' not in body:
+        batchSize = DEFAULT_ADAPTIVE_MAX_BATCH_SIZE
+
+    batchMaxBytes = body.get('batch_max_bytes')
+    batchMaxLinger = body.get('batch_max_linger_ms')
+    try:
+        if batchMaxBytes is not None:
+            batchMaxBytes = int(batchMaxBytes)
+        if batchMaxLinger is not None:
+            batchMaxLinger = float(batchMaxLinger) / 1000
+    except ValueError:
+        errMsg = f'Invalid batch bounds: {batchMaxBytes} bytes {batchMaxLinger} ms'
+        logging.warning(errMsg)
+        response = {
+            "action": "rtm/subscribe/error",
+            "id": pdu.get('id', 1),
+            "body": {"error": errMsg},
+        }
+        state.ok = False
+        state.error = response
+        await state.respond(ws, response)
+        return
+
+    conflateKey = body.get('conflate_key')
+    conflateInterval = body.get('conflate_interval_ms')
+    try:
+        if conflateKey is not None:
+            conflateKey = ConflateKey(conflateKey)
+        if conflateInterval is None:
+            conflateInterval = DEFAULT_CONFLATE_INTERVAL
+        else:
+            conflateInterval = float(conflateInterval) / 1000
+    except (InvalidConflateKeyError, ValueError) as e:
+        errMsg = f'Invalid conflate options: {e}'
+        logging.warning(errMsg)
+        response = {
+            "action": "rtm/subscribe/error",
+            "id": pdu.get('id', 1),
+            "body": {"error": errMsg},
+        }
+        state.ok = False
+        state.error = response
+        await state.respond(ws, response)
+        return
+
     response = {
         "action": "rtm/subscribe/ok",
         "id": pdu.get('id', 1),
@@ -207,124 +643,46 @@ async def handleSubscribe(
         },
     }
 
-    class MessageHandlerClass(RedisSubscriberMessageHandlerClass):
-        def __init__(self, args):
-            self.cnt = 0
-            self.cntPerSec = 0
-            self.throttle = Throttle(seconds=1)
-            self.ws = args['ws']
-            self.subscriptionId = args['subscription_id']
-            self.hasFilter = args['has_filter']
-            self.streamSQLFilter = args['stream_sql_filter']
-            self.appkey = args['appkey']
-            self.serverStats = args['stats']
-            self.state = args['state']
-            self.subscribeResponse = args['subscribe_response']
-            self.app = args['app']
-            self.channel = args['channel']
-            self.batchSize = args['batch_size']
-            self.idIterator = itertools.count()
-
-            self.messages = []
-
-        def log(self, msg):
-            self.state.log(msg)
-
-        async def on_init(self, initInfo):
-            response = self.subscribeResponse
-            response['body'].update(initInfo)
-
-            if not initInfo.get('success', False):
-                msgId = response['id']
-                response = {
-                    'action': 'rtm/subscribe/error',
-                    'id': msgId,
-                    'body': {
-                        'error': 'subscribe error: server cannot connect to redis'
-                    },
-                }
-
-            # Send response.
-            await self.state.respond(self.ws, response)
-
-        async def handleMsg(self, msg: dict, position: str, payloadSize: int) -> bool:
-
-            # Input msg is the full serialized publish pdu.
-            # Extract the real message out of it.
-            msg = msg.get('body', {}).get('message')
-
-            self.serverStats.updateSubscribed(self.state.role, payloadSize)
-            self.serverStats.updateChannelSubscribed(self.channel, payloadSize)
-
-            if self.hasFilter:
-                filterOutput = self.streamSQLFilter.match(
-                    msg.get('messages') or msg
-                )  # noqa
-                if not filterOutput:
-                    return True
-                else:
-                    msg = filterOutput
-
-            self.messages.append(msg)
-            if len(self.messages) < self.batchSize:
-                return True
-
-            assert position is not None
-
-            pdu = {
-                "action": "rtm/subscription/data",
-                "id": next(self.idIterator),
-                "body": {
-                    "subscription_id": self.subscriptionId,
-                    "messages": self.messages,
-                    "position": position,
-                },
-            }
-            serializedPdu = json.dumps(pdu)
-            self.state.log(f"> {serializedPdu} at position {position}")
-
-            await self.ws.send(serializedPdu)
-
-            self.cnt += len(self.messages)
-            self.cntPerSec += len(self.messages)
-
-            self.messages = []
-
-            if self.throttle.exceedRate():
-                return True
-
-            self.state.log(f"#messages {self.cnt} msg/s {self.cntPerSec}")
-            self.cntPerSec = 0
-
-            return True
-
     appChannel = '{}::{}'.format(state.appkey, channel)
 
-    # We need to create a new connection as reading from it will be blocking
-    redisClient = app['redis_clients'].makeRedisClient()
-
-    task = asyncio.ensure_future(
-        redisSubscriber(
-            redisClient.redis,
-            appChannel,
-            position,
-            MessageHandlerClass,
-            {
-                'ws': ws,
-                'subscription_id': subscriptionId,
-                'has_filter': hasFilter,
-                'stream_sql_filter': streamSQLFilter,
-                'appkey': state.appkey,
-                'stats': app['stats'],
-                'state': state,
-                'subscribe_response': response,
-                'app': app,
-                'channel': channel,
-                'batch_size': batchSize,
-            },
+    messageHandlerArgs = {
+        'ws': ws,
+        'subscription_id': subscriptionId,
+        'has_filter': hasFilter,
+        'stream_sql_filter': streamSQLFilter,
+        'appkey': state.appkey,
+        'stats': app['stats'],
+        'state': state,
+        'subscribe_response': response,
+        'app': app,
+        'channel': channel,
+        'batch_size': batchSize,
+        'batch_max_bytes': batchMaxBytes,
+        'batch_max_linger': batchMaxLinger,
+        'batch_adaptive': batchAdaptive,
+        'conflate_key': conflateKey,
+        'conflate_interval': conflateInterval,
+    }
+
+    if position in (None, '$'):
+        # Live subscriptions share one redis reader per channel on this node
+        hub = app['subscription_hub']
+        task = await hub.subscribe(appChannel, MessageHandlerClass(messageHandlerArgs))
+    else:
+        # We need to create a new connection as reading from it will be blocking
+        redisClient = app['redis_clients'].makeReadRedisClient()
+
+        task = asyncio.ensure_future(
+            redisSubscriber(
+                redisClient.redis,
+                appChannel,
+                position,
+                MessageHandlerClass,
+                messageHandlerArgs,
+            )
         )
-    )
-    addTaskCleanup(task)
+        addTaskCleanup(task)
+        task.add_done_callback(closeMessageHandler)
 
     key = subscriptionId + state.connection_id
     state.subscriptions[key] = (task, state.role)
@@ -333,7 +691,7 @@ async def handleSubscribe(
 
 
 async def handleUnSubscribe(
-    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: str
+    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: SerializedPdu
 ):
     '''
     Cancel a subscription
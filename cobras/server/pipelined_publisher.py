@@ -1,6 +1,11 @@
 '''Publish jobs gets enqueued into a multi-publisher, which publish them
 to redis in a batch fashion, using a pipeline.
 
+Jobs coming from all the connections of an app are queued, and flushed when
+the batch is full or when the oldest job has been waiting for the max linger
+time. Each publisher waits for its own job to be written, so errors are still
+reported to the right client.
+
 Copyright (c) 2018-2019 Machine Zone, Inc. All rights reserved.
 
 https://redis.io/topics/pipelining
@@ -10,51 +15,128 @@ Weird leaks https://bugs.python.org/issue31620
 import asyncio
 from typing import Optional
 
+DEFAULT_BATCH_PUBLISH_SIZE = 100
+DEFAULT_BATCH_PUBLISH_MAX_LINGER = 0.005  # seconds
+
 
 class PipelinedPublisher:
-    def __init__(self, redis, batchSize=None, channelMaxLength=None):
+    def __init__(self, redis, batchSize=None, channelMaxLength=None, maxLinger=None):
         self.redis = redis
-        self.queue = asyncio.Queue()
-        self.batchSize = batchSize or 100
+        self.queue = []
+        self.batchSize = batchSize or DEFAULT_BATCH_PUBLISH_SIZE
+        if self.batchSize < 0:
+            self.batchSize = DEFAULT_BATCH_PUBLISH_SIZE
         self.xaddMaxLength = channelMaxLength or 1000
+        if maxLinger is None:
+            maxLinger = DEFAULT_BATCH_PUBLISH_MAX_LINGER
+        self.maxLinger = maxLinger
         self.lock = asyncio.Lock()
+        self.timer = None
+        self.tasks = set()
 
     async def publishAll(self):
-        async with await self.redis.pipeline() as pipe:
-            async with self.lock:
-                while True:
-                    try:
-                        job = self.queue.get_nowait()
-                    except asyncio.QueueEmpty:
-                        break
-                    else:
-                        await self.publish(pipe, job)
-                        self.queue.task_done()
-
-            await pipe.execute()
+        '''Write all the queued jobs in one pipeline'''
+        self.cancelTimer()
+
+        async with self.lock:
+            jobs, self.queue = self.queue, []
+            if len(jobs) == 0:
+                return
+
+            try:
+                pipe = self.makePipe([job for job, _ in jobs])
+                streamIds = await self.redis.xaddEntries(pipe, self.xaddMaxLength)
+            except Exception as e:
+                # The jobs left the queue, their publishers must not hang
+                for job, future in jobs:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+
+            start = 0
+            for job, future in jobs:
+                end = start + len(job[0])
+                if not future.done():
+                    future.set_result(streamIds[start:end])
+                start = end
 
     def enqueue(self, job):
-        self.queue.put_nowait(job)
+        future = asyncio.get_event_loop().create_future()
+        self.queue.append((job, future))
+
+        if len(self.queue) >= self.batchSize:
+            self.flush()
+        elif self.timer is None:
+            loop = asyncio.get_event_loop()
+            self.timer = loop.call_later(self.maxLinger, self.flush)
+
+        return future
+
+    def flush(self):
+        task = asyncio.ensure_future(self.publishAll())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def cancelTimer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def makePipe(self, jobs):
+        '''The XADD entries of jobs, written together by xaddEntries'''
+        pipe = []
+        for streams, data, serializedMessage in jobs:
+            pipe.extend(self.redis.makeEntries(streams, data, serializedMessage))
 
-    async def publish(self, pipe, job, maxLen: Optional[int] = None):
+        return pipe
+
+    async def publishNow(self, job, maxLen: Optional[int] = None):
+        '''The XADDs are sent right away'''
         if maxLen is None:
             maxLen = self.xaddMaxLength
 
-        appkey, channel, data = job
-        appChannel = '{}::{}'.format(appkey, channel)
-        await self.redis.xadd(
-            appChannel, {'json': data}, max_len=self.xaddMaxLength, approximate=True
-        )
+        return await self.redis.xaddEntries(self.makePipe([job]), maxLen)
 
-    async def publishNow(self, job, maxLen: Optional[int] = None):
-        await self.publish(None, job, maxLen)
+    def submit(self, job, batchPublish=False):
+        '''Queue a job, and return a future of its stream ids. Jobs submitted
+        one after the other are written in the same order.
+
+        A job is a (streams, serialized pdu, serialized message) tuple.
+        '''
+        if not batchPublish:
+            # Tasks first run in the order they were created, and publishNow
+            # queues its XADDs with AutoPipeline.submit before suspending: they
+            # are queued, hence written, in submit order
+            return asyncio.ensure_future(self.publishNow(job))
 
-    async def push(self, job, batchPublish=False):
+        return self.enqueue(job)
+
+    def submitMany(self, jobs, batchPublish=False):
+        '''Queue many jobs at once, and return a future of their stream ids.
+        Without batch publish, all the jobs are written in one pipeline.
+        '''
         if not batchPublish:
-            await self.publishNow(job)
-            return
+            return asyncio.ensure_future(self.publishJobs(jobs))
+
+        return asyncio.gather(*[self.enqueue(job) for job in jobs])
+
+    async def publishJobs(self, jobs):
+        pipe = self.makePipe(jobs)
+        streamIds = await self.redis.xaddEntries(pipe, self.xaddMaxLength)
+
+        results = []
+        start = 0
+        for job in jobs:
+            end = start + len(job[0])
+            results.append(streamIds[start:end])
+            start = end
+
+        return results
 
-        self.enqueue(job)
+    async def close(self):
+        '''Flush the pending jobs'''
+        self.cancelTimer()
+        await self.publishAll()
 
-        if self.queue.qsize() >= self.batchSize:
-            await self.publishAll()
+        if self.tasks:
+            await asyncio.wait(self.tasks)
@@ -3,26 +3,25 @@
 Copyright (c) 2018-2019 Machine Zone, Inc. All rights reserved.
 '''
 
-import asyncio
-
 from cobras.server.pipelined_publisher import PipelinedPublisher
-from cobras.server.redis_connections import RedisConnections
+from cobras.server.redis_clients import RedisClients
 
 
 class PipelinedPublishers:
     def __init__(
         self,
-        redisConnections: RedisConnections,
+        redisClients: RedisClients,
         batchPublishSize: int,
         channelMaxLength: int,
+        batchPublishMaxLinger: float,
     ) -> None:
-        self.redisConnections = redisConnections
+        self.redisClients = redisClients
         self.pipelinedPublishers: dict = {}
         self.batchPublishSize: int = batchPublishSize
         self.channelMaxLength: int = channelMaxLength
-        self.lock = asyncio.Lock()
+        self.batchPublishMaxLinger: float = batchPublishMaxLinger
 
-    def getAppChannelAndKey(self, appkey, channel):
+    def get(self, appkey):
         '''
         Constraints:
         * (A) For a given app, subscriptions and publish should go to the
@@ -30,35 +29,27 @@ class PipelinedPublishers:
         * (B) Each app should get its own redis connection,
           so that one 'busy' app does not block another one.
 
-        Those constraints are reflected in the way we compute the hashing key
+        Both are provided by the per app redis clients, so there is one
+        publisher per app, shared by all its connections.
         '''
-        # Constraint A
-        appChannel = '{}::{}'.format(appkey, channel)
-
-        # Constraint B
-        key = '{}::{}'.format(appkey, self.redisConnections.hashChannel(appChannel))
-
-        return appChannel, key
-
-    async def get(self, appkey, channel):
-        appChannel, key = self.getAppChannelAndKey(appkey, channel)
-
-        async with self.lock:
-            pipelinedPublisher = self.pipelinedPublishers.get(key)
-            if pipelinedPublisher is not None:
-                return pipelinedPublisher
-
-            db = await self.redisConnections.create(appChannel)
-            pipelinedPublisher = PipelinedPublisher(
-                db, self.batchPublishSize, self.channelMaxLength
-            )
-            self.pipelinedPublishers[key] = pipelinedPublisher
+        pipelinedPublisher = self.pipelinedPublishers.get(appkey)
+        if pipelinedPublisher is not None:
             return pipelinedPublisher
 
-    async def erasePublisher(self, appkey, channel):
-        appChannel, key = self.getAppChannelAndKey(appkey, channel)
-
-        async with self.lock:
-            pipelinedPublisher = self.pipelinedPublishers.get(key)
-            if pipelinedPublisher is not None:
-                del self.pipelinedPublishers[key]
+        pipelinedPublisher = PipelinedPublisher(
+            self.redisClients.getRedisClient(appkey),
+            self.batchPublishSize,
+            self.channelMaxLength,
+            self.batchPublishMaxLinger,
+        )
+        self.pipelinedPublishers[appkey] = pipelinedPublisher
+        return pipelinedPublisher
+
+    async def erasePublisher(self, appkey):
+        pipelinedPublisher = self.pipelinedPublishers.pop(appkey, None)
+        if pipelinedPublisher is not None:
+            await pipelinedPublisher.close()
+
+    async def close(self):
+        for appkey in list(self.pipelinedPublishers):
+            await self.erasePublisher(appkey)
@@ -4,11 +4,11 @@ Copyright (c) 2018-2019 Machine Zone, Inc. All rights reserved.
 '''
 
 import base64
-import json
 import logging
 from typing import Dict
 
-from cobras.common.cobra_types import JsonDict
+from cobras.common.cobra_types import JsonDict, SerializedPdu
+from cobras.common.fast_json import dumps, loads
 from cobras.server.connection_state import ConnectionState
 from cobras.server.handlers.admin import (
     handleAdminCloseConnection,
@@ -21,6 +21,7 @@ from cobras.server.handlers.pubsub import (
     handleSubscribe,
     handleUnSubscribe,
 )
+from cobras.server.request_pipeline import getOrderingKeys
 
 
 async def badFormat(state: ConnectionState, ws, app: Dict, reason: str):
@@ -58,20 +59,69 @@ ACTION_HANDLERS_LUT = {
 
 
 async def processCobraMessage(
-    state: ConnectionState, ws, app: Dict, serializedPdu: str
+    state: ConnectionState, ws, app: Dict, message: SerializedPdu
 ):
+    '''message is a websocket frame, in the connection encoding'''
+    codec = state.codec
+
+    if codec.binary:
+        try:
+            pdu: JsonDict = codec.decode(message)
+        except ValueError:
+            msgEncoded = base64.b64encode(message).decode()
+            errMsg = f'malformed {codec.subprotocol} pdu for agent "{ws.userAgent}" '
+            errMsg += f'base64: {msgEncoded}'
+            await badFormat(state, ws, app, errMsg)
+            return
+
+        # Published pdus are stored as json, whatever the encoding
+        try:
+            serializedPdu = dumps(pdu)
+        except (TypeError, ValueError) as e:
+            errMsg = f'{codec.subprotocol} pdu cannot be converted to json: {e}'
+            await badFormat(state, ws, app, errMsg)
+            return
+    else:
+        # Binary frames are parsed and stored as is, without decoding them
+        serializedPdu = message
+
+        try:
+            pdu = loads(serializedPdu)
+        except ValueError:
+            if isinstance(message, str):
+                message = message.encode()
+
+            msgEncoded = base64.b64encode(message).decode()
+            errMsg = f'malformed json pdu for agent "{ws.userAgent}" '
+            errMsg += f'base64: {msgEncoded} raw: {serializedPdu}'
+            await badFormat(state, ws, app, errMsg)
+            return
 
-    try:
-        pdu: JsonDict = json.loads(serializedPdu)
-    except json.JSONDecodeError:
-        msgEncoded = base64.b64encode(serializedPdu.encode()).decode()
-        errMsg = f'malformed json pdu for agent "{ws.userAgent}" '
-        errMsg += f'base64: {msgEncoded} raw: {serializedPdu}'
-        await badFormat(state, ws, app, errMsg)
+    state.log(f"< {serializedPdu}")
+
+    # A frame can carry many pdus, handled one after the other
+    if isinstance(pdu, list):
+        for item in pdu:
+            if not isinstance(item, dict):
+                await badFormat(state, ws, app, 'pdus of a batch must be objects')
+                return
+
+            await processPdu(state, ws, app, item, dumps(item))
+
+            if not state.ok:
+                return
         return
 
-    state.log(f"< {serializedPdu}")
+    if not isinstance(pdu, dict):
+        await badFormat(state, ws, app, 'pdus must be objects')
+        return
+
+    await processPdu(state, ws, app, pdu, serializedPdu)
 
+
+async def processPdu(
+    state: ConnectionState, ws, app: Dict, pdu: JsonDict, serializedPdu: SerializedPdu
+):
     action = pdu.get('action')
     if action is None:
         await badFormat(state, ws, app, f'missing action')
@@ -107,4 +157,9 @@ async def processCobraMessage(
         return
 
     # proceed with handling action
-    await handler(state, ws, app, pdu, serializedPdu)
+    pipeline = state.requestPipeline
+    if pipeline is None:
+        await handler(state, ws, app, pdu, serializedPdu)
+    else:
+        keys = getOrderingKeys(app, state.appkey, action, pdu)
+        await pipeline.submit(keys, action, handler, state, ws, app, pdu, serializedPdu)
@@ -0,0 +1,165 @@
+'''Idempotent publishes: a message published twice to a channel within the
+dedup window is only added once to the stream.
+
+Messages are identified by the message_id field of the publish body when the
+client provides one, or else by the sha1 of the message. Seen ids are kept in
+a bounded in-process cache per channel, or in redis (SET NX with an expiry)
+so that retries landing on another node are caught too.
+
+A claimed id is released when the publish fails, so that it can be retried.
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import collections
+import logging
+import time
+from hashlib import sha1
+
+from cobras.common.apps_config import PUBLISH_DEDUP_REDIS
+
+
+def getDedupKey(body, serializedMessage: str) -> str:
+    messageId = body.get('message_id')
+    if messageId is not None:
+        return f'id:{messageId}'
+
+    return 'sha1:' + sha1(serializedMessage.encode()).hexdigest()
+
+
+class PublishDeduplicator:
+    def __init__(self, window: float, maxKeys: int):
+        '''window is in seconds, maxKeys is per channel'''
+        self.window = window
+        self.maxKeys = maxKeys
+
+        # stream -> key -> expiration time, oldest first
+        self.seen = collections.defaultdict(collections.OrderedDict)
+        self.nextSweep = time.monotonic() + window
+
+    async def claim(self, streams, key):
+        '''Return a list telling for each stream whether the key is new'''
+        return (await self.claimMany([(streams, key)]))[0]
+
+    async def claimMany(self, claims):
+        '''claims is [(streams, key), ...], keys are claimed in order'''
+        now = time.monotonic()
+        if now >= self.nextSweep:
+            self.sweep(now)
+
+        return [self.claimStreams(streams, key, now) for streams, key in claims]
+
+    def claimStreams(self, streams, key, now):
+        fresh = []
+        for stream in streams:
+            seen = self.seen[stream]
+            self.expire(seen, now)
+
+            if key in seen:
+                fresh.append(False)
+                continue
+
+            seen[key] = now + self.window
+            if len(seen) > self.maxKeys:
+                seen.popitem(last=False)
+
+            fresh.append(True)
+
+        return fresh
+
+    async def release(self, streams, key):
+        await self.releaseMany([(streams, key)])
+
+    async def releaseMany(self, claims):
+        for streams, key in claims:
+            for stream in streams:
+                self.seen.get(stream, {}).pop(key, None)
+
+    def expire(self, seen, now):
+        while seen:
+            key, expiration = next(iter(seen.items()))
+            if expiration > now:
+                break
+
+            del seen[key]
+
+    def sweep(self, now):
+        '''Forget the channels which have not been published to lately'''
+        for stream in list(self.seen):
+            seen = self.seen[stream]
+            self.expire(seen, now)
+            if not seen:
+                del self.seen[stream]
+
+        self.nextSweep = now + self.window
+
+
+class RedisPublishDeduplicator:
+    def __init__(self, redis, window: float):
+        self.redis = redis
+        self.windowMs = max(1, int(window * 1000))
+
+    def makeKey(self, stream, key):
+        return f'dedup::{stream}::{key}'
+
+    async def claim(self, streams, key):
+        return (await self.claimMany([(streams, key)]))[0]
+
+    async def claimMany(self, claims):
+        '''The SET NX of all the claims are pipelined'''
+        keys = [
+            self.makeKey(stream, key) for streams, key in claims for stream in streams
+        ]
+        try:
+            results = await self.redis.setManyIfNotExists(keys, self.windowMs)
+        except Exception as e:
+            # Better a duplicate than a lost message
+            logging.warning(f'publish dedup: cannot reach redis {e}')
+            results = [True] * len(keys)
+
+        results = iter(results)
+        return [[next(results) for _ in streams] for streams, _ in claims]
+
+    async def release(self, streams, key):
+        await self.releaseMany([(streams, key)])
+
+    async def releaseMany(self, claims):
+        keys = [
+            self.makeKey(stream, key) for streams, key in claims for stream in streams
+        ]
+        if not keys:
+            return
+
+        try:
+            await self.redis.deleteMany(keys)
+        except Exception as e:
+            logging.warning(f'publish dedup: cannot reach redis {e}')
+
+
+class PublishDeduplicators:
+    '''One deduplicator per app, for the apps which enabled it'''
+
+    def __init__(self, appsConfig, redisClients):
+        self.appsConfig = appsConfig
+        self.redisClients = redisClients
+        self.deduplicators: dict = {}
+
+    def get(self, appkey):
+        '''None when dedup is disabled for the app'''
+        if appkey in self.deduplicators:
+            return self.deduplicators[appkey]
+
+        mode = self.appsConfig.getPublishDedupMode(appkey)
+        window = self.appsConfig.getPublishDedupWindow(appkey)
+
+        if mode is None:
+            deduplicator = None
+        elif mode == PUBLISH_DEDUP_REDIS:
+            redis = self.redisClients.getRedisClient(appkey)
+            deduplicator = RedisPublishDeduplicator(redis, window)
+        else:
+            maxKeys = self.appsConfig.getPublishDedupMaxKeys(appkey)
+            deduplicator = PublishDeduplicator(window, maxKeys)
+
+        self.deduplicators[appkey] = deduplicator
+        return deduplicator
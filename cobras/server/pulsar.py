@@ -9,11 +9,11 @@ TODO:
 
 import asyncio
 import base64
-import json
 import logging
 from typing import Dict
 
 from cobras.common.cobra_types import JsonDict
+from cobras.common.fast_json import JSONDecodeError, loads
 from cobras.server.connection_state import ConnectionState
 
 
@@ -81,20 +81,32 @@ async def handleConsumerMessage(state: ConnectionState, ws, app: Dict, path: str
     topic = tokens[7]
 
     chan = f'{tenant}::{namespace}::{topic}'
+    stream = '{}::{}'.format(state.appkey, chan)
 
-    redis = app['redis_clients'].makeRedisClient()
+    # Batches of entries are queued by the stream multiplexer,
+    # which reads this stream along with many others
+    queue = asyncio.Queue()
+    multiplexer = app['stream_multiplexer']
 
-    lastId = '$'
+    # Stop reading the stream as soon as the consumer goes away
+    closed = asyncio.ensure_future(ws.wait_closed())
 
-    while True:
-        try:
-            stream = '{}::{}'.format(state.appkey, chan)
-            messages = await redis.xread(stream, lastId)
+    try:
+        await multiplexer.addListener(stream, queue.put_nowait)
+
+        while True:
+            nextMessages = asyncio.ensure_future(queue.get())
+            await asyncio.wait(
+                [nextMessages, closed], return_when=asyncio.FIRST_COMPLETED
+            )
+
+            if not nextMessages.done():
+                nextMessages.cancel()
+                return
 
-            messages = messages[stream.encode()]
+            messages = nextMessages.result()
 
             for message in messages:
-                lastId = message[0].decode()
                 streamId = message[0].decode()
                 body = message[1]
 
@@ -113,14 +125,18 @@ async def handleConsumerMessage(state: ConnectionState, ws, app: Dict, path: str
                 # FIXME: stats message received
                 # app['stats'].updateChannelPublished(chan, len(serializedPdu))
 
-        except asyncio.CancelledError:
-            logging.info('Cancelling redis subscription')
-            raise
+    except asyncio.CancelledError:
+        logging.info('Cancelling redis subscription')
+        raise
+
+    except Exception as e:
+        errMsg = f'Exception {e}'
+        await badFormat(state, ws, app, errMsg)
+        return
 
-        except Exception as e:
-            errMsg = f'Exception {e}'
-            await badFormat(state, ws, app, errMsg)
-            return
+    finally:
+        closed.cancel()
+        multiplexer.removeListener(stream, queue.put_nowait)
 
 
 async def processPulsarMessage(state: ConnectionState, ws, app: Dict, path: str):
@@ -134,8 +150,8 @@ async def processPulsarMessage(state: ConnectionState, ws, app: Dict, path: str)
         async for serializedPdu in ws:
             state.msgCount += 1
             try:
-                pdu: JsonDict = json.loads(serializedPdu)
-            except json.JSONDecodeError:
+                pdu: JsonDict = loads(serializedPdu)
+            except JSONDecodeError:
                 msgEncoded = base64.b64encode(serializedPdu.encode()).decode()
                 errMsg = f'malformed json pdu for agent "{ws.userAgent}" '
                 errMsg += f'base64: {msgEncoded} raw: {serializedPdu}'
@@ -3,14 +3,148 @@
 Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
 '''
 
+import asyncio
 from urllib.parse import urlparse
 from hashlib import sha1
 
+import hiredis
 from rcc.client import RedisClient
+from rcc.response import convertResponse
+
+from cobras.server.auto_pipeline import AutoPipeline
+from cobras.server.cluster_slots import SlotMap, parseRedirection
+
+
+def packCommand(*args) -> bytes:
+    '''RESP encoding of a command'''
+    chunks = [b'*%d\r\n' % len(args)]
+
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif isinstance(arg, int):
+            arg = b'%d' % arg
+        elif not isinstance(arg, bytes):
+            arg = str(arg).encode()
+
+        chunks.append(b'$%d\r\n' % len(arg))
+        chunks.append(arg)
+        chunks.append(b'\r\n')
+
+    return b''.join(chunks)
+
+
+# XADD stream MAXLEN ~ maxLen * json data sha1 cksum message serializedMessage
+XADD_TEMPLATE = (
+    b'*12\r\n$4\r\nXADD\r\n$%d\r\n%b\r\n$6\r\nMAXLEN\r\n$1\r\n~\r\n$%d\r\n%b\r\n'
+    b'$1\r\n*\r\n$4\r\njson\r\n$%d\r\n%b\r\n$4\r\nsha1\r\n$%d\r\n%b\r\n'
+    b'$7\r\nmessage\r\n$%d\r\n%b\r\n'
+)
+
+
+def packXadd(stream: bytes, maxLen: bytes, data, cksum, serializedMessage) -> bytes:
+    '''packCommand for the XADDs of publishes, which are hot'''
+    return XADD_TEMPLATE % (
+        len(stream),
+        stream,
+        len(maxLen),
+        maxLen,
+        len(data),
+        data,
+        len(cksum),
+        cksum,
+        len(serializedMessage),
+        serializedMessage,
+    )
+
+
+class RoutedRedisClient(RedisClient):
+    '''rcc client routing commands with a router shared by all the clients,
+    a cluster slot map (instead of learning the cluster layout one MOVED
+    redirection at a time) or a shard ring.
+
+    Commands are pipelined automatically, see AutoPipeline: the commands that
+    coroutines sharing the client issue during a loop iteration are written
+    together, per node.
+
+    Clients of a ReplicaRouter only send reads, to replicas.
+    '''
+
+    def __init__(self, url, password, router):
+        # url -> AutoPipeline
+        self.pipelines = {}
+
+        super().__init__(url, password)
+        self.router = router
+
+    def close(self):
+        for pipeline in self.pipelines.values():
+            pipeline.close()
+
+        super().close()
+
+    def connected(self):
+        return any(pipeline.connected() for pipeline in self.pipelines.values())
+
+    def getPipeline(self, url):
+        pipeline = self.pipelines.get(url)
+        if pipeline is None:
+            pipeline = AutoPipeline(self.pool.get(url), self.router.readOnly)
+            self.pipelines[url] = pipeline
+
+        return pipeline
+
+    async def getConnection(self, key):
+        return self.pool.get(self.router.getUrl(key))
+
+    def submit(self, key, command: bytes):
+        '''Queue a packed command for the node owning key, return the future
+        of its raw reply
+        '''
+        return self.getPipeline(self.router.getUrl(key)).submit(command)
+
+    async def send(self, cmd, *args, key=None):
+        '''Redis errors do not close the connection, which is shared by the
+        other commands in flight
+        '''
+        if key is None:
+            key = self.findKey(cmd, *args)
+
+        return await self.doSend(cmd, key, *args)
+
+    async def doSend(self, cmd, key, *args):
+        command = packCommand(cmd, *args)
+        response = await self.submit(key, command)
+        return await self.followRedirections(response, cmd, command)
+
+    async def followRedirections(self, response, cmd, command: bytes):
+        '''Follow MOVED and ASK redirections, raise other redis errors'''
+        attempts = 10
+
+        while isinstance(response, hiredis.ReplyError):
+            redirection = parseRedirection(response)
+            if redirection is None:
+                raise response
+
+            if attempts == 0:
+                raise ValueError(f'Error sending command, too many redirects: {cmd}')
+            attempts -= 1
+
+            kind, slot, url = redirection
+            pipeline = self.getPipeline(url)
+            if kind == 'ASK':
+                asking = pipeline.submit(packCommand('ASKING'))
+                _, response = await asyncio.gather(asking, pipeline.submit(command))
+            else:
+                self.router.onMoved(slot, url)
+                response = await pipeline.submit(command)
+
+        return convertResponse(response, cmd)
 
 
 class RedisClientRcc(object):
-    def __init__(self, url, password, cluster):
+    def __init__(self, url, password, cluster, router=None):
+        '''router is usually shared, see RedisClients'''
         self.url = url
         self.password = password
         self.cluster = cluster
@@ -22,38 +156,26 @@ class RedisClientRcc(object):
         else:
             port = 6379
 
-        self.redis = RedisClient(self.url, self.password)
+        if router is None:
+            router = SlotMap(url, password, cluster)
+
+        self.router = router
+        self.redis = RoutedRedisClient(self.url, self.password, router)
 
         self.host = host
 
+    def connected(self):
+        return self.redis.connected()
+
+    def close(self):
+        self.redis.close()
+
     async def getClientIdForKey(self, key):
         return await self.redis.send('CLIENT', 'ID', key=key)
 
     async def getHostForKey(self, key):
-        # Check whether redis is running in cluster mode or not
-        try:
-            info = await self.redis.send('INFO')
-        except Exception:
-            return f'{self.redis.host}:{self.redis.port}'
-
-        if info.get('cluster_enabled') == '0':
-            return f'{self.redis.host}:{self.redis.port}'
-
-        # Redis is running in cluster mode.
-        # 1. get the slot for a key
-        slot = await self.redis.send('CLUSTER', 'KEYSLOT', key)
-
-        # 2. find which node is handling a slot
-        slots = await self.redis.send('CLUSTER', 'SLOTS')
-
-        for slotInfo in slots:
-            if slotInfo[0] <= slot <= slotInfo[1]:
-                host = slotInfo[2][0].decode()
-                port = slotInfo[2][1]
-                return f'{host}:{port}'
-
-        # this should not happen, unless the cluster is being reconfigured
-        return 'unknown-host'
+        '''Looked up in the slot map, without any round-trip'''
+        return self.router.getNode(key)
 
     async def ping(self):
         return await self.redis.send('PING')
@@ -72,9 +194,75 @@ class RedisClientRcc(object):
             sha1(data.encode()).hexdigest(),
         )
 
+    async def xaddMessages(self, streams, data, serializedMessage, maxLen):
+        '''Add a publish pdu to many streams. The serialized message is stored
+        on its own next to the pdu, so that subscribers can forward it without
+        decoding the pdu.
+
+        The payload is encoded and hashed once, and the XADDs are pipelined:
+        they are all written to their redis node before reading any reply, so
+        a publish costs one round-trip whatever the number of streams.
+        Returns the stream ids.
+        '''
+        return await self.xaddEntries(
+            self.makeEntries(streams, data, serializedMessage), maxLen
+        )
+
+    @staticmethod
+    def makeEntries(streams, data, serializedMessage):
+        '''The xaddEntries arguments for one publish'''
+        if isinstance(data, str):
+            data = data.encode()
+        cksum = sha1(data).hexdigest().encode()
+        serializedMessage = serializedMessage.encode()
+
+        return [(stream, data, cksum, serializedMessage) for stream in streams]
+
+    async def xaddEntries(self, entries, maxLen):
+        '''Pipeline the XADDs of (stream, data, sha1, message) entries,
+        possibly coming from different publishes. Returns the stream ids.
+        '''
+        maxLen = b'%d' % maxLen
+        commands = [
+            (stream, packXadd(stream.encode(), maxLen, *fields))
+            for stream, *fields in entries
+        ]
+        return await self.sendPipelined('XADD', commands)
+
+    async def sendPipelined(self, cmd, commands):
+        '''Write (key, packed command) pairs to the nodes owning the keys
+        before reading any reply. Returns the replies, in order.
+        '''
+        responses = await asyncio.gather(
+            *[self.redis.submit(key, command) for key, command in commands]
+        )
+
+        replies = []
+        for (_, command), response in zip(commands, responses):
+            if isinstance(response, hiredis.ReplyError):
+                # The cluster is being re-configured
+                response = await self.redis.followRedirections(response, cmd, command)
+
+            replies.append(response)
+
+        return replies
+
     async def xaddRaw(self, stream, maxLen, *args):
         return await self.redis.send('XADD', stream, 'MAXLEN', '~', maxLen, b'*', *args)
 
+    async def setIfNotExists(self, key, ttlMs):
+        '''Return False if the key already exists'''
+        response = await self.redis.send('SET', key, b'1', b'NX', b'PX', ttlMs)
+        return response is not None
+
+    async def setManyIfNotExists(self, keys, ttlMs):
+        '''Pipelined setIfNotExists, one round-trip for all the keys'''
+        commands = [
+            (key, packCommand('SET', key, b'1', b'NX', b'PX', ttlMs)) for key in keys
+        ]
+        responses = await self.sendPipelined('SET', commands)
+        return [response is not None for response in responses]
+
     async def exists(self, key):
         return await self.redis.send('EXISTS', key)
 
@@ -86,5 +274,20 @@ class RedisClientRcc(object):
     async def delete(self, key):
         return await self.redis.send('DEL', key)
 
+    async def deleteMany(self, keys):
+        '''One DEL per key, pipelined, as keys can be on different nodes'''
+        commands = [(key, packCommand('DEL', key)) for key in keys]
+        return await self.sendPipelined('DEL', commands)
+
     async def xrevrange(self, stream, start, end, count):
         return await self.redis.send('XREVRANGE', stream, start, end, b'COUNT', count)
+
+    async def hset(self, key, field, value):
+        return await self.redis.send('HSET', key, field, value)
+
+    async def hgetall(self, key):
+        items = await self.redis.send('HGETALL', key)
+        return dict(zip(items[::2], items[1::2]))
+
+    async def expire(self, key, seconds):
+        return await self.redis.send('EXPIRE', key, seconds)
@@ -3,21 +3,76 @@
 Copyright (c) 2018-2020 Machine Zone, Inc. All rights reserved.
 '''
 
+from cobras.server.cluster_slots import SlotMap
 from cobras.server.rcc_client import RedisClientRcc
+from cobras.server.redis_pool import DEFAULT_REDIS_POOL_SIZE, RedisPool
+from cobras.server.replica_routing import (
+    DEFAULT_REPLICA_MAX_LAG,
+    READ_FROM_MASTER,
+    ReplicaRouter,
+)
+from cobras.server.shard_ring import ShardRing
 
 
 class RedisClients(object):
-    def __init__(self, redisUrls, redisPassword, redisCluster, appsConfig):
+    def __init__(
+        self,
+        redisUrls,
+        redisPassword,
+        redisCluster,
+        appsConfig,
+        poolSize=DEFAULT_REDIS_POOL_SIZE,
+        sharding=False,
+        readFrom=READ_FROM_MASTER,
+        replicaMaxLag=DEFAULT_REPLICA_MAX_LAG,
+    ):
         self.redisUrls = redisUrls
         self.redisPassword = redisPassword
         self.redisCluster = redisCluster
+
+        # Where the keys live, shared by all the clients
+        urls = redisUrls.split(';')
+        if sharding:
+            self.router = ShardRing(urls)
+        else:
+            # In cluster mode the first url is used as a seed
+            self.router = SlotMap(urls[0], redisPassword, redisCluster)
+
+        # Where subscriptions and reads go, see --redis_read_from
+        if readFrom == READ_FROM_MASTER:
+            self.readRouter = self.router
+        else:
+            self.readRouter = ReplicaRouter(
+                self.router, redisPassword, redisCluster, readFrom, replicaMaxLag
+            )
+
         self.clients = {}
 
         for app in appsConfig.apps:
             self.clients[app] = self.makeRedisClient()
 
+        # Shared by all apps, for short non-blocking commands
+        self.pool = RedisPool(self.makeRedisClient, poolSize)
+
+        # For the read-only commands, which can be served by replicas
+        if self.readRouter is self.router:
+            self.readPool = self.pool
+        else:
+            self.readPool = RedisPool(self.makeReadRedisClient, poolSize)
+
     def makeRedisClient(self):
-        return RedisClientRcc(self.redisUrls, self.redisPassword, self.redisCluster)
+        return RedisClientRcc(
+            self.router.url, self.redisPassword, self.redisCluster, self.router
+        )
+
+    def makeReadRedisClient(self):
+        '''Only for read-only commands'''
+        return RedisClientRcc(
+            self.router.url, self.redisPassword, self.redisCluster, self.readRouter
+        )
+
+    def readsFromReplicas(self):
+        return self.readRouter is not self.router
 
     def getRedisClient(self, appkey):
         return self.clients.get(appkey)
@@ -0,0 +1,88 @@
+'''A bounded pool of redis clients, for short non-blocking commands (reads,
+deletes, stream metadata queries).
+
+Clients are kept connected between uses, so that a command does not pay for a
+new TCP connection and AUTH. A client idle for a while is checked with a PING
+before being handed out, and clients which hit an error are dropped.
+
+In cluster mode each client keeps one connection per node it talked to, so
+there are at most maxSize connections to a node.
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import collections
+import contextlib
+import logging
+import time
+
+DEFAULT_REDIS_POOL_SIZE = 8
+HEALTH_CHECK_INTERVAL = 30  # seconds
+WARM_TIMEOUT = 5  # seconds
+
+
+class RedisPool:
+    def __init__(self, makeClient, maxSize: int = DEFAULT_REDIS_POOL_SIZE):
+        self.makeClient = makeClient
+        self.maxSize = maxSize
+        self.semaphore = asyncio.Semaphore(maxSize)
+
+        # (client, last time it was used), most recently used last
+        self.idle = collections.deque()
+
+    async def warm(self):
+        '''Connect all the clients of the pool'''
+        clients = [self.makeClient() for _ in range(self.maxSize - len(self.idle))]
+        results = await asyncio.gather(
+            *[asyncio.wait_for(client.ping(), WARM_TIMEOUT) for client in clients],
+            return_exceptions=True,
+        )
+
+        for client, result in zip(clients, results):
+            if isinstance(result, Exception):
+                logging.warning(f'redis pool: cannot connect to redis {result}')
+                client.close()
+            else:
+                self.idle.append((client, time.monotonic()))
+
+    async def checkout(self):
+        while self.idle:
+            client, lastUsed = self.idle.pop()
+            if not client.connected():
+                continue
+
+            if time.monotonic() - lastUsed < HEALTH_CHECK_INTERVAL:
+                return client
+
+            try:
+                await client.ping()
+                return client
+            except asyncio.CancelledError:
+                client.close()
+                raise
+            except Exception as e:
+                logging.warning(f'redis pool: dropping unhealthy client {e}')
+                client.close()
+
+        return self.makeClient()
+
+    @contextlib.asynccontextmanager
+    async def client(self):
+        '''Borrow a client, waiting when all of them are in use'''
+        async with self.semaphore:
+            client = await self.checkout()
+            try:
+                yield client
+            except BaseException:
+                # A reply might still be pending on the connection
+                client.close()
+                raise
+
+            if client.connected():
+                self.idle.append((client, time.monotonic()))
+
+    def close(self):
+        while self.idle:
+            client, _ = self.idle.pop()
+            client.close()
@@ -0,0 +1,204 @@
+'''Routing of the read traffic (subscriptions, pulsar consumers, reads) to
+redis replicas, see --redis_read_from. Publishes, writes and deletes always go
+to the masters.
+
+Policies:
+* master: read from the masters, the default
+* replica: read from an online replica of the master owning a key, or from
+  the master when it has none
+* replica_max_lag: the same, skipping replicas which are more than max_lag
+  bytes of replication stream behind their master
+
+The replicas of each master are listed with INFO replication, and refreshed
+in the background every REPLICA_REFRESH_INTERVAL seconds. The lag of a
+replica is the master replication offset minus the offset the replica
+acknowledged, which replicas do every second: a replica keeping up with a
+busy master still lags by up to a second of writes. Replicas are
+asynchronous: a read from a replica can miss the latest writes, and a
+subscription started on a replica can start a little behind its master.
+
+In cluster mode replicas only serve reads after READONLY, which the read
+connections send when they connect.
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import logging
+import random
+import time
+
+from rcc.connection import Connection
+
+from cobras.common.task_cleanup import addTaskCleanup
+from cobras.server.cluster_slots import getHashSlot, getNodeName
+
+READ_FROM_MASTER = 'master'
+READ_FROM_REPLICA = 'replica'
+READ_FROM_REPLICA_MAX_LAG = 'replica_max_lag'
+READ_POLICIES = (READ_FROM_MASTER, READ_FROM_REPLICA, READ_FROM_REPLICA_MAX_LAG)
+
+DEFAULT_REPLICA_MAX_LAG = 1024 * 1024  # bytes
+REPLICA_REFRESH_INTERVAL = 5  # seconds
+
+READONLY_COMMAND = b'*1\r\n$8\r\nREADONLY\r\n'
+
+
+def parseInfo(response) -> dict:
+    '''INFO reply -> {field: value}'''
+    if isinstance(response, bytes):
+        response = response.decode()
+
+    info = {}
+    for line in response.splitlines():
+        key, sep, val = line.partition(':')
+        if sep and not key.startswith('#'):
+            info[key] = val
+
+    return info
+
+
+def parseReplicas(info: dict):
+    '''INFO replication fields -> [(url, lag in bytes), ...], for the online
+    replicas. The lag= field is the age of the last ack, not a data lag.
+    slave0:ip=127.0.0.1,port=6380,state=online,offset=4230,lag=0
+    master_repl_offset:4230
+    '''
+    try:
+        masterOffset = int(info.get('master_repl_offset', 0))
+    except ValueError:
+        masterOffset = 0
+
+    replicas = []
+    for key, val in info.items():
+        if not key.startswith('slave') or not key[5:].isdigit():
+            continue
+
+        fields = dict(item.partition('=')[::2] for item in val.split(','))
+        if fields.get('state') != 'online':
+            continue
+
+        try:
+            url = f'redis://{fields["ip"]}:{int(fields["port"])}'
+            lag = max(masterOffset - int(fields['offset']), 0)
+        except (KeyError, ValueError):
+            continue
+
+        replicas.append((url, lag))
+
+    return replicas
+
+
+class ReplicaRouter:
+    '''Wraps the router of the masters (SlotMap or ShardRing) and exposes the
+    same interface, returning replica urls.
+    '''
+
+    def __init__(
+        self,
+        router,
+        password,
+        cluster: bool,
+        policy: str = READ_FROM_REPLICA,
+        maxLag: int = DEFAULT_REPLICA_MAX_LAG,
+    ):
+        if policy not in (READ_FROM_REPLICA, READ_FROM_REPLICA_MAX_LAG):
+            raise ValueError(f'Invalid replica read policy {policy}')
+
+        self.router = router
+        self.url = router.url
+        self.password = password
+        self.policy = policy
+        self.maxLag = maxLag
+
+        # Cluster replicas refuse reads without READONLY
+        self.readOnly = cluster
+
+        # Master url -> replica urls matching the policy
+        self.replicas = {}
+
+        self.refreshedAt = None
+        self.refreshTask = None
+
+    def getReplicaUrl(self, masterUrl: str, hint=None) -> str:
+        '''hint spreads the keys of a master over its replicas, a random
+        replica is picked without one
+        '''
+        self.checkFreshness()
+
+        replicas = self.replicas.get(masterUrl)
+        if not replicas:
+            return masterUrl
+
+        if hint is None:
+            return random.choice(replicas)
+
+        return replicas[hint % len(replicas)]
+
+    def getSlotUrl(self, slot: int) -> str:
+        return self.getReplicaUrl(self.router.getSlotUrl(slot), slot)
+
+    def getUrl(self, key) -> str:
+        masterUrl = self.router.getUrl(key)
+        return self.getReplicaUrl(masterUrl, None if key is None else getHashSlot(key))
+
+    def getNode(self, key) -> str:
+        '''host:port of the server a key is read from'''
+        return getNodeName(self.getUrl(key))
+
+    def onMoved(self, slot: int, url: str):
+        '''Replicas redirect to their master when a slot moved'''
+        self.router.onMoved(slot, url)
+
+    def checkFreshness(self):
+        now = time.monotonic()
+        if (
+            self.refreshedAt is None
+            or now - self.refreshedAt > REPLICA_REFRESH_INTERVAL
+        ):
+            self.scheduleRefresh()
+
+    def scheduleRefresh(self):
+        if self.refreshTask is not None and not self.refreshTask.done():
+            return
+
+        self.refreshedAt = time.monotonic()
+
+        self.refreshTask = asyncio.ensure_future(self.refresh())
+        addTaskCleanup(self.refreshTask)
+
+    async def refresh(self):
+        '''List the replicas of every master'''
+        self.refreshedAt = time.monotonic()
+
+        masterUrls = sorted(self.router.getUrls())
+        replicas = await asyncio.gather(
+            *[self.fetchReplicas(url) for url in masterUrls]
+        )
+        self.update(dict(zip(masterUrls, replicas)))
+
+    async def fetchReplicas(self, masterUrl: str):
+        connection = Connection(masterUrl, self.password)
+        try:
+            await connection.send('INFO', 'REPLICATION')
+            response = await connection.readResponse()
+            return parseReplicas(parseInfo(response))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Read from the master until its replicas can be listed
+            logging.warning(f'replicas: cannot list replicas of {masterUrl}: {e}')
+            return []
+        finally:
+            connection.close()
+
+    def update(self, replicas):
+        '''replicas is {master url: [(url, lag), ...]}'''
+        self.replicas = {
+            masterUrl: [
+                url
+                for url, lag in urls
+                if self.policy == READ_FROM_REPLICA or lag <= self.maxLag
+            ]
+            for masterUrl, urls in replicas.items()
+        }
@@ -0,0 +1,169 @@
+'''Per connection request pipelining.
+
+The requests of a connection are handled concurrently, up to a max number of
+requests in flight, instead of one after the other. Once that many requests
+are in flight the connection is not read anymore until one of them completes.
+
+Publishes, reads, writes and deletes are pipelined, and their order is kept
+per channel:
+* a publish lets the next publish to the same channels start as soon as its
+  XADDs are queued for redis (see markOrdered), so that consecutive publishes
+  share round-trips while being written in order.
+* other requests to a channel wait for the previous requests to that channel
+  to complete.
+
+Other requests (auth, subscribe, admin, ...) wait for all the requests in
+flight to complete, and are handled alone.
+
+Responses carry the id of their request, they can be sent out of order.
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import contextvars
+import logging
+
+PUBLISH_ACTION = 'rtm/publish'
+PIPELINED_ACTIONS = (PUBLISH_ACTION, 'rtm/read', 'rtm/write', 'rtm/delete')
+
+# Ordering key of the requests of apps with channel builder rules, which can
+# publish to extra channels depending on the message content
+ALL_CHANNELS = object()
+
+# Resolved by the request being handled once it is ordered
+currentOrdering = contextvars.ContextVar('currentOrdering', default=None)
+
+
+def markOrdered():
+    '''Called by handlers once their writes are queued, so that the next
+    requests to the same channels can start.
+    '''
+    ordered = currentOrdering.get()
+    if ordered is not None and not ordered.done():
+        ordered.set_result(None)
+
+
+def getOrderingKeys(app, appkey: str, action: str, pdu):
+    '''The channels of a request, or None for requests handled alone'''
+    if action not in PIPELINED_ACTIONS:
+        return None
+
+    body = pdu.get('body')
+    if not isinstance(body, dict):
+        return None
+
+    if app['apps_config'].getChannelBuilderRules(appkey):
+        return (ALL_CHANNELS,)
+
+    channels = body.get('channels')
+    if channels is None:
+        channels = [body.get('channel')]
+
+    if not isinstance(channels, list):
+        return None
+
+    try:
+        return tuple(set(channels))
+    except TypeError:  # unhashable channels, the handlers will reject them
+        return None
+
+
+class PendingRequest:
+    def __init__(self, action, keys):
+        loop = asyncio.get_event_loop()
+        self.action = action
+        self.keys = keys
+        self.ordered = loop.create_future()
+        self.done = loop.create_future()
+
+    def getBarrier(self, action):
+        '''What a request coming next on the same channels waits for'''
+        if action == PUBLISH_ACTION and self.action == PUBLISH_ACTION:
+            return self.ordered
+
+        return self.done
+
+    def complete(self):
+        for future in (self.ordered, self.done):
+            if not future.done():
+                future.set_result(None)
+
+
+class RequestPipeline:
+    def __init__(self, maxInFlight: int):
+        self.semaphore = asyncio.Semaphore(maxInFlight)
+        self.tasks = set()
+
+        # channel -> last pending request
+        self.pending = {}
+        self.error = None
+
+    async def submit(self, keys, action, handler, *args):
+        '''Start handling a request. Wait when too many requests are in flight,
+        or until all of them complete for requests without ordering keys.
+        '''
+        self.raiseError()
+
+        if keys is None:
+            await self.drain()
+            await handler(*args)
+            return
+
+        await self.semaphore.acquire()
+
+        request = PendingRequest(action, keys)
+        previous = []
+        for key in keys:
+            if key in self.pending:
+                previous.append(self.pending[key])
+
+            self.pending[key] = request
+
+        task = asyncio.ensure_future(self.run(request, previous, handler, args))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, request, previous, handler, args):
+        try:
+            barriers = [prev.getBarrier(request.action) for prev in previous]
+            barriers = [barrier for barrier in barriers if not barrier.done()]
+            if barriers:
+                await asyncio.wait(barriers)
+
+            currentOrdering.set(request.ordered)
+            await handler(*args)
+
+            # Complete after the previous requests to the same channels, so
+            # that waiting for the last one is enough
+            pending = [prev.done for prev in previous if not prev.done.done()]
+            if pending:
+                await asyncio.wait(pending)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f'request pipeline: unexpected error {e}')
+            self.error = e
+        finally:
+            request.complete()
+            self.semaphore.release()
+
+            for key in request.keys:
+                if self.pending.get(key) is request:
+                    del self.pending[key]
+
+    def raiseError(self):
+        '''Errors of pipelined requests terminate the connection'''
+        if self.error is not None:
+            raise self.error
+
+    async def drain(self):
+        '''Wait for the requests in flight'''
+        if self.tasks:
+            await asyncio.wait(self.tasks)
+
+        self.raiseError()
+
+    async def close(self):
+        if self.tasks:
+            await asyncio.wait(self.tasks)
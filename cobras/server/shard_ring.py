@@ -0,0 +1,58 @@
+'''Sharding mode: keys are spread over independent redis servers (not a redis
+cluster) with a consistent hash ring, see --redis_sharding.
+
+Every key (appkey::channel streams, stats, dedup keys, ...) is routed with the
+same ring, by all the clients of all the cobra nodes, so that publishers and
+subscribers of a channel meet on the same redis. Adding a server only moves
+the keys it takes over from the others, about 1/N of them.
+
+The ring is built from the redis urls, which should be written the same way
+on all the nodes.
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+from uhashring import HashRing
+
+from cobras.server.cluster_slots import getNodeName
+
+ROUTE_CACHE_SIZE = 64 * 1024
+
+
+class ShardRing:
+    def __init__(self, urls):
+        self.urls = urls
+        self.url = urls[0]
+        self.ring = HashRing(nodes=urls)
+        self.readOnly = False
+
+        # Channels are few and hot, hashing them every time is not needed
+        self.cache = {}
+
+    def getUrl(self, key) -> str:
+        if key is None:
+            return self.url
+
+        url = self.cache.get(key)
+        if url is None:
+            url = self.ring.get_node(key.decode() if isinstance(key, bytes) else key)
+
+            if len(self.cache) >= ROUTE_CACHE_SIZE:
+                self.cache.clear()
+            self.cache[key] = url
+
+        return url
+
+    def getNode(self, key) -> str:
+        '''host:port of the server owning a key'''
+        return getNodeName(self.getUrl(key))
+
+    def getUrls(self):
+        return self.urls
+
+    def onMoved(self, slot: int, url: str):
+        '''Standalone servers do not redirect commands'''
+        pass
+
+    async def refresh(self):
+        pass
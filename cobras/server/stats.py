@@ -7,13 +7,13 @@ Copyright (c) 2018-2019 Machine Zone, Inc. All rights reserved.
 import asyncio
 import collections
 import datetime
-import json
 import os
 import platform
 import time
 import logging
 import sys
 
+from cobras.common.fast_json import dumps
 from cobras.common.memory_usage import getContainerMemoryLimit, getProcessUsedMemory
 
 DEFAULT_STATS_CHANNEL = '/stats'
@@ -32,6 +32,9 @@ class ServerStats:
         self.internalAppKey = appkey
         self.statsChannel = DEFAULT_STATS_CHANNEL
 
+        # Set in multi-process mode, see cobras/server/workers.py
+        self.workerRegistry = None
+
         self.publishedCount = collections.defaultdict(int)
         self.publishedBytes = collections.defaultdict(int)
         self.subscribedCount = collections.defaultdict(int)
@@ -48,6 +51,15 @@ class ServerStats:
         self.subscribedCountByChannel = collections.defaultdict(int)
         self.subscribedBytesByChannel = collections.defaultdict(int)
 
+        # Slow consumers
+        self.subscriptionDroppedCount = collections.defaultdict(int)
+        self.subscriptionDroppedCountByChannel = collections.defaultdict(int)
+        self.subscriptionQueueHighWaterMark = collections.defaultdict(int)
+        self.slowConsumerDisconnections = collections.defaultdict(int)
+
+        # Idempotent publishes
+        self.publishDuplicateCount = collections.defaultdict(int)
+
         self.resetCounterByPeriod()
         self.start = time.time()
 
@@ -85,6 +97,9 @@ class ServerStats:
         self.subscribedCountByChannelByPeriod = collections.defaultdict(int)
         self.subscribedBytesByChannelByPeriod = collections.defaultdict(int)
 
+        self.subscriptionDroppedCountByPeriod = collections.defaultdict(int)
+        self.subscriptionQueueHighWaterMarkByPeriod = collections.defaultdict(int)
+
     def updatePublished(self, role, val):
         self.publishedCount[role] += 1
         self.publishedBytes[role] += val
@@ -113,6 +128,24 @@ class ServerStats:
         self.subscribedCountByChannelByPeriod[channel] += 1
         self.subscribedBytesByChannelByPeriod[channel] += val
 
+    def updateSubscriptionDropped(self, role, channel, val):
+        self.subscriptionDroppedCount[role] += val
+        self.subscriptionDroppedCountByPeriod[role] += val
+        self.subscriptionDroppedCountByChannel[channel] += val
+
+    def updateSubscriptionQueueSize(self, role, val):
+        if val > self.subscriptionQueueHighWaterMark[role]:
+            self.subscriptionQueueHighWaterMark[role] = val
+
+        if val > self.subscriptionQueueHighWaterMarkByPeriod[role]:
+            self.subscriptionQueueHighWaterMarkByPeriod[role] = val
+
+    def incrSlowConsumerDisconnections(self, role):
+        self.slowConsumerDisconnections[role] += 1
+
+    def updatePublishDuplicates(self, role, val):
+        self.publishDuplicateCount[role] += val
+
     def updateReads(self, role, val):
         self.readsCount[role] += 1
         self.readsBytes[role] += val
@@ -169,6 +202,17 @@ class ServerStats:
                 }
             )
 
+            cobraData.update(
+                {
+                    'subscription_dropped_count': self.subscriptionDroppedCount,
+                    'subscription_dropped_count_per_second': self.subscriptionDroppedCountByPeriod,  # noqa
+                    'subscription_queue_high_water_mark': self.subscriptionQueueHighWaterMark,  # noqa
+                    'subscription_queue_high_water_mark_per_second': self.subscriptionQueueHighWaterMarkByPeriod,  # noqa
+                    'slow_consumer_disconnections': self.slowConsumerDisconnections,
+                    'publish_duplicate_count': self.publishDuplicateCount,
+                }
+            )
+
             # Channel data
             channelData = {}
 
@@ -187,6 +231,7 @@ class ServerStats:
                     'subscribed_bytes': self.subscribedBytesByChannel,
                     'subscribed_count_per_second': self.subscribedCountByChannelByPeriod,  # noqa
                     'subscribed_bytes_per_second': self.subscribedBytesByChannelByPeriod,  # noqa
+                    'subscription_dropped_count': self.subscriptionDroppedCountByChannel,  # noqa
                 }
             )
 
@@ -218,16 +263,20 @@ class ServerStats:
                 },
             }
 
-            data = json.dumps({'body': {'message': message}})
-
             chan = self.statsChannel
             appkey = self.internalAppKey
 
             try:
-                stream = '{}::{}'.format(appkey, chan)
-                maxLen = 100
-                streamId = await self.redis.xadd(stream, 'json', data, maxLen)
-                logging.debug(f'stats: xadd result {streamId}')
+                if self.workerRegistry is not None:
+                    message = await self.mergeWorkerStats(message)
+
+                if message is not None:
+                    data = dumps({'body': {'message': message}})
+
+                    stream = '{}::{}'.format(appkey, chan)
+                    maxLen = 100
+                    streamId = await self.redis.xadd(stream, 'json', data, maxLen)
+                    logging.debug(f'stats: xadd result {streamId}')
 
             except Exception as e:
                 # await publishers.erasePublisher(appkey, chan) # FIXME
@@ -243,5 +292,17 @@ class ServerStats:
             if self.stop:
                 return
 
+    async def mergeWorkerStats(self, message):
+        '''The first worker publishes the merged stats of all the workers of
+        the node, the other ones only share their stats with it.
+        '''
+        registry = self.workerRegistry
+        if not registry.isLeader():
+            registry.stats = message['data']
+            return None
+
+        message['data'], message['workers'] = await registry.mergeStats(message['data'])
+        return message
+
     def terminate(self):
         self.stop = True
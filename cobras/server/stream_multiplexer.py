@@ -0,0 +1,488 @@
+'''Read many redis streams with a single blocking command per connection:
+XREAD BLOCK 0 STREAMS k1 k2 ... id1 id2 ...
+
+Streams are grouped per redis node, with one reading connection per group, so
+that the number of redis connections of a cobra node is bounded by the
+number of redis nodes. When streams are added or removed, the pending XREAD
+is interrupted with CLIENT UNBLOCK (issued from a second, control connection)
+and re-armed with the new set.
+
+Multi-key commands must target a single hash slot in cluster mode, and a
+connection can only block on one command. When the streams of a group span
+several slots, one XREAD per slot is pipelined on the group connection: only
+the last one blocks, for at most SLOT_POLL_INTERVAL_MS, and the slot it
+blocks on rotates. The others return right away, entries of their slots are
+delivered at most SLOT_POLL_INTERVAL_MS late. Streams of a slot which moved
+(MOVED) are handed over to the group of their new node.
+
+Groups read from the replicas of their node when the read router is a
+ReplicaRouter, see --redis_read_from.
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import logging
+import traceback
+
+import hiredis
+from rcc.connection import Connection
+
+from cobras.common.task_cleanup import addTaskCleanup
+from cobras.server.cluster_slots import SlotMap, getHashSlot, parseRedirection
+from cobras.server.rcc_client import packCommand
+
+RECONNECT_WAIT_TIME = 1
+UNBLOCK_RETRY_WAIT_TIME = 0.005
+SLOT_POLL_INTERVAL_MS = 50
+
+
+def parseStreamId(streamId: str):
+    ms, _, seq = streamId.partition('-')
+    return int(ms), int(seq or 0)
+
+
+def convertEntries(items):
+    '''[[id, [k1, v1, k2, v2]], ...] -> [(id, {k1: v1, k2: v2}), ...]
+    which is what rcc returns for a single stream XREAD
+    '''
+    entries = []
+    for position, array in items:
+        fields = {}
+        for i in range(len(array) // 2):
+            fields[array[2 * i]] = array[2 * i + 1]
+
+        entries.append((position, fields))
+
+    return entries
+
+
+class StreamGroup:
+    '''Streams of a redis node, which are read on one connection'''
+
+    def __init__(self, multiplexer, key, url: str):
+        self.multiplexer = multiplexer
+        self.key = key
+        self.url = url
+        self.password = multiplexer.password
+
+        self.listeners = {}
+        self.lastIds = {}
+
+        # Slot (None out of cluster mode) -> streams read by the same XREAD
+        self.slots = {}
+
+        self.connection = None
+        self.clientId = None
+        self.connectLock = asyncio.Lock()
+
+        self.control = None
+        self.controlLock = asyncio.Lock()
+
+        self.blocked = False
+        self.dirty = False
+        self.rounds = 0
+        self.task = None
+        self.unblockTask = None
+
+    def __repr__(self):
+        return f'<StreamGroup {self.key} at {self.url}: {len(self.lastIds)} streams>'
+
+    def getSlot(self, stream: str):
+        return getHashSlot(stream) if self.multiplexer.cluster else None
+
+    def addStream(self, stream: str, lastId: str):
+        if stream in self.lastIds:
+            return
+
+        self.lastIds[stream] = lastId
+        self.slots.setdefault(self.getSlot(stream), {})[stream] = None
+
+    def dropStream(self, stream: str):
+        '''Returns the last id of the stream'''
+        lastId = self.lastIds.pop(stream, None)
+        if lastId is None:
+            return None
+
+        slot = self.getSlot(stream)
+        streams = self.slots[slot]
+        del streams[stream]
+        if len(streams) == 0:
+            del self.slots[slot]
+
+        return lastId
+
+    def closeConnections(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+        if self.control is not None:
+            self.control.close()
+            self.control = None
+
+    async def sendControl(self, cmd, *args):
+        '''Non blocking commands, sent to our node'''
+        async with self.controlLock:
+            try:
+                if self.control is None:
+                    self.control = await self.openConnection()
+
+                await self.control.send(cmd, *args)
+                response = await self.control.readResponse()
+            except Exception:
+                if self.control is not None:
+                    self.control.close()
+                    self.control = None
+                raise
+
+        attempts = 3
+        while isinstance(response, hiredis.ReplyError):
+            redirection = parseRedirection(response)
+            if redirection is None or redirection[0] != 'MOVED' or attempts == 0:
+                raise response
+            attempts -= 1
+
+            # The XREAD of the slot will hand its streams over to the new owner
+            _, slot, url = redirection
+            self.multiplexer.router.onMoved(slot, url)
+            response = await self.sendRedirected(url, cmd, *args)
+
+        return response
+
+    async def sendRedirected(self, url: str, cmd, *args):
+        '''A control command for a slot which moved, sent to its new owner'''
+        connection = Connection(url, self.password)
+        try:
+            await connection.send(cmd, *args)
+            return await connection.readResponse()
+        finally:
+            connection.close()
+
+    async def openConnection(self):
+        '''Cluster replicas refuse reads without READONLY'''
+        connection = Connection(self.url, self.password)
+        try:
+            await connection.connect()
+
+            if self.multiplexer.readOnly:
+                await connection.send('READONLY')
+                response = await connection.readResponse()
+                if isinstance(response, hiredis.ReplyError):
+                    raise response
+        except Exception:
+            connection.close()
+            raise
+
+        return connection
+
+    async def connect(self):
+        async with self.connectLock:
+            if self.connection is not None:
+                return
+
+            connection = await self.openConnection()
+
+            await connection.send('CLIENT', 'ID')
+            self.clientId = await connection.readResponse()
+            self.connection = connection
+
+    async def lastStreamId(self, stream: str) -> str:
+        '''Resolve '$' once, so that re-arming the XREAD never skips entries'''
+        response = await self.sendControl('XREVRANGE', stream, '+', '-', 'COUNT', 1)
+        if not response:
+            return '0-0'
+
+        return response[0][0].decode()
+
+    async def addListener(self, stream: str, callback):
+        listeners = self.listeners.get(stream)
+        if listeners is not None:
+            listeners.add(callback)
+            return
+
+        self.listeners[stream] = {callback}
+
+        try:
+            lastId = await self.lastStreamId(stream)
+            await self.connect()
+        except Exception:
+            self.removeListener(stream, callback)
+            raise
+
+        if stream in self.listeners:
+            self.addStream(stream, lastId)
+            self.rearm()
+
+    def removeListener(self, stream: str, callback):
+        listeners = self.listeners.get(stream)
+        if listeners is None:
+            return
+
+        listeners.discard(callback)
+        if len(listeners) != 0:
+            return
+
+        del self.listeners[stream]
+        self.multiplexer.forgetStream(stream, self)
+
+        if self.dropStream(stream) is not None:
+            self.rearm()
+
+        if len(self.listeners) == 0:
+            self.multiplexer.removeGroup(self)
+            self.stop()
+
+    def adopt(self, stream: str, listeners, lastId: str):
+        '''A stream handed over by another group, read from lastId'''
+        self.listeners.setdefault(stream, set()).update(listeners)
+        self.addStream(stream, lastId)
+        self.rearm()
+
+    def handOver(self, slot):
+        '''The slot moved, its streams go to the group of their new node'''
+        for stream in list(self.slots.get(slot, ())):
+            lastId = self.dropStream(stream)
+            listeners = self.listeners.pop(stream)
+            self.multiplexer.moveStream(stream, listeners, lastId)
+
+    def rearm(self):
+        '''Start reading, or interrupt the pending XREAD to issue a new one'''
+        self.dirty = True
+
+        if self.task is None or self.task.done():
+            if len(self.lastIds) != 0:
+                self.task = asyncio.ensure_future(self.run())
+                addTaskCleanup(self.task)
+        elif self.unblockTask is None or self.unblockTask.done():
+            self.unblockTask = asyncio.ensure_future(self.unblock())
+            addTaskCleanup(self.unblockTask)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+        if self.unblockTask is not None:
+            self.unblockTask.cancel()
+
+    async def unblock(self):
+        '''Interrupt the pending XREAD so that it gets re-armed.
+        CLIENT UNBLOCK returns 0 when the server has not processed our
+        XREAD yet, in which case we try again.
+        '''
+        while self.dirty:
+            if self.blocked:
+                try:
+                    unblocked = await self.sendControl(
+                        'CLIENT', 'UNBLOCK', self.clientId
+                    )
+                except Exception as e:
+                    logging.warning(f'{self}: cannot unblock reader: {e}')
+                    return
+
+                if unblocked == 1:
+                    return
+
+            await asyncio.sleep(UNBLOCK_RETRY_WAIT_TIME)
+
+    async def run(self):
+        try:
+            while len(self.lastIds) != 0:
+                try:
+                    await self.connect()
+                    await self.readStreams()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    backtrace = traceback.format_exc()
+                    logging.warning(f'{self}: {e} {backtrace}')
+
+                    self.closeConnections()
+                    await asyncio.sleep(RECONNECT_WAIT_TIME)
+
+                    # The replica we read from might be gone
+                    self.url = self.multiplexer.getGroupUrl(self.key)
+        finally:
+            self.blocked = False
+            self.closeConnections()
+
+    async def readStreams(self):
+        while len(self.lastIds) != 0:
+            self.dirty = False
+
+            # One XREAD per slot, the last one blocks, on another slot at
+            # every round
+            slots = list(self.slots.items())
+            self.rounds += 1
+            shift = self.rounds % len(slots)
+            slots = slots[shift:] + slots[:shift]
+            blockTime = b'0' if len(slots) == 1 else SLOT_POLL_INTERVAL_MS
+
+            commands = []
+            sentIds = []
+            for i, (_, streams) in enumerate(slots):
+                streams = list(streams)
+                ids = [self.lastIds[stream] for stream in streams]
+                sentIds.append(dict(zip(streams, ids)))
+
+                block = (b'BLOCK', blockTime) if i == len(slots) - 1 else ()
+                commands.append(
+                    packCommand('XREAD', *block, b'STREAMS', *streams, *ids)
+                )
+
+            writer = self.connection.writer
+            writer.write(b''.join(commands))
+            await writer.drain()
+
+            received = False
+            moved = []
+            error = None
+
+            for i, (slot, _) in enumerate(slots):
+                if i == len(slots) - 1:
+                    # There might be more entries, do not wait for the poll
+                    # interval
+                    if received:
+                        self.rearm()
+
+                    self.blocked = True
+
+                try:
+                    response = await self.connection.readResponse()
+                finally:
+                    self.blocked = False
+
+                # No entries, or we got unblocked
+                if response is None:
+                    continue
+
+                if isinstance(response, hiredis.ReplyError):
+                    redirection = parseRedirection(response)
+                    if redirection is not None and redirection[0] == 'MOVED':
+                        moved.append((slot, redirection))
+                    elif error is None:
+                        error = response
+                    continue
+
+                for stream, items in response:
+                    stream = stream.decode()
+                    self.dispatch(stream, sentIds[i].get(stream), items)
+                    received = True
+
+            for slot, (_, movedSlot, url) in moved:
+                self.multiplexer.router.onMoved(movedSlot, url)
+                self.handOver(slot)
+
+            if len(self.listeners) == 0:
+                self.multiplexer.removeGroup(self)
+
+            # Slots being migrated (ASK) are retried until they are moved
+            if error is not None:
+                raise error
+
+    def dispatch(self, stream, sentId, items):
+        lastId = self.lastIds.get(stream)
+
+        # The stream was removed while we were waiting
+        if lastId is None or len(items) == 0:
+            return
+
+        # ... or removed and added back, with a more recent last id
+        if lastId != sentId:
+            lastIdKey = parseStreamId(lastId)
+            items = [
+                item for item in items if parseStreamId(item[0].decode()) > lastIdKey
+            ]
+            if len(items) == 0:
+                return
+
+        self.lastIds[stream] = items[-1][0].decode()
+
+        entries = convertEntries(items)
+        for callback in list(self.listeners.get(stream, ())):
+            callback(entries)
+
+
+class StreamMultiplexer:
+    def __init__(
+        self,
+        redisUrls: str,
+        redisPassword,
+        redisCluster: bool,
+        router=None,
+        readRouter=None,
+    ):
+        # In cluster mode the first url is used as a seed, the slot map takes
+        # us to the right node. In sharding mode the router is a ShardRing.
+        # The read router picks the replica of a node we read from.
+        self.url = redisUrls.split(';')[0]
+        self.password = redisPassword
+        self.cluster = redisCluster
+
+        if router is None:
+            router = SlotMap(self.url, redisPassword, redisCluster)
+        self.router = router
+
+        if readRouter is None:
+            readRouter = router
+        self.readRouter = readRouter
+        self.readOnly = readRouter.readOnly
+
+        # Master url -> group
+        self.groups = {}
+
+        # Stream -> group reading it
+        self.streams = {}
+
+    def groupKey(self, stream: str):
+        '''The master url of the node owning the stream'''
+        return self.router.getUrl(stream)
+
+    def getGroupUrl(self, key) -> str:
+        '''The node a group reads from, a replica of its master or itself'''
+        if self.readRouter is self.router:
+            return key
+
+        return self.readRouter.getReplicaUrl(key)
+
+    def getGroup(self, stream: str) -> StreamGroup:
+        group = self.streams.get(stream)
+        if group is not None:
+            return group
+
+        key = self.groupKey(stream)
+        group = self.groups.get(key)
+        if group is None:
+            group = StreamGroup(self, key, self.getGroupUrl(key))
+            self.groups[key] = group
+
+        self.streams[stream] = group
+        return group
+
+    async def addListener(self, stream: str, callback) -> StreamGroup:
+        '''callback is invoked with each batch of (position, fields) entries.
+        It cannot be a coroutine, as it would block every stream of its group.
+        '''
+        group = self.getGroup(stream)
+        await group.addListener(stream, callback)
+        return group
+
+    def removeListener(self, stream: str, callback):
+        group = self.streams.get(stream)
+        if group is not None:
+            group.removeListener(stream, callback)
+
+    def forgetStream(self, stream: str, group):
+        if self.streams.get(stream) is group:
+            del self.streams[stream]
+
+    def moveStream(self, stream: str, listeners, lastId: str):
+        self.streams.pop(stream, None)
+        self.getGroup(stream).adopt(stream, listeners, lastId)
+
+    def removeGroup(self, group):
+        if self.groups.get(group.key) is group:
+            del self.groups[group.key]
+
+    def groupsCount(self):
+        return len(self.groups)
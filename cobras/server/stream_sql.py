@@ -1,13 +1,24 @@
 '''Stream SQL processor, to filter and transform messages when subcribing.
 
+Filters are compiled once into a predicate and a projection closure,
+with pre-split json paths and precompiled LIKE patterns. Compiled filters
+are immutable and shared by all the subscriptions using the same SQL text,
+see getStreamSqlFilter.
+
+matchBatch filters a whole batch of messages at once: the fields referenced
+by the WHERE clause are extracted into columns, and each condition is
+evaluated over a column, only for the rows still in the running.
+
 Copyright (c) 2018-2019 Machine Zone, Inc. All rights reserved.
 '''
 
 import collections
 import fnmatch
+import functools
+import itertools
 import logging
-
-from cobras.common.algorithm import extractAttributeFromDict
+import operator
+import re
 
 StreamSQLExpression = collections.namedtuple(
     'StreamSQLExpression',
@@ -24,10 +35,170 @@ StreamSQLExpression = collections.namedtuple(
 )
 
 
+STREAM_SQL_CACHE_SIZE = 1024
+
+
 class InvalidStreamSQLError(Exception):
     pass
 
 
+def compilePathGetter(components):
+    '''Return a function extracting a (nested) field from a message'''
+    if len(components) == 1:
+        key = components[0]
+
+        def getter(msg):
+            return msg.get(key)
+
+    elif len(components) == 2:
+        first, second = components
+
+        def getter(msg):
+            return msg.get(first, {}).get(second)
+
+    else:
+        parents, last = components[:-1], components[-1]
+
+        def getter(msg):
+            for component in parents:
+                msg = msg.get(component, {})
+            return msg.get(last)
+
+    return getter
+
+
+def compileValueGetter(components):
+    '''Like compilePathGetter, None when a parent field is not a dict'''
+    getter = compilePathGetter(components)
+
+    def get(msg):
+        try:
+            return getter(msg)
+        except AttributeError:
+            return None
+
+    return get
+
+
+def compileColumnExtractor(components):
+    '''Return a function extracting a (nested) field from many messages'''
+    getter = compilePathGetter(components)
+
+    if len(components) == 1:
+        key = components[0]
+
+        def extractAll(rows):
+            return [row.get(key) for row in rows]
+
+    elif len(components) == 2:
+        first, second = components
+
+        def extractAll(rows):
+            return [row.get(first, {}).get(second) for row in rows]
+
+    else:
+
+        def extractAll(rows):
+            return [getter(row) for row in rows]
+
+    def extract(rows):
+        try:
+            return extractAll(rows)
+        except AttributeError:
+            pass
+
+        # One of the parent fields is not a dict
+        values = []
+        for row in rows:
+            try:
+                values.append(getter(row))
+            except AttributeError:
+                values.append(None)
+
+        return values
+
+    return extract
+
+
+def compileComparison(compare, val):
+    '''Values which cannot be compared (missing fields ...) do not match'''
+
+    def test(values):
+        try:
+            return [compare(value, val) for value in values]
+        except TypeError:
+            pass
+
+        mask = []
+        for value in values:
+            try:
+                mask.append(compare(value, val))
+            except TypeError:
+                mask.append(False)
+
+        return mask
+
+    return test
+
+
+def compileScalarComparison(getter, compare, val):
+    '''Values which cannot be compared do not match, see compileComparison'''
+
+    def predicate(msg):
+        try:
+            return compare(getter(msg), val)
+        except TypeError:
+            return False
+
+    return predicate
+
+
+def compileColumnTest(expression):
+    '''Return a function evaluating an expression over a column of values'''
+    val = expression.val
+
+    if expression.equalExpression:
+        return lambda values: [value == val for value in values]
+    elif expression.likeExpression:
+        regexMatch = re.compile(fnmatch.translate(val)).match
+        return lambda values: [
+            isinstance(value, str) and regexMatch(value) is not None for value in values
+        ]
+    elif expression.differentExpression:
+        return lambda values: [value != val for value in values]
+    elif expression.largerThanExpression:
+        return compileComparison(operator.gt, val)
+    elif expression.lowerThanExpression:
+        return compileComparison(operator.lt, val)
+    else:
+        assert False, 'unexpected expression'
+
+
+def compileProjection(fields):
+    '''Return a function extracting the selected subfields of a message'''
+    if fields is None:
+        return lambda msg: msg
+
+    paths = [(field.split('.'), alias) for field, alias in fields]
+
+    def projection(msg):
+        ret = {}
+        for components, alias in paths:
+            subtree = msg
+            for component in components:
+                if not isinstance(subtree, dict):
+                    subtree = None
+                    break
+
+                subtree = subtree.get(component, {})
+
+            ret[alias] = subtree
+
+        return ret
+
+    return projection
+
+
 class StreamSqlFilter:
     def __init__(self, sql_filter):
         '''
@@ -89,9 +260,83 @@ class StreamSqlFilter:
             try:
                 whereIdx = tokens.index('where')
             except ValueError:
+                whereIdx = None
                 self.emptyFilter = True
-                return
 
+        if whereIdx is not None:
+            self.parseCondition(tokens, whereIdx)
+
+        self.compile()
+
+    def compile(self):
+        '''Build the predicate and projection closures used by match'''
+        self.projection = compileProjection(self.fields)
+
+        if self.emptyFilter:
+            self.predicate = None
+            return
+
+        predicates = [
+            self.compileExpression(expression) for expression in self.expressions
+        ]
+
+        self.columnExpressions = [
+            (
+                compileColumnExtractor(expression.components),
+                compileColumnTest(expression),
+            )
+            for expression in self.expressions
+        ]
+
+        if len(predicates) == 1:
+            self.predicate = predicates[0]
+        elif self.andExpr:
+
+            def predicate(msg):
+                for expressionPredicate in predicates:
+                    if not expressionPredicate(msg):
+                        return False
+                return True
+
+            self.predicate = predicate
+        else:
+
+            def predicate(msg):
+                for expressionPredicate in predicates:
+                    if expressionPredicate(msg):
+                        return True
+                return False
+
+            self.predicate = predicate
+
+    def compileExpression(self, expression):
+        '''Same semantics as compileColumnTest, one message at a time'''
+        getter = compileValueGetter(expression.components)
+        val = expression.val
+
+        if expression.equalExpression:
+            return lambda msg: getter(msg) == val
+        elif expression.likeExpression:
+            if not isinstance(val, str):
+                raise InvalidStreamSQLError('LIKE expects a string')
+
+            regexMatch = re.compile(fnmatch.translate(val)).match
+
+            def like(msg):
+                value = getter(msg)
+                return isinstance(value, str) and regexMatch(value) is not None
+
+            return like
+        elif expression.differentExpression:
+            return lambda msg: getter(msg) != val
+        elif expression.largerThanExpression:
+            return compileScalarComparison(getter, operator.gt, val)
+        elif expression.lowerThanExpression:
+            return compileScalarComparison(getter, operator.lt, val)
+        else:
+            assert False, 'unexpected expression'
+
+    def parseCondition(self, tokens, whereIdx):
         conditionStart = whereIdx + 1
         sql_filter = ' '.join(tokens[conditionStart:])
         sql_filter = sql_filter.replace('\n', ' ')
@@ -170,40 +415,9 @@ class StreamSqlFilter:
             lowerThanExpression,
         )
 
-    def matchExpression(self, msg, expression):
-        if expression.length == 2:
-            val = msg.get(expression.components[0], {}).get(
-                expression.components[1]
-            )  # noqa
-            return self.matchOperand(val, expression)
-        elif expression.length == 1:
-            val = msg.get(expression.components[0])
-            return self.matchOperand(val, expression)
-        else:
-            msgCopy = dict(msg)
-
-            for component in expression.components:
-                msgCopy = msgCopy.get(component, {})
-
-            return self.matchOperand(msgCopy, expression)
-
-    def matchOperand(self, val, expression):
-        if expression.equalExpression:
-            return expression.val == val
-        elif expression.likeExpression:
-            return fnmatch.fnmatch(val, expression.val)
-        elif expression.differentExpression:
-            return expression.val != val
-        elif expression.largerThanExpression:
-            return val > expression.val
-        elif expression.lowerThanExpression:
-            return val < expression.val
-        else:
-            assert False, 'unexpected expression'
-
     def match(self, msg):
         if self.emptyFilter:
-            return self.transform(msg)
+            return self.projection(msg)
 
         if isinstance(msg, list):
             if len(msg) == 0:
@@ -216,38 +430,105 @@ class StreamSqlFilter:
             logging.error('Bad type for {}, expecting dictionary'.format(msg))
             return False
 
-        if self.andExpr:
-            if not all(
-                self.matchExpression(msg, expression) for expression in self.expressions
-            ):  # noqa
-                return False
-            else:
-                return self.transform(msg)
+        if not self.predicate(msg):
+            return False
+
+        return self.projection(msg)
+
+    def matchBatch(self, payloads):
+        '''Filter a batch of messages. Every element of list payloads is
+        filtered on its own. Returns a (payload index, message, output) tuple
+        for each message or element which matched, in order.
+        '''
+        if all(type(payload) is dict for payload in payloads):
+            rows = payloads
+            owners = range(len(payloads))
         else:
-            if not any(
-                self.matchExpression(msg, expression) for expression in self.expressions
-            ):  # noqa
-                return False
-            else:
-                return self.transform(msg)
+            rows, owners = self.flatten(payloads)
+
+        if self.emptyFilter:
+            selected = range(len(rows))
+        elif self.andExpr:
+            selected = self.selectAll(rows)
+        else:
+            selected = self.selectAny(rows)
+
+        projection = self.projection
+        return [(owners[i], rows[i], projection(rows[i])) for i in selected]
+
+    def flatten(self, payloads):
+        '''One row per message, or per element of list messages'''
+        rows = []
+        owners = []
+
+        for index, payload in enumerate(payloads):
+            if isinstance(payload, dict):
+                rows.append(payload)
+                owners.append(index)
+            elif isinstance(payload, list):
+                for item in payload:
+                    if isinstance(item, dict):
+                        rows.append(item)
+                        owners.append(index)
+
+        return rows, owners
+
+    def selectAll(self, rows):
+        '''Indexes of the rows matching all the expressions'''
+        selected = range(len(rows))
+
+        for extract, test in self.columnExpressions:
+            if len(rows) == 0:
+                break
+
+            mask = test(extract(rows))
+            selected = list(itertools.compress(selected, mask))
+            rows = list(itertools.compress(rows, mask))
+
+        return selected
+
+    def selectAny(self, rows):
+        '''Indexes of the rows matching at least one expression'''
+        remaining = range(len(rows))
+        selected = []
+
+        for extract, test in self.columnExpressions:
+            if len(rows) == 0:
+                break
+
+            mask = test(extract(rows))
+            misses = [not matched for matched in mask]
+
+            selected.extend(itertools.compress(remaining, mask))
+            remaining = list(itertools.compress(remaining, misses))
+            rows = list(itertools.compress(rows, misses))
+
+        selected.sort()
+        return selected
 
     def transform(self, msg):
         '''extract a subfield'''
+        return self.projection(msg)
 
-        if self.fields is None:
-            return msg
 
-        ret = {}
-        for field, alias in self.fields:
-            subtree = extractAttributeFromDict(dict(msg), field)
-            ret.update({alias: subtree})
+def getStreamSqlFilter(sql_filter):
+    '''Compiled filters are shared by all the subscriptions using the same
+    SQL text. Raise InvalidStreamSQLError (which is not cached).
+    '''
+    if not isinstance(sql_filter, str):
+        raise InvalidStreamSQLError()
 
-        return ret
+    return compileStreamSqlFilter(sql_filter)
+
+
+@functools.lru_cache(maxsize=STREAM_SQL_CACHE_SIZE)
+def compileStreamSqlFilter(sql_filter):
+    return StreamSqlFilter(sql_filter)
 
 
 def match_stream_sql_filter(sql_filter, msg):
     try:
-        f = StreamSqlFilter(sql_filter)
+        f = getStreamSqlFilter(sql_filter)
         return f.match(msg)
     except InvalidStreamSQLError:
         return False
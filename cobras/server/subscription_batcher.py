@@ -0,0 +1,202 @@
+'''Outbound queue of a subscription, and batching of its messages.
+
+Messages are queued without blocking the stream reader, and sent by a
+dedicated task. The queue is bounded; when a client cannot keep up and the
+queue is full, the slow consumer policy of the app decides what happens:
+
+- drop_oldest: the oldest queued message is dropped
+- drop_newest: the incoming message is dropped
+- jump_to_head: the whole backlog is dropped, delivery resumes from the
+  incoming message
+- disconnect: the client is disconnected
+
+A batch is sent when it is full (message count or bytes), or when its oldest
+message has been waiting for longer than the max linger time, so that quiet
+channels are not held back by a large batch size.
+
+In adaptive mode the batch size follows the subscriber drain rate. It doubles
+when the websocket still has unsent data after a batch was written (the client
+is falling behind), and is halved when the client keeps up.
+
+When sending fails for another reason than the client going away, the
+batcher is closed and onError is invoked, so that the subscription does not
+keep queueing messages which will never be sent.
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import collections
+import logging
+
+import websockets
+
+from cobras.common.apps_config import (
+    DEFAULT_SLOW_CONSUMER_POLICY,
+    DEFAULT_SUBSCRIPTION_QUEUE_MAX_SIZE,
+    DISCONNECT,
+    DROP_NEWEST,
+    JUMP_TO_HEAD,
+)
+from cobras.common.task_cleanup import addTaskCleanup
+
+DEFAULT_BATCH_MAX_LINGER = 0.1  # seconds
+DEFAULT_BATCH_MAX_BYTES = 256 * 1024
+DEFAULT_ADAPTIVE_MAX_BATCH_SIZE = 100
+
+
+class SlowConsumerError(Exception):
+    pass
+
+
+class SubscriptionBatcher:
+    def __init__(
+        self,
+        send,
+        batchSize: int = 1,
+        maxBytes: int = None,
+        maxLinger: float = None,
+        adaptive: bool = False,
+        queueMaxSize: int = DEFAULT_SUBSCRIPTION_QUEUE_MAX_SIZE,
+        policy: str = DEFAULT_SLOW_CONSUMER_POLICY,
+        onError=None,
+    ):
+        '''send is a coroutine taking a list of serialized messages and the
+        serialized position of the last one. It returns True if the client
+        still has unsent data once the batch has been written.
+        onError is invoked with the exception when send fails.
+        '''
+        self.send = send
+        self.onError = onError
+        self.maxBatchSize = batchSize
+        self.batchSize = 1 if adaptive else batchSize
+        self.maxBytes = maxBytes or DEFAULT_BATCH_MAX_BYTES
+        self.maxLinger = DEFAULT_BATCH_MAX_LINGER if maxLinger is None else maxLinger
+        self.adaptive = adaptive
+        self.queueMaxSize = max(queueMaxSize, 1)
+        self.policy = policy
+
+        # (message, encodedPosition, enqueue time)
+        self.queue = collections.deque()
+        self.bytes = 0
+        self.highWaterMark = 0
+
+        self.loop = asyncio.get_event_loop()
+        self.event = asyncio.Event()
+        self.timer = None
+        self.task = None
+        self.closed = False
+
+    def queueSize(self):
+        return len(self.queue)
+
+    def add(self, message: str, encodedPosition: str) -> int:
+        '''Returns how many messages were dropped to make room for this one.
+        Raise SlowConsumerError when the client should be disconnected.
+        '''
+        if self.closed:
+            return 0
+
+        dropped = 0
+
+        if len(self.queue) >= self.queueMaxSize:
+            if self.policy == DISCONNECT:
+                raise SlowConsumerError(
+                    f'outbound queue is full ({len(self.queue)} messages)'
+                )
+            elif self.policy == DROP_NEWEST:
+                return 1
+            elif self.policy == JUMP_TO_HEAD:
+                dropped = len(self.queue)
+                self.queue.clear()
+                self.bytes = 0
+            else:
+                item = self.queue.popleft()
+                self.bytes -= len(item[0])
+                dropped = 1
+
+        self.queue.append((message, encodedPosition, self.loop.time()))
+        self.bytes += len(message)
+        self.highWaterMark = max(self.highWaterMark, len(self.queue))
+
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+            addTaskCleanup(self.task)
+
+        # Wake up the sender to arm the linger timer, or to send a full batch
+        if len(self.queue) == 1 or self.ready():
+            self.event.set()
+
+        return dropped
+
+    def ready(self):
+        return len(self.queue) >= self.batchSize or self.bytes >= self.maxBytes
+
+    async def run(self):
+        try:
+            while True:
+                await self.event.wait()
+                self.event.clear()
+                self.cancelTimer()
+
+                while len(self.queue) != 0:
+                    _, _, enqueueTime = self.queue[0]
+                    delay = enqueueTime + self.maxLinger - self.loop.time()
+
+                    if not self.ready() and delay > 0:
+                        self.timer = self.loop.call_later(delay, self.event.set)
+                        break
+
+                    await self.sendBatch()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception as e:
+            logging.error(f'subscription batcher: cannot send messages: {e}')
+
+            self.task = None
+            self.close()
+
+            if self.onError is not None:
+                self.onError(e)
+
+    async def sendBatch(self):
+        messages = []
+        size = 0
+
+        # Do not go over the bytes budget, unless a message alone is too big
+        while len(self.queue) != 0 and len(messages) < self.batchSize:
+            message, _, _ = self.queue[0]
+            if len(messages) != 0 and size + len(message) > self.maxBytes:
+                break
+
+            _, position, _ = self.queue.popleft()
+            messages.append(message)
+            size += len(message)
+
+        self.bytes -= size
+
+        backlog = await self.send(messages, position)
+
+        if self.adaptive:
+            self.adapt(backlog)
+
+    def adapt(self, backlog: bool):
+        if backlog:
+            self.batchSize = min(self.batchSize * 2, self.maxBatchSize)
+        else:
+            self.batchSize = max(self.batchSize // 2, 1)
+
+    def cancelTimer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def close(self):
+        '''Pending messages are dropped'''
+        self.closed = True
+        self.cancelTimer()
+        self.queue.clear()
+        self.bytes = 0
+
+        if self.task is not None:
+            self.task.cancel()
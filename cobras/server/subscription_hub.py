@@ -0,0 +1,446 @@
+'''Node local subscription hub.
+
+Live subscriptions (no explicit position) to the same appkey::channel share
+a single stream reader. Each batch returned by XREAD is decoded once
+and fanned out to every local subscriber of that channel, and messages are
+re-encoded at most once for all of them. Readers are
+started by the first subscriber and stopped when the last one goes away.
+
+Readers do not own a redis connection, the stream multiplexer reads all
+of them with one XREAD per redis node (or cluster slot).
+
+Subscribers receive whole batches, so that StreamSQL filters run over all
+the entries at once, and only once for the subscribers sharing a filter.
+
+Entries carry the serialized message as its own field (see handlePublish),
+unfiltered subscribers splice it into their frames and the publish pdu is
+never decoded for them.
+
+Apps with local delivery enabled hand the messages published on this node
+straight to its readers once they are added to their stream, without waiting
+for XREAD to return them. The reader then skips them when XREAD catches up.
+Messages published on other nodes can come after more recent local ones,
+they are still delivered, but the positions sent to the subscribers never go
+backwards.
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import base64
+import logging
+import traceback
+from hashlib import sha1
+from urllib.parse import urlparse
+
+from cobras.common.fast_json import JSONDecodeError, dumps, loads
+from cobras.common.pdu_codecs import JSON_CODEC
+from cobras.common.task_cleanup import addTaskCleanup
+from cobras.server.cluster_slots import getNodeName
+from cobras.server.stream_multiplexer import parseStreamId
+
+
+class StreamEntry:
+    '''A stream entry, shared by all the subscribers of a stream.
+    The publish pdu is decoded lazily, and the message serialized at most once
+    per codec.
+    '''
+
+    def __init__(
+        self,
+        msg: dict,
+        position: str,
+        payloadSize: int,
+        data: bytes = None,
+        serializedMessage: str = None,
+    ):
+        '''msg can be None when data, the serialized publish pdu, is given'''
+        self.decodedMsg = msg
+        self.data = data
+        self.position = position
+        self.payloadSize = payloadSize
+
+        self.serializedMessage = serializedMessage
+        self.serializedPosition = None
+
+        # Binary codecs: codec -> (encoded message, encoded position)
+        self.encodings = {}
+
+    @property
+    def msg(self):
+        if self.decodedMsg is None:
+            self.decodedMsg = loads(self.data)
+
+        return self.decodedMsg
+
+    def message(self):
+        # msg is the full publish pdu, extract the real message out of it.
+        return self.msg.get('body', {}).get('message')
+
+    def encodedMessage(self, codec=JSON_CODEC):
+        if codec is not JSON_CODEC:
+            return self.encode(codec)[0]
+
+        if self.serializedMessage is None:
+            self.serializedMessage = dumps(self.message())
+
+        return self.serializedMessage
+
+    def encodedPosition(self, codec=JSON_CODEC):
+        if codec is not JSON_CODEC:
+            return self.encode(codec)[1]
+
+        if self.serializedPosition is None:
+            self.serializedPosition = dumps(self.position)
+
+        return self.serializedPosition
+
+    def encode(self, codec):
+        encoding = self.encodings.get(codec)
+        if encoding is None:
+            encoding = (
+                codec.encodeValue(self.message()),
+                codec.encodeValue(self.position),
+            )
+            self.encodings[codec] = encoding
+
+        return encoding
+
+
+class StreamBatch:
+    '''Entries returned by one XREAD, shared by all the subscribers'''
+
+    def __init__(self, entries):
+        self.entries = entries
+
+        # Compiled filters are shared between identical subscriptions,
+        # so are their results
+        self.filterResults = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def match(self, streamSqlFilter, codec=JSON_CODEC):
+        '''Returns (entry, message, serialized output) for each filter match'''
+        results = self.filterResults.get((streamSqlFilter, codec))
+        if results is not None:
+            return results
+
+        payloads = []
+        for entry in self.entries:
+            # The real message might be wrapped into a list of messages
+            payload = entry.message()
+            if isinstance(payload, dict):
+                payload = payload.get('messages') or payload
+            payloads.append(payload)
+
+        results = [
+            (self.entries[index], msg, codec.encodeValue(output))
+            for index, msg, output in streamSqlFilter.matchBatch(payloads)
+            if output
+        ]
+        self.filterResults[(streamSqlFilter, codec)] = results
+        return results
+
+
+class StreamReader:
+    '''Receive batches of entries from the multiplexer, and fan them out'''
+
+    def __init__(self, hub, stream: str):
+        self.hub = hub
+        self.stream = stream
+        self.queue = asyncio.Queue()
+
+        self.subscribers = set()
+        self.pending = set()
+        self.initInfo = None
+        self.task = None
+
+        # Local delivery: the last position read with XREAD, the positions
+        # delivered locally that XREAD did not return yet, and the highest
+        # position delivered to the subscribers
+        self.lastReadId = None
+        self.localPositions = set()
+        self.lastDeliveredId = (0, 0)
+        self.lastDeliveredPosition = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+        addTaskCleanup(self.task)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def empty(self):
+        return len(self.subscribers) == 0 and len(self.pending) == 0
+
+    async def addSubscriber(self, handler):
+        # The reader has not been initialized yet, it will call on_init
+        # for pending subscribers once it is ready
+        if self.initInfo is None:
+            self.pending.add(handler)
+            return
+
+        await self.initSubscriber(handler)
+
+    def removeSubscriber(self, handler):
+        self.subscribers.discard(handler)
+        self.pending.discard(handler)
+
+        # Drop the messages it still has to send
+        handler.close()
+
+        if self.empty():
+            self.hub.removeReader(self)
+            self.stop()
+
+    async def initSubscriber(self, handler):
+        # Register the handler first, so that a cancellation happening
+        # while on_init is running is honored
+        if self.initInfo.get('success', False):
+            self.subscribers.add(handler)
+
+        try:
+            await handler.on_init(dict(self.initInfo))
+        except Exception as e:
+            logging.error(f'subscriber[{self.stream}]: cannot initialize handler: {e}')
+            self.subscribers.discard(handler)
+
+    async def fetchInitInfo(self):
+        streamExists = False
+        redisHost = self.hub.redisHost
+        clientId = -1
+        success = True
+
+        # start reading, and query the stream metadata once for all the subscribers
+        try:
+            group = await self.hub.multiplexer.addListener(
+                self.stream, self.onStreamEntries
+            )
+            clientId = group.clientId
+
+            # Entries up to there were published before we started reading
+            lastId = group.lastIds.get(self.stream, '0-0')
+            self.lastReadId = parseStreamId(lastId)
+            # The node the group reads from, a replica or a master
+            redisHost = getNodeName(group.url)
+            async with self.hub.redisPool.client() as redisClient:
+                streamExists = await redisClient.exists(self.stream)
+        except Exception as e:
+            logging.error(
+                f'subscriber[{self.stream}]: cannot retreive stream metadata: {e}'
+            )
+            success = False
+
+        return {
+            'success': success,
+            'redis_node': redisHost,
+            'redis_client_id': clientId,
+            'stream_exists': streamExists,
+            'stream_name': self.stream,
+        }
+
+    def onStreamEntries(self, results):
+        self.queue.put_nowait((results, False))
+
+    def addLocalEntries(self, entries):
+        '''Entries published on this node, added to the stream already'''
+        if self.lastReadId is None:
+            return  # XREAD will return them
+
+        self.queue.put_nowait((entries, True))
+
+    def filterLocalEntries(self, entries):
+        fresh = []
+        for entry in entries:
+            # Already returned by XREAD
+            if parseStreamId(entry.position) <= self.lastReadId:
+                continue
+
+            self.localPositions.add(entry.position)
+            fresh.append(entry)
+
+        return fresh
+
+    def filterReadEntries(self, entries):
+        '''Skip the entries delivered locally'''
+        if len(entries) != 0:
+            self.lastReadId = parseStreamId(entries[-1].position)
+
+        if len(self.localPositions) == 0:
+            return entries
+
+        fresh = []
+        for entry in entries:
+            if entry.position in self.localPositions:
+                self.localPositions.discard(entry.position)
+            else:
+                fresh.append(entry)
+
+        # Entries trimmed from the stream before we could read them
+        self.localPositions = {
+            position
+            for position in self.localPositions
+            if parseStreamId(position) > self.lastReadId
+        }
+        return fresh
+
+    def orderPositions(self, entries):
+        '''Entries coming after a more recent one are sent with its position'''
+        for entry in entries:
+            streamId = parseStreamId(entry.position)
+            if streamId < self.lastDeliveredId:
+                entry.position = self.lastDeliveredPosition
+            else:
+                self.lastDeliveredId = streamId
+                self.lastDeliveredPosition = entry.position
+
+    def decodeEntries(self, results):
+        entries = []
+
+        for result in results:
+            position = result[0].decode()
+            msg = result[1]
+            data = msg[b'json']
+
+            msgCksum = msg.get(b'sha1')
+            if msgCksum is not None:
+                cksum = sha1(data).hexdigest().encode()
+                if cksum != msgCksum:
+                    logging.error(f'{position}: invalid xread msg cksum')
+                    continue
+
+            # The publish pdu was valid json when we stored it
+            serializedMessage = msg.get(b'message')
+            if serializedMessage is not None:
+                entry = StreamEntry(
+                    None, position, len(data), data, serializedMessage.decode()
+                )
+                entries.append(entry)
+                continue
+
+            try:
+                msg = loads(data)
+            except JSONDecodeError:
+                msgEncoded = base64.b64encode(data).decode()
+                err = f'{position}: malformed json: base64: {msgEncoded} raw: {data}'
+                logging.error(err)
+                continue
+
+            entries.append(StreamEntry(msg, position, len(data)))
+
+        return entries
+
+    async def dispatch(self, handler, batch):
+        # The subscriber might have been cancelled while we were
+        # delivering to another one
+        if handler not in self.subscribers:
+            return
+
+        try:
+            ret = await handler.handleEntries(batch)
+        except Exception as e:
+            handler.log(f'subscriber[{self.stream}]: dropping subscriber: {e}')
+            ret = False
+
+        if not ret:
+            self.removeSubscriber(handler)
+
+    async def run(self):
+        try:
+            self.initInfo = await self.fetchInitInfo()
+
+            while len(self.pending) != 0:
+                handler = self.pending.pop()
+                await self.initSubscriber(handler)
+
+            if self.initInfo['success']:
+                await self.readStream()
+
+        except asyncio.CancelledError:
+            logging.info(f'subscriber[{self.stream}]: cancelling redis subscription')
+            raise
+
+        except Exception as e:
+            backtrace = traceback.format_exc()
+            logging.warning(f'subscriber[{self.stream}]: {e} {backtrace}')
+
+        finally:
+            self.hub.removeReader(self)
+            self.hub.multiplexer.removeListener(self.stream, self.onStreamEntries)
+
+    async def readStream(self):
+        # wait for incoming events.
+        while True:
+            results, local = await self.queue.get()
+
+            if local:
+                entries = self.filterLocalEntries(results)
+            else:
+                entries = self.filterReadEntries(self.decodeEntries(results))
+
+            if len(entries) == 0:
+                continue
+
+            self.orderPositions(entries)
+
+            batch = StreamBatch(entries)
+            for handler in list(self.subscribers):
+                await self.dispatch(handler, batch)
+
+
+class HubSubscription:
+    '''Returned to the subscribe handler. Quacks like the asyncio task used
+    for dedicated subscriptions so that it can be cancelled the same way.
+    '''
+
+    def __init__(self, reader, handler):
+        self.reader = reader
+        self.handler = handler
+
+    def cancel(self):
+        self.reader.removeSubscriber(self.handler)
+
+
+class SubscriptionHub:
+    def __init__(self, redisClients, multiplexer):
+        self.multiplexer = multiplexer
+        self.readers = {}
+
+        # Used for stream metadata queries, which are not blocking
+        self.redisPool = redisClients.readPool
+        self.redisHost = urlparse(redisClients.router.url).netloc.partition(':')[0]
+
+    async def subscribe(self, stream: str, handler) -> HubSubscription:
+        reader = self.readers.get(stream)
+        if reader is None:
+            reader = StreamReader(self, stream)
+            self.readers[stream] = reader
+            reader.start()
+
+        await reader.addSubscriber(handler)
+        return HubSubscription(reader, handler)
+
+    def deliverLocal(self, streams, streamIds, data, serializedMessage: str):
+        '''Hand a message published on this node to the local subscribers
+        of its streams, streamIds being the XADD results.
+        '''
+        for stream, streamId in zip(streams, streamIds):
+            reader = self.readers.get(stream)
+            if reader is None:
+                continue
+
+            if isinstance(streamId, bytes):
+                streamId = streamId.decode()
+
+            entry = StreamEntry(None, streamId, len(data), data, serializedMessage)
+            reader.addLocalEntries([entry])
+
+    def removeReader(self, reader):
+        # A new reader might have been started for this stream already
+        if self.readers.get(reader.stream) is reader:
+            del self.readers[reader.stream]
+
+    def readersCount(self):
+        return len(self.readers)
@@ -0,0 +1,264 @@
+'''Multi-process mode: N worker processes, each with its own event loop,
+accept connections on the same port through SO_REUSEPORT.
+
+Workers of a node share their state through redis: every second, each
+worker writes its connection count and its latest stats to a hash for the
+node. The first worker publishes the merged stats of all the workers.
+
+Connection lists can be large, and are only needed by admin/get_connections,
+so they are fetched on demand: the worker handling the request adds it to a
+stream which all the workers of the node listen to, and waits for the other
+live workers to write their connections to a short-lived hash.
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import logging
+import os
+import signal
+import sys
+import time
+import uuid
+
+from cobras.common.fast_json import dumps, loads
+from cobras.common.task_cleanup import addTaskCleanup
+
+WORKER_STATE_TTL = 5  # seconds
+CONNECTIONS_REQUEST_TIMEOUT = 1  # seconds
+CONNECTIONS_REQUEST_POLL_INTERVAL = 0.01  # seconds
+REQUEST_STREAM_MAX_LENGTH = 100
+REQUEST_STREAM_TTL = 3600  # seconds
+
+# Stats which are not summed across workers
+MAX_MERGED_STATS = (
+    'subscription_queue_high_water_mark',
+    'subscription_queue_high_water_mark_per_second',
+    'container_memory_limit_bytes',
+    'uptime_minutes',
+)
+
+
+def forkWorkers(count: int):
+    '''Return the worker id in the workers. The parent process forwards
+    SIGTERM and SIGINT to the workers, and exits once they are all done.
+    '''
+    pids = []
+    for workerId in range(count):
+        pid = os.fork()
+        if pid == 0:
+            return workerId
+
+        pids.append(pid)
+
+    def terminate(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+    exitCode = 0
+    for pid in pids:
+        _, status = os.waitpid(pid, 0)
+        if status != 0:
+            logging.error(f'worker {pid} exited with status {status}')
+            exitCode = 1
+
+    sys.exit(exitCode)
+
+
+def pinWorkerToCpu(workerId: int):
+    '''Workers are spread over the cpus this process is allowed to use'''
+    if not hasattr(os, 'sched_setaffinity'):
+        logging.warning('cpu affinity is not supported on this platform')
+        return
+
+    cpus = sorted(os.sched_getaffinity(0))
+    cpu = cpus[workerId % len(cpus)]
+    os.sched_setaffinity(0, {cpu})
+    logging.info(f'worker {workerId} pinned to cpu {cpu}')
+
+
+def installUvloop():
+    try:
+        import uvloop
+    except ImportError:
+        logging.error('uvloop is not installed, run `pip install uvloop`')
+        sys.exit(1)
+
+    uvloop.install()
+
+
+def mergeStats(items):
+    '''Sum the stats of all the workers, which have the same layout.
+    High water marks and limits are merged with max, other values which are
+    not numbers are taken from the first worker.
+    '''
+    merged = {}
+    for item in items:
+        for key, val in item.items():
+            if key not in merged:
+                merged[key] = mergeStats([val]) if isinstance(val, dict) else val
+            elif isinstance(val, dict):
+                merged[key] = mergeStats([merged[key], val])
+            elif isinstance(val, bool) or not isinstance(val, (int, float)):
+                continue
+            elif key in MAX_MERGED_STATS:
+                merged[key] = max(merged[key], val)
+            else:
+                merged[key] += val
+
+    return merged
+
+
+class WorkerRegistry:
+    def __init__(
+        self,
+        redis,
+        multiplexer,
+        node: str,
+        workerId: int,
+        workerCount: int,
+        connections,
+    ):
+        '''connections is the connection id -> connection dict of the app'''
+        self.redis = redis
+        self.multiplexer = multiplexer
+        self.workerId = workerId
+        self.workerCount = workerCount
+        self.key = f'_workers::{node}'
+        self.requestStream = f'_workers::{node}::requests'
+        self.connections = connections
+        self.stats = None
+        self.stop = False
+
+        # Our own connections requests, which we do not answer
+        self.requests = set()
+        self.listening = False
+
+    def isLeader(self):
+        return self.workerId == 0
+
+    async def publish(self):
+        state = {
+            'time': time.time(),
+            'connection_count': len(self.connections),
+            'stats': self.stats,
+        }
+        await self.redis.hset(self.key, self.workerId, dumps(state))
+        await self.redis.expire(self.key, WORKER_STATE_TTL)
+
+    async def getWorkers(self):
+        '''The state of the other live workers, by worker id'''
+        items = await self.redis.hgetall(self.key)
+
+        workers = {}
+        now = time.time()
+        for workerId, state in items.items():
+            workerId = int(workerId)
+            state = loads(state)
+            if workerId == self.workerId or workerId >= self.workerCount:
+                continue
+
+            if now - state['time'] > WORKER_STATE_TTL:
+                continue
+
+            workers[workerId] = state
+
+        return workers
+
+    def getResponseKey(self, requestId: str):
+        return f'{self.key}::connections::{requestId}'
+
+    async def getConnections(self):
+        '''Ask the other live workers for their connections. Workers which do
+        not answer in time are left out.
+        '''
+        connections = list(self.connections)
+
+        workers = await self.getWorkers()
+        if not workers:
+            return connections
+
+        requestId = uuid.uuid4().hex
+        responseKey = self.getResponseKey(requestId)
+        self.requests.add(requestId)
+        try:
+            await self.redis.xaddRaw(
+                self.requestStream, REQUEST_STREAM_MAX_LENGTH, b'request_id', requestId
+            )
+            await self.redis.expire(self.requestStream, REQUEST_STREAM_TTL)
+
+            deadline = time.monotonic() + CONNECTIONS_REQUEST_TIMEOUT
+            while True:
+                answers = await self.redis.hgetall(responseKey)
+                if len(answers) >= len(workers) or time.monotonic() > deadline:
+                    break
+
+                await asyncio.sleep(CONNECTIONS_REQUEST_POLL_INTERVAL)
+        finally:
+            self.requests.discard(requestId)
+
+        await self.redis.delete(responseKey)
+
+        for workerConnections in answers.values():
+            connections.extend(loads(workerConnections))
+
+        return connections
+
+    def onRequests(self, entries):
+        '''Stream multiplexer callback, for the connections requests'''
+        for _, fields in entries:
+            requestId = fields.get(b'request_id')
+            if requestId is None or requestId.decode() in self.requests:
+                continue
+
+            task = asyncio.ensure_future(self.answer(requestId.decode()))
+            addTaskCleanup(task)
+
+    async def answer(self, requestId: str):
+        key = self.getResponseKey(requestId)
+        try:
+            await self.redis.hset(key, self.workerId, dumps(list(self.connections)))
+            await self.redis.expire(key, WORKER_STATE_TTL)
+        except Exception as e:
+            logging.warning(f'workers: cannot send our connections {e}')
+
+    async def mergeStats(self, stats):
+        '''Merge our latest stats with the ones of the other workers'''
+        self.stats = stats
+
+        items = [stats]
+        for state in (await self.getWorkers()).values():
+            if state['stats'] is not None:
+                items.append(state['stats'])
+
+        return mergeStats(items), len(items)
+
+    async def run(self):
+        while not self.stop:
+            try:
+                if not self.listening:
+                    await self.multiplexer.addListener(
+                        self.requestStream, self.onRequests
+                    )
+                    self.listening = True
+
+                await self.publish()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f'workers: cannot connect to redis {e}')
+
+            await asyncio.sleep(1)
+
+    def terminate(self):
+        self.stop = True
+
+        if self.listening:
+            self.multiplexer.removeListener(self.requestStream, self.onRequests)
+            self.listening = False
@@ -36,7 +36,7 @@ setup(
     packages=find_packages(exclude=["tests"]),
     zip_safe=False,
     install_requires=install_requires,
-    extras_require={"dev": dev_requires},
+    extras_require={"dev": dev_requires, "cbor": ["cbor2"], "orjson": ["orjson"]},
     license="BSD 3",
     include_package_data=True,
     entry_points={
@@ -60,3 +60,119 @@ def test_get_roles_and_secret():
 def test_empty_apps_file():
     appsConfig = AppsConfig('')
     assert not appsConfig.isAppKeyValid('ASDCSDC')
+
+
+def test_slow_consumer_policy(tmp_path):
+    path = tmp_path / 'apps.yaml'
+    path.write_text(
+        '''
+apps:
+    foo:
+        subscription_queue_max_size: 100
+        slow_consumer_policy: disconnect
+        roles:
+            bar:
+                secret: baz
+    bar:
+        roles:
+            bar:
+                secret: baz
+'''
+    )
+
+    appsConfig = AppsConfig(str(path))
+    assert appsConfig.getSubscriptionQueueMaxSize('foo') == 100
+    assert appsConfig.getSlowConsumerPolicy('foo') == 'disconnect'
+    assert appsConfig.getSubscriptionQueueMaxSize('bar') == 10000
+    assert appsConfig.getSlowConsumerPolicy('bar') == 'drop_oldest'
+
+    path.write_text(
+        '''
+apps:
+    foo:
+        slow_consumer_policy: block
+        roles:
+            bar:
+                secret: baz
+'''
+    )
+
+    with pytest.raises(ValueError):
+        AppsConfig(str(path))
+
+
+def test_publish_dedup(tmp_path):
+    path = tmp_path / 'apps.yaml'
+    path.write_text(
+        '''
+apps:
+    foo:
+        publish_dedup: redis
+        publish_dedup_window_ms: 5000
+        roles:
+            bar:
+                secret: baz
+    bar:
+        roles:
+            bar:
+                secret: baz
+'''
+    )
+
+    appsConfig = AppsConfig(str(path))
+    assert appsConfig.getPublishDedupMode('foo') == 'redis'
+    assert appsConfig.getPublishDedupWindow('foo') == 5
+    assert appsConfig.getPublishDedupMaxKeys('foo') == 10000
+    assert appsConfig.getPublishDedupMode('bar') is None
+
+    path.write_text(
+        '''
+apps:
+    foo:
+        publish_dedup: disk
+        roles:
+            bar:
+                secret: baz
+'''
+    )
+
+    with pytest.raises(ValueError):
+        AppsConfig(str(path))
+
+
+def test_max_inflight_requests(tmp_path):
+    path = tmp_path / 'apps.yaml'
+    path.write_text(
+        '''
+apps:
+    foo:
+        max_inflight_requests: 16
+        roles:
+            bar:
+                secret: baz
+    bar:
+        roles:
+            bar:
+                secret: baz
+'''
+    )
+
+    appsConfig = AppsConfig(str(path))
+    assert appsConfig.getMaxInFlightRequests('foo') == 16
+
+    # Requests are handled one at a time unless the app opts in
+    assert appsConfig.getMaxInFlightRequests('bar') == 1
+
+    path.write_text(
+        '''
+apps:
+    foo:
+        max_inflight_requests: 0
+        roles:
+            bar:
+                secret: baz
+'''
+    )
+
+    with pytest.raises(ValueError):
+        AppsConfig(str(path))
@@ -0,0 +1,71 @@
+'''Test the automatic pipelining of redis commands
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+
+import hiredis
+import pytest
+
+from cobras.server.rcc_client import RedisClientRcc
+
+from .test_utils import makeUniqueString
+
+
+def test_auto_pipeline():
+    async def coroutine():
+        client = RedisClientRcc('redis://localhost', None, False)
+        assert await client.ping()
+
+        pipeline = client.redis.getPipeline(client.url)
+        writer = pipeline.connection.writer
+        writes = []
+        write = writer.write
+
+        def spy(data):
+            writes.append(data)
+            write(data)
+
+        writer.write = spy
+
+        # Commands issued in the same loop iteration are written at once
+        key = makeUniqueString()
+        streams = [makeUniqueString() for i in range(10)]
+        results = await asyncio.gather(
+            client.xaddMessages(streams, '{"a": 1}', '1', 10),
+            client.setIfNotExists(key, 1000),
+            client.setIfNotExists(key, 1000),
+            *[client.exists(stream) for stream in streams],
+        )
+        assert len(writes) == 1
+        assert len(results[0]) == 10
+        assert results[1:3] == [True, False]
+        assert results[3:] == [1] * 10
+
+        # Errors only fail their own command
+        results = await asyncio.gather(
+            client.redis.send('HGETALL', streams[0]),
+            client.exists(streams[0]),
+            return_exceptions=True,
+        )
+        assert isinstance(results[0], hiredis.ReplyError)
+        assert results[1] == 1
+
+        # Replies of cancelled commands are skipped
+        task = asyncio.ensure_future(client.exists(streams[0]))
+        await asyncio.sleep(0)
+        task.cancel()
+        assert await client.setIfNotExists(key, 1000) is False
+
+        # Connection errors fail the commands in flight, the next ones reconnect
+        future = client.redis.submit(key, b'*1\r\n$4\r\nPING\r\n')
+        client.close()
+        with pytest.raises(ConnectionError):
+            await future
+        assert await client.exists(streams[0]) == 1
+
+        for stream in streams + [key]:
+            await client.delete(stream)
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
@@ -3,8 +3,10 @@
 import os
 import random
 
+import pytest
+
 from cobras.common.apps_config import AppsConfig
-from cobras.common.channel_builder import updateMsg
+from cobras.common.channel_builder import compileRules, updateMsg
 
 
 def test_compose2():
@@ -207,3 +209,50 @@ def test_none_error():
     assert len(channels) == 1
 
     assert 'a_channel' in channels
+
+
+def test_compose():
+    rules = compileRules(
+        {
+            'compose': {'kind': 'compose', 'template': 'a_{device.game}_{id}_{{x}}'},
+            'add': {'kind': 'add', 'channel': 'foo'},
+            'add_again': {'kind': 'add', 'channel': 'foo'},
+            'remove': {'kind': 'remove', 'prefix': 'sms_'},
+        }
+    )
+
+    msg = {
+        'action': 'rtm/publish',
+        'body': {
+            'message': {'device': {'game': 'ody'}, 'id': 12},
+            'channels': ['sms_republished_v1_neo', 'bar'],
+        },
+    }
+
+    updatedMsg = updateMsg(rules, msg)
+    assert updatedMsg['body']['channels'] == ['bar', 'a_ody_12_{x}', 'foo']
+
+    # Missing fields
+    msg = {'action': 'rtm/publish', 'body': {'message': {'id': 12}, 'channel': 'c'}}
+    updatedMsg = updateMsg(rules, msg)
+    assert updatedMsg['body']['channels'] == ['c', 'foo']
+
+
+@pytest.mark.parametrize(
+    'rules',
+    [
+        [],
+        {'foo': 'bar'},
+        {'foo': {'kind': 'unknown'}},
+        {'foo': {'kind': 'add'}},
+        {'foo': {'kind': 'compose2', 'field1': 'a', 'field2': 'b'}},
+        {'foo': {'kind': 'compose', 'template': 'no_field'}},
+        {'foo': {'kind': 'compose', 'template': '{a'}},
+        {'foo': {'kind': 'compose', 'template': '{a:>10}'}},
+        {'foo': {'kind': 'add_shard', 'channel': 'c_{shard}', 'shards': 0}},
+        {'foo': {'kind': 'add_shard', 'channel': 'c_{other}', 'shards': 2}},
+    ],
+)
+def test_invalid_rules(rules):
+    with pytest.raises(ValueError):
+        compileRules(rules)
@@ -0,0 +1,63 @@
+'''Test the client side routing of redis cluster commands
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+
+from cobras.server.cluster_slots import (
+    SlotMap,
+    getHashSlot,
+    parseClusterSlots,
+    parseRedirection,
+)
+
+
+def test_hash_slot():
+    assert getHashSlot('123456789') == 0x31C3
+    assert getHashSlot(b'123456789') == 0x31C3
+    assert getHashSlot('foo') == 12182
+
+    # Hash tags
+    assert getHashSlot('{user1000}.following') == getHashSlot('user1000')
+    assert getHashSlot('foo{}{bar}') != getHashSlot('bar')
+    assert getHashSlot('foo{{bar}}zap') == getHashSlot('{bar')
+
+
+def test_parse_redirection():
+    assert parseRedirection('MOVED 3999 127.0.0.1:6381') == (
+        'MOVED',
+        3999,
+        'redis://127.0.0.1:6381',
+    )
+    assert parseRedirection('ASK 3999 127.0.0.1:6381')[0] == 'ASK'
+    assert parseRedirection('WRONGTYPE Operation against a key') is None
+
+
+def test_slot_map():
+    async def coroutine():
+        slotMap = SlotMap('redis://localhost', None, False)
+        assert slotMap.getUrl('foo') == 'redis://localhost'
+        assert slotMap.getNode('foo') == 'localhost:6379'
+
+        slots = [
+            [0, 8191, [b'10.0.0.1', 7000, b'id1'], [b'10.0.0.4', 7000, b'id4']],
+            [8192, 16383, [b'', 7001, b'id2']],
+        ]
+        slotMap.update(parseClusterSlots(slots, 'localhost'))
+        assert not slotMap.single
+        assert slotMap.getUrl('123456789') == 'redis://localhost:7001'
+        assert slotMap.getUrl('{123456789}.foo') == 'redis://localhost:7001'
+        assert slotMap.getNode('user1000') == '10.0.0.1:7000'
+        assert slotMap.getUrl(None) == 'redis://localhost'
+
+        # Moved slots are updated right away
+        slotMap.onMoved(getHashSlot('user1000'), 'redis://10.0.0.2:7000')
+        assert slotMap.getNode('user1000') == '10.0.0.2:7000'
+        assert slotMap.getNode('{user1000}.following') == '10.0.0.2:7000'
+
+        # ... and the whole table is refreshed in the background
+        assert slotMap.refreshTask is not None
+        await slotMap.refreshTask
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
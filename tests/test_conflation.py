@@ -0,0 +1,73 @@
+'''Test conflated subscriptions
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+
+import pytest
+
+from cobras.server.conflation import ConflateKey, Conflater, InvalidConflateKeyError
+
+
+def test_conflate_key():
+    key = ConflateKey('device.android_id, game')
+
+    msg = {'device': {'android_id': 'a1'}, 'game': 'wiso', 'data': 1}
+    assert key.extract(msg) == ('a1', 'wiso')
+    assert key.extract([msg]) == ('a1', 'wiso')
+
+    assert key.extract({'device': 'a1', 'game': 'wiso'}) is None
+    assert key.extract({'game': 'wiso'}) is None
+    assert key.extract('hello') is None
+
+    for expression in ('', 'device.', 'device..id', 'device id', None):
+        with pytest.raises(InvalidConflateKeyError):
+            ConflateKey(expression)
+
+
+def test_conflater():
+    async def coroutine():
+        flushed = []
+
+        def flush(message, encodedPosition):
+            flushed.append((message, encodedPosition))
+
+        conflater = Conflater(ConflateKey('id'), 0.05, 100, flush)
+
+        conflater.add({'id': 'a'}, 'a1', '1')
+        conflater.add({'id': 'b'}, 'b2', '2')
+        conflater.add({'id': 'a'}, 'a3', '3')
+        conflater.add({'no_id': 'c'}, 'c4', '4')
+        conflater.add({'no_id': 'c'}, 'c5', '5')
+        assert flushed == []
+
+        # Latest value per key, in position order
+        await asyncio.sleep(0.2)
+        assert flushed == [('b2', '2'), ('a3', '3'), ('c4', '4'), ('c5', '5')]
+
+        conflater.add({'id': 'a'}, 'a6', '6')
+        conflater.close()
+        await asyncio.sleep(0.2)
+        assert len(flushed) == 4
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+def test_conflater_max_keys():
+    async def coroutine():
+        flushed = []
+
+        def flush(message, encodedPosition):
+            flushed.append(message)
+
+        conflater = Conflater(ConflateKey('id'), 60, 2, flush)
+
+        for i in range(3):
+            conflater.add({'id': i}, str(i), str(i))
+
+        # Too many keys pending, flushed without waiting for the interval
+        assert flushed == ['0', '1', '2']
+        conflater.close()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
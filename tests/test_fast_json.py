@@ -0,0 +1,45 @@
+'''Test the json backend
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import json
+import math
+
+import pytest
+from cobras.common.fast_json import JSONDecodeError, dumps, loads
+
+
+def test_loads():
+    pdu = {'action': 'rtm/publish', 'body': {'message': {'unicode': 'é', 'i': 1}}}
+    data = json.dumps(pdu)
+
+    assert loads(data) == pdu
+    assert loads(data.encode()) == pdu
+
+    # Not supported by every backend
+    assert loads(str(2**70)) == 2**70
+    assert math.isnan(loads('NaN'))
+
+    for data in ('{"action":', b'{"action":', b'\xff'):
+        with pytest.raises(ValueError):
+            loads(data)
+
+    with pytest.raises(JSONDecodeError):
+        loads('{"action":')
+
+
+def test_dumps():
+    for obj in ({'foo': ['bar', 1.5, None, True]}, {1: 'one'}, 2**70, 'é'):
+        assert json.loads(dumps(obj)) == json.loads(json.dumps(obj))
+
+    with pytest.raises(TypeError):
+        dumps({'foo': object()})
+
+    # Not turned into null
+    for obj in ({'a': float('nan')}, [None, float('inf')], {'b': [-float('inf')]}):
+        assert dumps(obj) == json.dumps(obj)
+
+    assert dumps({'b': 1, 'a': [None]}, sortKeys=True).replace(' ', '') == (
+        '{"a":[null],"b":1}'
+    )
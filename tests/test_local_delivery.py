@@ -0,0 +1,142 @@
+'''Test the delivery of messages published on the node of their subscribers
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import os
+
+import pytest
+
+from cobras.client.connection import ActionFlow, Connection
+from cobras.client.credentials import (
+    createCredentials,
+    getDefaultRoleForApp,
+    getDefaultSecretForApp,
+)
+from cobras.client.health_check import getDefaultHealthCheckUrl
+from cobras.common.fast_json import dumps
+from cobras.server.subscription_hub import StreamEntry, StreamReader
+
+from .test_utils import makeRunner, makeUniqueString
+
+
+class FakeSubscriber:
+    def __init__(self):
+        self.received = []
+
+    async def handleEntries(self, batch):
+        for entry in batch.entries:
+            self.received.append((entry.message(), entry.position))
+        return True
+
+
+def makeEntry(message, position):
+    pdu = dumps({'action': 'rtm/publish', 'body': {'message': message}})
+    return StreamEntry(None, position, len(pdu), pdu, dumps(message))
+
+
+def makeResult(message, position):
+    pdu = dumps({'action': 'rtm/publish', 'body': {'message': message}}).encode()
+    return (position.encode(), {b'json': pdu})
+
+
+def test_stream_reader_local_entries():
+    async def coroutine():
+        reader = StreamReader(None, 'stream')
+        reader.lastReadId = (2, 0)
+
+        subscriber = FakeSubscriber()
+        reader.subscribers.add(subscriber)
+        task = asyncio.ensure_future(reader.readStream())
+
+        # Published on this node
+        reader.addLocalEntries([makeEntry('a', '5-0')])
+
+        # XREAD catches up, with an older entry published on another node
+        reader.onStreamEntries([makeResult('b', '3-0'), makeResult('a', '5-0')])
+        reader.onStreamEntries([makeResult('c', '6-0')])
+
+        # Already read
+        reader.addLocalEntries([makeEntry('c', '6-0')])
+        await asyncio.sleep(0.01)
+
+        # Delivered once, and positions never go backwards
+        assert subscriber.received == [('a', '5-0'), ('b', '5-0'), ('c', '6-0')]
+        assert not reader.localPositions
+
+        task.cancel()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+class MessageHandlerClass:
+    def __init__(self, connection, args):
+        self.connection = connection
+        self.count = args['count']
+        self.messages = []
+
+    async def on_init(self):
+        pass
+
+    async def handleMsg(self, messages, position):
+        self.messages.extend(messages)
+        if len(self.messages) >= self.count:
+            return ActionFlow.STOP
+
+        return ActionFlow.CONTINUE
+
+
+@pytest.fixture()
+def runner():
+    runner, appsConfigPath = makeRunner(debugMemory=False)
+    runner.app['apps_config'].apps['_health']['local_delivery'] = True
+    yield runner
+
+    runner.terminate()
+    os.unlink(appsConfigPath)
+
+
+def test_local_delivery(runner):
+    url = getDefaultHealthCheckUrl(None, runner.port)
+    role = getDefaultRoleForApp('health')
+    secret = getDefaultSecretForApp('health')
+    creds = createCredentials(role, secret)
+
+    hub = runner.app['subscription_hub']
+    delivered = []
+    deliverLocal = hub.deliverLocal
+
+    def spy(streams, *args):
+        delivered.extend(streams)
+        deliverLocal(streams, *args)
+
+    hub.deliverLocal = spy
+
+    async def coroutine():
+        channel = makeUniqueString()
+        messages = [{'seq': i} for i in range(3)]
+
+        subscriber = Connection(url, creds)
+        await subscriber.connect()
+        task = asyncio.ensure_future(
+            subscriber.subscribe(
+                channel, None, None, MessageHandlerClass, {'count': 3}, channel
+            )
+        )
+        while channel not in subscriber.subscriptions:
+            await asyncio.sleep(0.01)
+
+        publisher = Connection(url, creds)
+        await publisher.connect()
+        for message in messages:
+            await publisher.publish(channel, message)
+
+        handler = await asyncio.wait_for(task, 5)
+        assert handler.messages == messages
+        assert delivered == [f'_health::{channel}'] * 3
+
+        await publisher.close()
+        await subscriber.close()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
@@ -0,0 +1,96 @@
+'''Test the pdu encodings
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import json
+
+import pytest
+from cobras.common.pdu_codecs import (
+    CBOR_SUBPROTOCOL,
+    JSON_CODEC,
+    JSON_SUBPROTOCOL,
+    SUBPROTOCOLS,
+    encodeCborArrayHeader,
+    getCodec,
+)
+from cobras.server.app import ServerProtocol
+
+try:
+    import cbor2
+except ImportError:  # cbor is optional
+    cbor2 = None
+
+
+def makeSubscriptionData(codec, messages):
+    return codec.encodeSubscriptionData(
+        3,
+        codec.encodeValue('sub'),
+        [codec.encodeValue(message) for message in messages],
+        codec.encodeValue('1-0'),
+    )
+
+
+def subscriptionData(messages):
+    return {
+        'action': 'rtm/subscription/data',
+        'id': 3,
+        'body': {'subscription_id': 'sub', 'messages': messages, 'position': '1-0'},
+    }
+
+
+def test_json_codec():
+    assert getCodec(None) is JSON_CODEC
+    assert getCodec('json') is JSON_CODEC
+
+    with pytest.raises(ValueError):
+        getCodec('xml')
+
+    messages = [{'foo': 'bar'}, 1]
+    data = makeSubscriptionData(JSON_CODEC, messages)
+    assert json.loads(data) == subscriptionData(messages)
+
+
+def test_codec_negotiation():
+    # json is always offered, cbor when cbor2 is installed
+    assert SUBPROTOCOLS[0] == JSON_SUBPROTOCOL
+    assert (CBOR_SUBPROTOCOL in SUBPROTOCOLS) == (cbor2 is not None)
+    if cbor2 is None:
+        with pytest.raises(ValueError):
+            getCodec(CBOR_SUBPROTOCOL)
+
+    # The first encoding the client asked for that the server supports
+    select = ServerProtocol.select_subprotocol
+    assert select(None, ['xml', 'json'], SUBPROTOCOLS) == 'json'
+    assert select(None, ['cbor', 'json'], ['json']) == 'json'
+    assert select(None, ['xml'], SUBPROTOCOLS) is None
+
+
+def test_cbor_codec():
+    pytest.importorskip('cbor2')
+
+    codec = getCodec('cbor')
+    assert codec.binary
+
+    pdu = {'action': 'rtm/publish', 'body': {'message': {'data': b'\x00', 'i': 1}}}
+    assert codec.decode(codec.encode(pdu)) == pdu
+
+    # Text frame, truncated map, reserved type
+    for data in ('{"action": "rtm/publish"}', b'\xa3', b'\x1c'):
+        with pytest.raises(ValueError):
+            codec.decode(data)
+
+    # Assembled from the encoded messages, in any array size
+    for count in (0, 1, 23, 24, 255, 256, 70000):
+        messages = [{'i': i} for i in range(count)]
+        data = makeSubscriptionData(codec, messages)
+        assert data == cbor2.dumps(subscriptionData(messages))
+
+
+def test_cbor_array_header():
+    assert encodeCborArrayHeader(2 ** 32) == b'\x9b\x00\x00\x00\x01\x00\x00\x00\x00'
+
+    pytest.importorskip('cbor2')
+    for length in (0, 23, 24, 255, 256, 65535, 65536):
+        items = cbor2.dumps([None] * length)
+        assert encodeCborArrayHeader(length) == items[: len(items) - length]
@@ -0,0 +1,133 @@
+'''Test the batch publish mode
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import json
+
+from cobras.server.pipelined_publisher import PipelinedPublisher
+from cobras.server.rcc_client import RedisClientRcc
+
+from .test_utils import makeUniqueString
+
+
+def makeJob(streams, i):
+    message = {'i': i}
+    pdu = json.dumps({'action': 'rtm/publish', 'body': {'message': message}})
+    return (streams, pdu, json.dumps(message))
+
+
+async def lastMessages(client, stream, count):
+    items = await client.xrevrange(stream, '+', '-', count)
+    return [json.loads(fields[b'message']) for position, fields in reversed(items)]
+
+
+def test_batch_publish_size():
+    async def coroutine():
+        client = RedisClientRcc('redis://localhost', None, False)
+        publisher = PipelinedPublisher(client, batchSize=3, maxLinger=60)
+
+        streams = [makeUniqueString(), makeUniqueString()]
+
+        # Concurrent publishers share the pipeline, flushed when full
+        jobs = [publisher.submit(makeJob(streams, i), True) for i in range(3)]
+        results = await asyncio.wait_for(asyncio.gather(*jobs), 5)
+
+        for streamIds in results:
+            assert len(streamIds) == 2
+
+        for stream in streams:
+            assert await lastMessages(client, stream, 10) == [
+                {'i': 0},
+                {'i': 1},
+                {'i': 2},
+            ]
+            await client.delete(stream)
+
+        await publisher.close()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+class FailingClient(RedisClientRcc):
+    def makeEntries(self, streams, data, serializedMessage):
+        if data == 'bad':
+            raise ValueError('cannot encode')
+
+        return super().makeEntries(streams, data, serializedMessage)
+
+
+def test_batch_publish_error():
+    async def coroutine():
+        client = FailingClient('redis://localhost', None, False)
+        publisher = PipelinedPublisher(client, batchSize=2, maxLinger=60)
+
+        stream = makeUniqueString()
+
+        # The whole batch fails, instead of waiting forever
+        jobs = [
+            publisher.submit(makeJob([stream], 0), True),
+            publisher.submit(([stream], 'bad', '{}'), True),
+        ]
+        results = await asyncio.wait_for(
+            asyncio.gather(*jobs, return_exceptions=True), 5
+        )
+        assert all(isinstance(result, ValueError) for result in results)
+        assert await client.exists(stream) == 0
+
+        await publisher.close()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+def test_batch_publish_max_linger():
+    async def coroutine():
+        client = RedisClientRcc('redis://localhost', None, False)
+        publisher = PipelinedPublisher(client, batchSize=100, maxLinger=0.05)
+
+        stream = makeUniqueString()
+
+        task = asyncio.ensure_future(publisher.submit(makeJob([stream], 0), True))
+        await asyncio.sleep(0.01)
+        assert not task.done()
+        assert await client.exists(stream) == 0
+
+        # Not full, flushed by the linger timer
+        await asyncio.wait_for(task, 5)
+        assert await lastMessages(client, stream, 10) == [{'i': 0}]
+
+        # Without batch publish, written right away
+        await publisher.submit(makeJob([stream], 1))
+        assert await lastMessages(client, stream, 10) == [{'i': 0}, {'i': 1}]
+
+        await client.delete(stream)
+        await publisher.close()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+def test_publish_order():
+    async def coroutine():
+        client = RedisClientRcc('redis://localhost', None, False)
+        publisher = PipelinedPublisher(client)
+
+        streams = [makeUniqueString(), makeUniqueString()]
+
+        # Nothing serializes the publishing tasks, the jobs are still written
+        # in the order they were submitted
+        count = 50
+        jobs = [publisher.submit(makeJob(streams, i)) for i in range(count)]
+        jobs.append(publisher.submitMany([makeJob(streams, count)]))
+        jobs.append(publisher.submit(makeJob(streams, count + 1)))
+        await asyncio.wait_for(asyncio.gather(*jobs), 5)
+
+        for stream in streams:
+            assert await lastMessages(client, stream, 100) == [
+                {'i': i} for i in range(count + 2)
+            ]
+            await client.delete(stream)
+
+        await publisher.close()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
@@ -0,0 +1,122 @@
+'''Test idempotent publishes
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+
+from cobras.server.publish_dedup import (
+    PublishDeduplicator,
+    RedisPublishDeduplicator,
+    getDedupKey,
+)
+from cobras.server.rcc_client import RedisClientRcc
+
+from .test_utils import makeUniqueString
+
+
+def test_dedup_key():
+    assert getDedupKey({'message_id': 12}, '{"foo": "bar"}') == 'id:12'
+
+    key = getDedupKey({}, '{"foo": "bar"}')
+    assert key == getDedupKey({'message': 'ignored'}, '{"foo": "bar"}')
+    assert key != getDedupKey({}, '{"foo": "baz"}')
+
+
+def test_dedup_memory():
+    async def coroutine():
+        deduplicator = PublishDeduplicator(window=0.1, maxKeys=2)
+
+        assert await deduplicator.claim(['a', 'b'], 'k1') == [True, True]
+        assert await deduplicator.claim(['a', 'c'], 'k1') == [False, True]
+
+        # Failed publishes can be retried
+        await deduplicator.release(['c'], 'k1')
+        assert await deduplicator.claim(['c'], 'k1') == [True]
+
+        # Bounded per channel, the oldest key is forgotten first
+        assert await deduplicator.claim(['a'], 'k2') == [True]
+        assert await deduplicator.claim(['a'], 'k3') == [True]
+        assert await deduplicator.claim(['a'], 'k1') == [True]
+
+        # Forgotten after the window
+        assert await deduplicator.claim(['b'], 'k1') == [False]
+        await asyncio.sleep(0.2)
+        assert await deduplicator.claim(['b'], 'k1') == [True]
+
+        # Idle channels are swept
+        assert 'c' not in deduplicator.seen
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+def test_dedup_redis():
+    async def coroutine():
+        client = RedisClientRcc('redis://localhost', None, False)
+
+        # Two nodes sharing the same redis
+        deduplicators = [RedisPublishDeduplicator(client, window=60) for i in range(2)]
+
+        stream = makeUniqueString()
+        key = makeUniqueString()
+
+        assert await deduplicators[0].claim([stream], key) == [True]
+        assert await deduplicators[1].claim([stream], key) == [False]
+
+        await deduplicators[0].release([stream], key)
+        assert await deduplicators[1].claim([stream], key) == [True]
+        await deduplicators[1].release([stream], key)
+
+        # Many streams at once, some of them already claimed
+        streams = [makeUniqueString() for i in range(4)]
+        assert await deduplicators[0].claim(streams[:2], key) == [True, True]
+        assert await deduplicators[1].claim(streams, key) == [False, False, True, True]
+
+        await deduplicators[1].release(streams, key)
+        assert await deduplicators[0].claim(streams, key) == [True] * 4
+        await deduplicators[0].release(streams, key)
+
+        for stream in streams:
+            assert await client.exists(f'dedup::{stream}::{key}') == 0
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+class CountingClient:
+    '''Counts the pipelined round-trips'''
+
+    def __init__(self, client):
+        self.client = client
+        self.roundTrips = 0
+
+    async def setManyIfNotExists(self, keys, ttlMs):
+        self.roundTrips += 1
+        return await self.client.setManyIfNotExists(keys, ttlMs)
+
+    async def deleteMany(self, keys):
+        self.roundTrips += 1
+        return await self.client.deleteMany(keys)
+
+
+def test_dedup_claim_many():
+    async def coroutine():
+        memory = PublishDeduplicator(window=60, maxKeys=10)
+        client = CountingClient(RedisClientRcc('redis://localhost', None, False))
+        redis = RedisPublishDeduplicator(client, window=60)
+
+        streams = [makeUniqueString() for i in range(2)]
+        key = makeUniqueString()
+
+        # The same message twice in a batch is only claimed once
+        claims = [(streams, key), (streams[:1], key), ([streams[1]], key + 'x')]
+        expected = [[True, True], [False], [True]]
+        for deduplicator in (memory, redis):
+            assert await deduplicator.claimMany(claims) == expected
+            await deduplicator.releaseMany(claims)
+            assert await deduplicator.claimMany(claims) == expected
+            await deduplicator.releaseMany(claims)
+
+        # One round-trip for the whole batch
+        assert client.roundTrips == 4
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
@@ -3,16 +3,27 @@
 # TODO: test subscribe better
 
 import asyncio
+import hashlib
+import json
 import os
 
 import pytest
-from cobras.client.connection import ActionException, Connection
+from cobras.client.connection import ActionException, ActionFlow, Connection
 from cobras.client.credentials import (
     createCredentials,
     getDefaultRoleForApp,
     getDefaultSecretForApp,
 )
 from cobras.client.health_check import getDefaultHealthCheckUrl
+from cobras.common import fast_json
+from cobras.common.apps_config import AppsConfig
+from cobras.common.fast_json import dumps
+from cobras.common.pdu_codecs import SUBSCRIPTION_DATA_TEMPLATE
+from cobras.server.connection_state import ConnectionState
+from cobras.server.handlers.pubsub import MessageHandlerClass
+from cobras.server.stats import ServerStats
+from cobras.server.stream_sql import getStreamSqlFilter
+from cobras.server.subscription_hub import StreamBatch, StreamEntry, StreamReader
 
 from .test_utils import makeRunner, makeUniqueString
 
@@ -74,6 +85,97 @@ def test_publish(runner):
     asyncio.get_event_loop().run_until_complete(clientCoroutine(connection))
 
 
+async def publishNoAckCoroutine(connection):
+    await connection.connect()
+    assert not connection.publishAck
+
+    channel = makeUniqueString()
+    for i in range(10):
+        await connection.publish(channel, {"i": i})
+
+    # Only errors are sent back
+    pdu = {"action": "rtm/publish", "body": {"message": "hello", "ack": False}}
+    with pytest.raises(ActionException):
+        await connection.send(pdu)
+
+    # The stored publish pdu
+    pdu = await connection.read(channel)
+    assert pdu['body']['message'] == {"i": 9}
+    assert len(connection.queues) == 0
+
+    # Per pdu
+    await connection.publishNoAck(None, 'hello world')
+    await asyncio.sleep(0.1)
+
+    errors = connection.getPublishErrors()
+    assert len(errors) == 1
+    assert errors[0]['action'] == 'rtm/publish/error'
+    assert connection.getPublishErrors() == []
+
+    await connection.close()
+
+
+def test_publish_no_ack(runner):
+    port = runner.port
+
+    url = getDefaultHealthCheckUrl(None, port)
+    role = getDefaultRoleForApp('health')
+    secret = getDefaultSecretForApp('health')
+
+    creds = createCredentials(role, secret)
+    connection = Connection(url, creds, publishAck=False)
+
+    asyncio.get_event_loop().run_until_complete(publishNoAckCoroutine(connection))
+
+
+async def publishBatchCoroutine(connection):
+    await connection.connect()
+
+    channel = makeUniqueString()
+    messages = [{"seq": i} for i in range(3)]
+
+    body = await connection.publishBatch(channel, messages)
+    assert body == {'channels': [channel], 'count': 3}
+
+    # Stored one by one, the last message comes last
+    pdu = await connection.read(channel)
+    assert pdu['body']['message'] == {"seq": 2}
+
+    # Many pdus in one frame
+    responses = await connection.sendBatch(
+        [
+            {"action": "rtm/publish", "body": {"channel": channel, "message": 3}},
+            {"action": "rtm/read", "body": {"channel": channel}},
+        ]
+    )
+    assert [data['action'] for data in responses] == [
+        'rtm/publish/ok',
+        'rtm/read/ok',
+    ]
+    assert responses[1]['body']['message']['body']['message'] == 3
+
+    with pytest.raises(ActionException):
+        await connection.publishBatch(channel, [])
+
+    with pytest.raises(ActionException):
+        await connection.publishBatch(channel, messages, messageIds=[1])
+
+    await connection.close()
+
+
+def test_publish_batch(runner):
+    port = runner.port
+
+    url = getDefaultHealthCheckUrl(None, port)
+    role = getDefaultRoleForApp('health')
+    secret = getDefaultSecretForApp('health')
+
+    creds = createCredentials(role, secret)
+    connection = Connection(url, creds)
+
+    asyncio.get_event_loop().run_until_complete(publishBatchCoroutine(connection))
+
+
 async def redisDownClientCoroutine(connection):
     await connection.connect()
 
@@ -144,6 +246,30 @@ def test_subscribe(runner):
     asyncio.get_event_loop().run_until_complete(subscribeClientCoroutine(connection))
 
 
+@pytest.mark.parametrize('batchSize', [0, -1, 'foo'])
+def test_subscribe_invalid_batch_size(runner, batchSize):
+    url = getDefaultHealthCheckUrl(None, runner.port)
+    role = getDefaultRoleForApp('health')
+    secret = getDefaultSecretForApp('health')
+
+    creds = createCredentials(role, secret)
+    connection = Connection(url, creds)
+
+    async def coroutine():
+        await connection.connect()
+
+        pdu = {
+            "action": "rtm/subscribe",
+            "body": {'channel': 'foo', 'batch_size': batchSize},
+        }
+        with pytest.raises(ActionException):
+            await connection.send(pdu)
+
+        await connection.close()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
 async def unsubscribeClientCoroutine(connection):
     await connection.connect()
 
@@ -175,3 +301,309 @@ def test_unsubscribe(runner):
     connection = Connection(url, creds)
 
     asyncio.get_event_loop().run_until_complete(unsubscribeClientCoroutine(connection))
+
+
+class SharedReaderMessageHandlerClass:
+    def __init__(self, connection, args):
+        self.connection = connection
+        self.args = args
+        self.messages = []
+
+    async def on_init(self):
+        pass
+
+    async def handleMsg(self, messages, position):
+        self.messages.extend(messages)
+        return ActionFlow.STOP
+
+
+async def waitFor(predicate, timeout=5):
+    for i in range(int(timeout / 0.01)):
+        if predicate():
+            return True
+        await asyncio.sleep(0.01)
+
+    return predicate()
+
+
+async def sharedReaderClientCoroutine(url, creds, hub):
+    channel = makeUniqueString()
+
+    subscribers = [Connection(url, creds) for i in range(3)]
+    tasks = []
+    for connection in subscribers:
+        await connection.connect()
+        task = asyncio.ensure_future(
+            connection.subscribe(
+                channel, None, None, SharedReaderMessageHandlerClass, {}, channel
+            )
+        )
+        tasks.append(task)
+
+    assert await waitFor(
+        lambda: all(channel in conn.subscriptions for conn in subscribers)
+    )
+
+    # One redis reader for all the subscribers of that channel
+    assert hub.readersCount() == 1
+
+    publisher = Connection(url, creds)
+    await publisher.connect()
+    data = {"foo": makeUniqueString()}
+    await publisher.publish(channel, data)
+
+    messageHandlers = await asyncio.wait_for(asyncio.gather(*tasks), 5)
+    for messageHandler in messageHandlers:
+        assert messageHandler.messages == [data]
+
+    # The reader goes away with its last subscriber
+    assert await waitFor(lambda: hub.readersCount() == 0)
+
+    await publisher.close()
+    for connection in subscribers:
+        await connection.close()
+
+
+def test_subscribe_shared_reader(runner):
+    port = runner.port
+
+    url = getDefaultHealthCheckUrl(None, port)
+    role = getDefaultRoleForApp('health')
+    secret = getDefaultSecretForApp('health')
+
+    creds = createCredentials(role, secret)
+    hub = runner.app['subscription_hub']
+
+    asyncio.get_event_loop().run_until_complete(
+        sharedReaderClientCoroutine(url, creds, hub)
+    )
+
+
+def test_subscription_data_template():
+    msg = {'action': 'rtm/publish', 'body': {'message': {'foo': ['bar', 1]}}}
+    entry = StreamEntry(msg, '1591838273452-0', 42)
+
+    pdu = {
+        "action": "rtm/subscription/data",
+        "id": 3,
+        "body": {
+            "subscription_id": 'sub"id',
+            "messages": [entry.message(), entry.message()],
+            "position": entry.position,
+        },
+    }
+
+    serializedPdu = SUBSCRIPTION_DATA_TEMPLATE.format(
+        3,
+        json.dumps('sub"id'),
+        ', '.join([entry.encodedMessage(), entry.encodedMessage()]),
+        entry.encodedPosition(),
+    )
+    assert json.loads(serializedPdu) == pdu
+
+    # Byte for byte, with the standard library encoder
+    if fast_json.BACKEND == 'json':
+        assert serializedPdu == json.dumps(pdu)
+
+    # The message is only serialized once
+    assert entry.encodedMessage() is entry.encodedMessage()
+
+
+def test_stream_batch_filter():
+    def makeEntry(message, position):
+        msg = {'action': 'rtm/publish', 'body': {'message': message}}
+        return StreamEntry(msg, position, 42)
+
+    batch = StreamBatch(
+        [
+            makeEntry({'game': 'miso'}, '1-0'),
+            makeEntry({'game': 'ody'}, '2-0'),
+            makeEntry(
+                {'messages': [{'game': 'miso', 'id': 1}, {'game': 'miso'}]}, '3-0'
+            ),
+        ]
+    )
+
+    streamSqlFilter = getStreamSqlFilter("SELECT * FROM blah WHERE game = 'miso'")
+    results = batch.match(streamSqlFilter)
+    assert [(entry.position, message) for entry, _, message in results] == [
+        ('1-0', dumps({"game": "miso"})),
+        ('3-0', dumps({"game": "miso", "id": 1})),
+        ('3-0', dumps({"game": "miso"})),
+    ]
+
+    # Subscribers sharing the filter share the results
+    assert batch.match(streamSqlFilter) is results
+
+
+def test_stream_entry_passthrough():
+    message = {'foo': ['bar', 1], 'unicode': 'é'}
+    pdu = {'action': 'rtm/publish', 'body': {'channel': 'c', 'message': message}}
+    data = json.dumps(pdu).encode()
+    sha1 = hashlib.sha1(data).hexdigest().encode()
+
+    reader = StreamReader(None, 'stream')
+    entries = reader.decodeEntries(
+        [
+            (b'1-0', {b'json': data, b'sha1': sha1}),
+            (b'2-0', {b'json': data, b'sha1': sha1, b'message': b'{"raw": 1}'}),
+        ]
+    )
+
+    # Entries stored before the message field existed are decoded
+    assert entries[0].encodedMessage() == dumps(message)
+
+    # The raw message is forwarded, without decoding the publish pdu
+    assert entries[1].encodedMessage() == '{"raw": 1}'
+    assert entries[1].decodedMsg is None
+
+    # ... which is still available, for filters
+    assert entries[1].message() == message
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.frames = []
+        self.transport = None
+
+    async def send(self, frame):
+        self.frames.append(frame)
+
+
+def test_unfiltered_delivery_passthrough():
+    pdu = {'action': 'rtm/publish', 'body': {'channel': 'c', 'message': {'a': 1}}}
+    data = json.dumps(pdu).encode()
+
+    async def coroutine():
+        ws = FakeWebSocket()
+        handler = MessageHandlerClass(
+            {
+                'ws': ws,
+                'subscription_id': 'c',
+                'has_filter': False,
+                'stream_sql_filter': None,
+                'appkey': 'appkey',
+                'stats': ServerStats(None, 'appkey'),
+                'state': ConnectionState('appkey', 'test'),
+                'subscribe_response': None,
+                'app': {'apps_config': AppsConfig('/does/not/exist.yaml')},
+                'channel': 'c',
+                'batch_size': 1,
+                'batch_max_bytes': None,
+                'batch_max_linger': None,
+                'batch_adaptive': False,
+                'conflate_key': None,
+                'conflate_interval': None,
+            }
+        )
+
+        entry = StreamEntry(None, '1-0', len(data), data, '{"raw": 1}')
+        assert await handler.handleEntries(StreamBatch([entry]))
+        await asyncio.sleep(0.01)
+
+        # The stored message is sent as is, the publish pdu is never decoded
+        assert len(ws.frames) == 1
+        assert '{"raw": 1}' in ws.frames[0]
+        assert entry.decodedMsg is None
+
+        handler.close()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+async def cborClientCoroutine(url, creds):
+    subscriber = Connection(url, creds, encoding='cbor')
+    await subscriber.connect()
+    assert subscriber.websocket.subprotocol == 'cbor'
+
+    publisher = Connection(url, creds)
+    await publisher.connect()
+    assert publisher.websocket.subprotocol == 'json'
+
+    channel = makeUniqueString()
+    fsqlFilter = f"SELECT data FROM `{channel}` WHERE data.i > 0"
+
+    task = asyncio.ensure_future(
+        subscriber.subscribe(
+            channel, None, fsqlFilter, SharedReaderMessageHandlerClass, {}, channel
+        )
+    )
+    assert await waitFor(lambda: channel in subscriber.subscriptions)
+
+    await publisher.publish(channel, {"data": {"i": 0}})
+    await subscriber.publish(channel, {"data": {"i": 1}})
+
+    messageHandler = await asyncio.wait_for(task, 5)
+    assert messageHandler.messages == [{"data": {"i": 1}}]
+
+    await publisher.close()
+    await subscriber.close()
+
+
+def test_cbor_encoding(runner):
+    pytest.importorskip('cbor2')
+
+    port = runner.port
+
+    url = getDefaultHealthCheckUrl(None, port)
+    role = getDefaultRoleForApp('health')
+    secret = getDefaultSecretForApp('health')
+
+    creds = createCredentials(role, secret)
+
+    asyncio.get_event_loop().run_until_complete(cborClientCoroutine(url, creds))
+
+
+async def multiplexedClientCoroutine(url, creds, multiplexer):
+    connection = Connection(url, creds)
+    await connection.connect()
+
+    publisher = Connection(url, creds)
+    await publisher.connect()
+
+    # Each subscription is added while the multiplexed XREAD is blocked,
+    # and needs to be re-armed
+    # In cluster mode the streams of a node span several slots
+    channels = [makeUniqueString() for i in range(10)]
+    tasks = []
+    for channel in channels:
+        task = asyncio.ensure_future(
+            connection.subscribe(
+                channel, None, None, SharedReaderMessageHandlerClass, {}, channel
+            )
+        )
+        tasks.append(task)
+        assert await waitFor(lambda: channel in connection.subscriptions)
+
+    # All the streams of a redis node are read with a single connection
+    nodes = {multiplexer.groupKey(stream) for stream in multiplexer.streams}
+    assert multiplexer.groupsCount() == len(nodes)
+    if not multiplexer.cluster:
+        assert len(nodes) == 1
+
+    for channel in channels:
+        await publisher.publish(channel, {"channel": channel})
+
+    messageHandlers = await asyncio.wait_for(asyncio.gather(*tasks), 5)
+    for channel, messageHandler in zip(channels, messageHandlers):
+        assert messageHandler.messages == [{"channel": channel}]
+
+    assert await waitFor(lambda: multiplexer.groupsCount() == 0)
+
+    await publisher.close()
+    await connection.close()
+
+
+def test_subscribe_multiplexed(runner):
+    port = runner.port
+
+    url = getDefaultHealthCheckUrl(None, port)
+    role = getDefaultRoleForApp('health')
+    secret = getDefaultSecretForApp('health')
+
+    creds = createCredentials(role, secret)
+    multiplexer = runner.app['stream_multiplexer']
+
+    asyncio.get_event_loop().run_until_complete(
+        multiplexedClientCoroutine(url, creds, multiplexer)
+    )
@@ -0,0 +1,47 @@
+'''Test the rcc redis client wrapper
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import json
+from hashlib import sha1
+
+from cobras.server.rcc_client import RedisClientRcc, packCommand
+
+from .test_utils import makeUniqueString
+
+
+def test_pack_command():
+    assert packCommand('XADD', b'foo', 12) == (
+        b'*3\r\n$4\r\nXADD\r\n$3\r\nfoo\r\n$2\r\n12\r\n'
+    )
+
+
+async def xaddMessagesCoroutine():
+    client = RedisClientRcc('redis://localhost', None, False)
+
+    streams = [makeUniqueString() for i in range(5)]
+    message = {'foo': 'bar'}
+    pdu = json.dumps({'action': 'rtm/publish', 'body': {'message': message}})
+
+    streamIds = await client.xaddMessages(streams, pdu, json.dumps(message), 10)
+    assert len(streamIds) == len(streams)
+
+    for stream, streamId in zip(streams, streamIds):
+        items = await client.xrevrange(stream, '+', '-', 1)
+        position, fields = items[0]
+
+        assert position == streamId
+        assert fields[b'json'] == pdu.encode()
+        assert fields[b'sha1'] == sha1(pdu.encode()).hexdigest().encode()
+        assert fields[b'message'] == b'{"foo": "bar"}'
+
+        await client.delete(stream)
+
+    # The connection is still usable for regular commands
+    assert await client.ping()
+
+
+def test_xadd_messages():
+    asyncio.get_event_loop().run_until_complete(xaddMessagesCoroutine())
@@ -0,0 +1,78 @@
+'''Test the redis client pool
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+
+import pytest
+
+from cobras.server import redis_pool
+from cobras.server.rcc_client import RedisClientRcc
+from cobras.server.redis_pool import RedisPool
+
+from .test_utils import makeUniqueString
+
+
+def makeClient():
+    return RedisClientRcc('redis://localhost', None, False)
+
+
+def test_redis_pool(monkeypatch):
+    async def coroutine():
+        pool = RedisPool(makeClient, maxSize=2)
+        await pool.warm()
+        assert len(pool.idle) == 2
+        assert all(client.connected() for client, _ in pool.idle)
+
+        # Clients are reused
+        clients = {client for client, _ in pool.idle}
+        async with pool.client() as redis:
+            assert redis in clients
+            assert await redis.exists(makeUniqueString()) == 0
+
+        # Bounded, a third user waits for a client to be released
+        inUse = 0
+        maxInUse = 0
+
+        async def use():
+            nonlocal inUse, maxInUse
+            async with pool.client() as redis:
+                inUse += 1
+                maxInUse = max(maxInUse, inUse)
+                await redis.ping()
+                await asyncio.sleep(0.01)
+                inUse -= 1
+
+        await asyncio.gather(*[use() for _ in range(6)])
+        assert maxInUse == 2
+        assert {client for client, _ in pool.idle} == clients
+
+        # Clients which hit an error are dropped
+        with pytest.raises(Exception):
+            async with pool.client() as redis:
+                await redis.redis.send('NOT_A_COMMAND')
+
+        assert len(pool.idle) == 1
+
+        # Idle clients are checked before being reused
+        monkeypatch.setattr(redis_pool, 'HEALTH_CHECK_INTERVAL', 0)
+        client, _ = pool.idle[0]
+        client.close()
+        async with pool.client() as redis:
+            assert redis is not client
+            assert await redis.ping()
+
+        pool.close()
+        assert not pool.idle
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+def test_redis_pool_redis_down():
+    async def coroutine():
+        pool = RedisPool(lambda: RedisClientRcc('redis://localhost:9999', None, False))
+        await pool.warm()
+        assert not pool.idle
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
@@ -0,0 +1,141 @@
+'''Test the routing of subscriptions and reads to redis replicas
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import os
+import time
+
+import pytest
+
+from cobras.client.connection import Connection
+from cobras.client.credentials import (
+    createCredentials,
+    getDefaultRoleForApp,
+    getDefaultSecretForApp,
+)
+from cobras.client.health_check import getDefaultHealthCheckUrl
+from cobras.server.replica_routing import (
+    READ_FROM_REPLICA,
+    READ_FROM_REPLICA_MAX_LAG,
+    ReplicaRouter,
+    parseInfo,
+    parseReplicas,
+)
+from cobras.server.shard_ring import ShardRing
+
+from .test_pubsub import SharedReaderMessageHandlerClass, waitFor
+from .test_utils import makeRunner, makeUniqueString
+
+INFO = b'''# Replication\r
+role:master\r
+connected_slaves:3\r
+slave0:ip=10.0.0.2,port=6379,state=online,offset=4230,lag=1\r
+slave1:ip=10.0.0.3,port=6380,state=online,offset=4100,lag=0\r
+slave2:ip=10.0.0.4,port=6379,state=wait_bgsave,offset=0,lag=0\r
+master_repl_offset:4230\r
+'''
+
+
+def test_parse_replicas():
+    info = parseInfo(INFO)
+    assert info['role'] == 'master'
+    # Lags are offset differences, whatever the age of the last ack
+    assert parseReplicas(info) == [
+        ('redis://10.0.0.2:6379', 0),
+        ('redis://10.0.0.3:6380', 130),
+    ]
+
+    assert parseReplicas(parseInfo('# Replication\r\nrole:master\r\n')) == []
+
+
+@pytest.mark.parametrize(
+    'policy,replicas',
+    [
+        (READ_FROM_REPLICA, {'redis://10.0.0.2:6379', 'redis://10.0.0.3:6380'}),
+        (READ_FROM_REPLICA_MAX_LAG, {'redis://10.0.0.2:6379'}),
+    ],
+)
+def test_replica_router(policy, replicas):
+    masters = ShardRing(['redis://redis1', 'redis://redis2'])
+    router = ReplicaRouter(masters, None, False, policy, maxLag=100)
+
+    # Do not list the replicas of these fake servers
+    router.refreshedAt = time.monotonic()
+    router.update({'redis://redis1': parseReplicas(parseInfo(INFO))})
+
+    keys = [f'_health::channel_{i}' for i in range(100)]
+    for key in keys:
+        url = router.getUrl(key)
+        if masters.getUrl(key) == 'redis://redis1':
+            assert url in replicas
+        else:
+            # No replica, the master serves its reads
+            assert url == 'redis://redis2'
+
+        # The same replica every time
+        assert router.getUrl(key) == url
+
+    assert {router.getReplicaUrl('redis://redis1', i) for i in range(4)} == replicas
+
+    with pytest.raises(ValueError):
+        ReplicaRouter(masters, None, False, 'master')
+
+
+@pytest.fixture()
+def runner():
+    runner, appsConfigPath = makeRunner(
+        debugMemory=False, redisReadFrom=READ_FROM_REPLICA
+    )
+    yield runner
+
+    runner.terminate()
+    os.unlink(appsConfigPath)
+
+
+def test_read_from_replica(runner):
+    url = getDefaultHealthCheckUrl(None, runner.port)
+    role = getDefaultRoleForApp('health')
+    secret = getDefaultSecretForApp('health')
+    creds = createCredentials(role, secret)
+
+    # A stand-in replica, which happens to be the master
+    readRouter = runner.app['redis_clients'].readRouter
+    readRouter.refreshedAt = time.monotonic()
+    readRouter.update({readRouter.url: [('redis://127.0.0.1:6379', 0)]})
+
+    multiplexer = runner.app['stream_multiplexer']
+
+    async def coroutine():
+        subscriber = Connection(url, creds)
+        await subscriber.connect()
+
+        publisher = Connection(url, creds)
+        await publisher.connect()
+
+        channel = makeUniqueString()
+        task = asyncio.ensure_future(
+            subscriber.subscribe(
+                channel, None, None, SharedReaderMessageHandlerClass, {}, channel
+            )
+        )
+        assert await waitFor(lambda: channel in subscriber.subscriptions)
+
+        groups = list(multiplexer.groups.values())
+        assert [group.url for group in groups] == ['redis://127.0.0.1:6379']
+
+        await publisher.publish(channel, {'channel': channel})
+        messageHandler = await asyncio.wait_for(task, 5)
+        assert messageHandler.messages == [{'channel': channel}]
+
+        await publisher.write(channel, {'channel': channel})
+        assert await publisher.read(channel) == {'channel': channel}
+
+        async with runner.app['redis_clients'].readPool.client() as redis:
+            assert 'redis://127.0.0.1:6379' in redis.redis.pipelines
+
+        await publisher.close()
+        await subscriber.close()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
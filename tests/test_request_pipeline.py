@@ -0,0 +1,151 @@
+'''Test per connection request pipelining
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import os
+
+import pytest
+
+from cobras.client.connection import Connection
+from cobras.client.credentials import (
+    createCredentials,
+    getDefaultRoleForApp,
+    getDefaultSecretForApp,
+)
+from cobras.client.health_check import getDefaultHealthCheckUrl
+from cobras.common.fast_json import loads
+from cobras.server.rcc_client import RedisClientRcc
+from cobras.server.request_pipeline import (
+    ALL_CHANNELS,
+    RequestPipeline,
+    getOrderingKeys,
+    markOrdered,
+)
+
+from .test_utils import makeRunner, makeUniqueString
+
+
+class FakeAppsConfig:
+    def getChannelBuilderRules(self, appkey):
+        return [{'foo': 'bar'}] if appkey == 'rules' else []
+
+
+def test_ordering_keys():
+    app = {'apps_config': FakeAppsConfig()}
+
+    pdu = {'body': {'channel': 'a'}}
+    assert getOrderingKeys(app, 'app', 'rtm/publish', pdu) == ('a',)
+    assert getOrderingKeys(app, 'app', 'rtm/read', pdu) == ('a',)
+    assert getOrderingKeys(app, 'rules', 'rtm/publish', pdu) == (ALL_CHANNELS,)
+    assert getOrderingKeys(app, 'rules', 'rtm/read', pdu) == (ALL_CHANNELS,)
+
+    pdu = {'body': {'channels': ['a', 'b', 'a']}}
+    assert sorted(getOrderingKeys(app, 'app', 'rtm/publish', pdu)) == ['a', 'b']
+
+    # Handled alone
+    assert getOrderingKeys(app, 'app', 'rtm/subscribe', pdu) is None
+    assert getOrderingKeys(app, 'app', 'rtm/publish', {'body': 12}) is None
+    assert getOrderingKeys(app, 'app', 'rtm/publish', {'body': {'channel': {}}}) is None
+
+
+def test_request_pipeline():
+    async def coroutine():
+        pipeline = RequestPipeline(maxInFlight=3)
+        events = []
+        inFlight = []
+
+        async def publish(name, delay):
+            inFlight.append(name)
+            events.append(f'start {name}')
+            markOrdered()
+            await asyncio.sleep(delay)
+            events.append(f'end {name}')
+            inFlight.remove(name)
+
+        async def read(name):
+            events.append(f'read {name} {len(inFlight)}')
+
+        # Consecutive publishes to a channel overlap, in order
+        await pipeline.submit(('a',), 'rtm/publish', publish, 'p1', 0.05)
+        await pipeline.submit(('a',), 'rtm/publish', publish, 'p2', 0.01)
+        await pipeline.submit(('b',), 'rtm/publish', publish, 'p3', 0.01)
+        assert len(pipeline.tasks) == 3
+
+        # Blocks until a request completes
+        await pipeline.submit(('a',), 'rtm/read', read, 'r1')
+        assert events[:3] == ['start p1', 'start p2', 'start p3']
+        assert len(inFlight) < 3
+
+        # Reads wait for the publishes to the channel to complete
+        await pipeline.drain()
+        assert events.index('read r1 0') > events.index('end p1')
+
+        # Requests without keys run alone
+        await pipeline.submit(('a',), 'rtm/publish', publish, 'p4', 0.01)
+        await pipeline.submit(None, 'rtm/subscribe', read, 's1')
+        assert events[-1] == 'read s1 0'
+        assert not pipeline.pending
+
+        await pipeline.close()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+def test_request_pipeline_error():
+    async def coroutine():
+        pipeline = RequestPipeline(maxInFlight=2)
+
+        async def fail():
+            raise ValueError('boom')
+
+        await pipeline.submit(('a',), 'rtm/publish', fail)
+
+        with pytest.raises(ValueError):
+            await pipeline.drain()
+
+        with pytest.raises(ValueError):
+            await pipeline.submit(('a',), 'rtm/publish', fail)
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+@pytest.fixture()
+def runner():
+    runner, appsConfigPath = makeRunner(debugMemory=False)
+    runner.app['apps_config'].apps['_health']['max_inflight_requests'] = 16
+    yield runner
+
+    runner.terminate()
+    os.unlink(appsConfigPath)
+
+
+def test_pipelined_publishes_are_ordered(runner):
+    url = getDefaultHealthCheckUrl(None, runner.port)
+    role = getDefaultRoleForApp('health')
+    secret = getDefaultSecretForApp('health')
+    creds = createCredentials(role, secret)
+
+    channel = makeUniqueString()
+    count = 100
+
+    async def coroutine():
+        connection = Connection(url, creds)
+        await connection.connect()
+
+        # Sent back to back, without waiting for the acks
+        await asyncio.gather(
+            *[connection.publish(channel, {'seq': i}) for i in range(count)]
+        )
+        await connection.close()
+
+        redis = RedisClientRcc('redis://localhost', None, False)
+        entries = await redis.xrevrange(f'_health::{channel}', '+', '-', count)
+        sequence = [
+            loads(fields[b'json'])['body']['message']['seq']
+            for _, fields in reversed(entries)
+        ]
+        assert sequence == list(range(count))
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
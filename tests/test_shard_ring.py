@@ -0,0 +1,114 @@
+'''Test the sharding of channels over standalone redis servers
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import collections
+import os
+
+import pytest
+
+from cobras.client.connection import Connection
+from cobras.client.credentials import (
+    createCredentials,
+    getDefaultRoleForApp,
+    getDefaultSecretForApp,
+)
+from cobras.client.health_check import getDefaultHealthCheckUrl
+from cobras.server.shard_ring import ShardRing
+
+from .test_pubsub import SharedReaderMessageHandlerClass, waitFor
+from .test_utils import makeRunner, makeUniqueString
+
+URLS = ['redis://redis1', 'redis://redis2', 'redis://redis3']
+
+
+def test_shard_ring():
+    ring = ShardRing(URLS)
+    keys = [f'_health::channel_{i}' for i in range(3000)]
+
+    # Spread over all the servers, the same way by every node
+    routes = {key: ring.getUrl(key) for key in keys}
+    counts = collections.Counter(routes.values())
+    assert set(counts) == set(URLS)
+    assert min(counts.values()) > 600
+
+    otherRing = ShardRing(list(reversed(URLS)))
+    assert all(otherRing.getUrl(key) == url for key, url in routes.items())
+    assert ring.getUrl(keys[0].encode()) == routes[keys[0]]
+    assert ring.getNode(keys[0]) == routes[keys[0]].replace('redis://', '') + ':6379'
+
+    # Adding a server only moves the keys it takes over
+    biggerRing = ShardRing(URLS + ['redis://redis4'])
+    moved = [key for key in keys if biggerRing.getUrl(key) != routes[key]]
+    assert all(biggerRing.getUrl(key) == 'redis://redis4' for key in moved)
+    assert len(moved) < len(keys) / 3
+
+
+@pytest.fixture()
+def runner():
+    # Two ring nodes, which happen to be the same redis
+    runner, appsConfigPath = makeRunner(
+        debugMemory=False,
+        redisUrls='redis://localhost;redis://127.0.0.1',
+        redisSharding=True,
+    )
+    yield runner
+
+    runner.terminate()
+    os.unlink(appsConfigPath)
+
+
+def test_sharding(runner):
+    url = getDefaultHealthCheckUrl(None, runner.port)
+    role = getDefaultRoleForApp('health')
+    secret = getDefaultSecretForApp('health')
+    creds = createCredentials(role, secret)
+
+    router = runner.app['redis_clients'].router
+    multiplexer = runner.app['stream_multiplexer']
+
+    async def coroutine():
+        subscriber = Connection(url, creds)
+        await subscriber.connect()
+
+        publisher = Connection(url, creds)
+        await publisher.connect()
+
+        # Channels on both shards
+        channels = []
+        shards = set()
+        while len(shards) < 2 or len(channels) < 4:
+            channel = makeUniqueString()
+            channels.append(channel)
+            shards.add(router.getUrl(f'_health::{channel}'))
+
+        tasks = []
+        for channel in channels:
+            task = asyncio.ensure_future(
+                subscriber.subscribe(
+                    channel, None, None, SharedReaderMessageHandlerClass, {}, channel
+                )
+            )
+            tasks.append(task)
+            assert await waitFor(lambda: channel in subscriber.subscriptions)
+
+        # One multiplexed reader per shard
+        assert multiplexer.groupsCount() == 2
+
+        for channel in channels:
+            await publisher.publish(channel, {'channel': channel})
+
+        messageHandlers = await asyncio.wait_for(asyncio.gather(*tasks), 5)
+        for channel, messageHandler in zip(channels, messageHandlers):
+            assert messageHandler.messages == [{'channel': channel}]
+
+        for channel in channels:
+            await publisher.write(channel, {'channel': channel})
+            assert await publisher.read(channel) == {'channel': channel}
+
+        await publisher.close()
+        await subscriber.close()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
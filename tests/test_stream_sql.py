@@ -1,6 +1,12 @@
 '''Copyright (c) 2018-2019 Machine Zone, Inc. All rights reserved.'''
 
-from cobras.server.stream_sql import match_stream_sql_filter
+import pytest
+
+from cobras.server.stream_sql import (
+    InvalidStreamSQLError,
+    getStreamSqlFilter,
+    match_stream_sql_filter,
+)
 
 
 def test_answer():
@@ -326,3 +332,100 @@ def test_select_field_with_empty_string_value():
     hit = {'data': {"scene_name": ""}}
 
     assert {"data.scene_name": ""} == match_stream_sql_filter(sql_filter, hit)
+
+
+def test_compiled_filter_cache():
+    sql_filter = "SELECT * FROM blah WHERE device.game = 'miso'"
+
+    # Subscriptions with the same filter text share the compiled filter
+    assert getStreamSqlFilter(sql_filter) is getStreamSqlFilter(sql_filter)
+
+    with pytest.raises(InvalidStreamSQLError):
+        getStreamSqlFilter({'filter': sql_filter})
+
+    with pytest.raises(InvalidStreamSQLError):
+        getStreamSqlFilter("SELECT * FROM blah WHERE device.game LIKE 12")
+
+
+def test_deep_path():
+    sql_filter = (
+        "SELECT device.app.version FROM blah WHERE device.app.build = 'release'"
+    )
+
+    hit = {'device': {'app': {'build': 'release', 'version': 12}}}
+    miss = {'device': {'app': {'build': 'debug', 'version': 12}}}
+    missing = {'device': {}}
+
+    assert match_stream_sql_filter(sql_filter, hit) == {'device.app.version': 12}
+    assert not match_stream_sql_filter(sql_filter, miss)
+    assert not match_stream_sql_filter(sql_filter, missing)
+
+
+def test_match_batch():
+    sql_filter = (
+        "SELECT device.game FROM blah WHERE device.game = 'miso' AND data.fps > 30"
+    )
+    streamSqlFilter = getStreamSqlFilter(sql_filter)
+
+    miso = {'device': {'game': 'miso'}, 'data': {'fps': 60}}
+    slow = {'device': {'game': 'miso'}, 'data': {'fps': 10}}
+    ody = {'device': {'game': 'ody'}, 'data': {'fps': 60}}
+    missing = {'device': {'game': 'miso'}, 'data': 'not a dict'}
+
+    payloads = [miso, slow, [ody, miso, missing, 'junk', miso], ody, 42, miso]
+    results = streamSqlFilter.matchBatch(payloads)
+
+    # Every element of list payloads is filtered
+    assert [(index, msg) for index, msg, _ in results] == [
+        (0, miso),
+        (2, miso),
+        (2, miso),
+        (5, miso),
+    ]
+    assert all(output == {'device.game': 'miso'} for _, _, output in results)
+
+    # Same results, one message at a time
+    for msg in (miso, slow, ody):
+        expected = streamSqlFilter.match(msg)
+        results = streamSqlFilter.matchBatch([msg])
+        assert (results[0][2] if results else False) == expected
+
+
+def test_match_batch_or():
+    sql_filter = "SELECT * FROM blah WHERE device.os LIKE 'And%' OR data.fps < 30"
+    streamSqlFilter = getStreamSqlFilter(sql_filter)
+
+    payloads = [
+        {'device': {'os': 'iOS'}, 'data': {'fps': 10}},
+        {'device': {'os': 'Android'}, 'data': {'fps': 60}},
+        {'device': {'os': 'iOS'}, 'data': {'fps': 60}},
+        {'device': {'os': 12}, 'data': {'fps': 'fast'}},
+    ]
+    results = streamSqlFilter.matchBatch(payloads)
+    assert [index for index, _, _ in results] == [0, 1]
+
+    streamSqlFilter = getStreamSqlFilter("SELECT * FROM blah")
+    results = streamSqlFilter.matchBatch([{'a': 1}, [{'b': 2}, {'c': 3}]])
+    assert [output for _, _, output in results] == [{'a': 1}, {'b': 2}, {'c': 3}]
+
+
+@pytest.mark.parametrize(
+    'sql_filter',
+    [
+        "SELECT * FROM foo WHERE foo.a > 3",
+        "SELECT * FROM foo WHERE foo.a < 3",
+        "SELECT * FROM foo WHERE foo.a LIKE 'x%'",
+        "SELECT * FROM foo WHERE foo.a.b = 3",
+    ],
+)
+def test_incomparable_values(sql_filter):
+    streamSqlFilter = getStreamSqlFilter(sql_filter)
+
+    # Strings vs ints, missing fields, fields which are not dicts
+    for msg in ({'foo': {'a': 'x'}}, {'foo': {'a': 3}}, {'foo': {}}, {'bar': 1}):
+        expected = streamSqlFilter.match(msg)
+        results = streamSqlFilter.matchBatch([msg])
+        assert (results[0][2] if results else False) == expected
+
+    assert not streamSqlFilter.match({'foo': {'a': None}})
+    assert not streamSqlFilter.match({'foo': 'not a dict'})
@@ -0,0 +1,208 @@
+'''Test the subscription batcher
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+
+import pytest
+
+from cobras.common.apps_config import DISCONNECT, DROP_NEWEST, JUMP_TO_HEAD
+from cobras.server.subscription_batcher import SlowConsumerError, SubscriptionBatcher
+
+
+class Sender:
+    def __init__(self, backlog=False):
+        self.batches = []
+        self.backlog = backlog
+        self.blocked = asyncio.Event()
+        self.blocked.set()
+
+    async def send(self, messages, encodedPosition):
+        await self.blocked.wait()
+        self.batches.append((messages, encodedPosition))
+        return self.backlog
+
+
+def test_batch_size():
+    async def coroutine():
+        sender = Sender()
+        batcher = SubscriptionBatcher(sender.send, batchSize=3, maxLinger=60)
+
+        for i in range(7):
+            batcher.add(str(i), f'"{i}-0"')
+        await asyncio.sleep(0.1)
+
+        assert sender.batches == [
+            (['0', '1', '2'], '"2-0"'),
+            (['3', '4', '5'], '"5-0"'),
+        ]
+        batcher.close()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+def test_batch_max_bytes():
+    async def coroutine():
+        sender = Sender()
+        batcher = SubscriptionBatcher(
+            sender.send, batchSize=100, maxBytes=10, maxLinger=60
+        )
+
+        batcher.add('aaaa', '"1-0"')
+        batcher.add('bbbb', '"2-0"')
+        await asyncio.sleep(0.1)
+        assert sender.batches == []
+
+        # Over the budget, the first two are sent on their own
+        batcher.add('cccc', '"3-0"')
+        await asyncio.sleep(0.1)
+        assert sender.batches == [(['aaaa', 'bbbb'], '"2-0"')]
+
+        # A message bigger than the budget is sent alone
+        batcher.add('d' * 20, '"4-0"')
+        await asyncio.sleep(0.1)
+        assert sender.batches[1:] == [(['cccc'], '"3-0"'), (['d' * 20], '"4-0"')]
+        batcher.close()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+def test_batch_max_linger():
+    async def coroutine():
+        sender = Sender()
+        batcher = SubscriptionBatcher(sender.send, batchSize=100, maxLinger=0.05)
+
+        batcher.add('a', '"1-0"')
+        batcher.add('b', '"2-0"')
+        assert sender.batches == []
+
+        await asyncio.sleep(0.2)
+        assert sender.batches == [(['a', 'b'], '"2-0"')]
+
+        # Closing drops pending messages, and cancels the timer
+        batcher.add('c', '"3-0"')
+        batcher.close()
+        await asyncio.sleep(0.2)
+        assert len(sender.batches) == 1
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+def test_send_error():
+    async def coroutine():
+        errors = []
+
+        async def send(messages, encodedPosition):
+            raise ValueError('cannot encode')
+
+        batcher = SubscriptionBatcher(send, maxLinger=60, onError=errors.append)
+
+        batcher.add('a', '"1-0"')
+        await asyncio.sleep(0.1)
+        assert [str(error) for error in errors] == ['cannot encode']
+
+        # Closed, messages are not queued anymore
+        assert batcher.add('b', '"2-0"') == 0
+        assert batcher.queueSize() == 0
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+def test_batch_adaptive():
+    async def coroutine():
+        sender = Sender(backlog=True)
+        batcher = SubscriptionBatcher(
+            sender.send, batchSize=4, maxLinger=60, adaptive=True
+        )
+        assert batcher.batchSize == 1
+
+        # The client is behind, grow up to the max batch size
+        for i in range(10):
+            batcher.add(str(i), f'"{i}-0"')
+            await asyncio.sleep(0.01)
+        assert batcher.batchSize == 4
+
+        # It caught up, shrink back
+        sender.backlog = False
+        for i in range(10):
+            batcher.add(str(i), f'"{i}-0"')
+            await asyncio.sleep(0.01)
+        assert batcher.batchSize == 1
+        batcher.close()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+async def fillBlockedBatcher(policy):
+    '''The first message is being sent, the next 5 are queued'''
+    sender = Sender()
+    sender.blocked.clear()
+
+    batcher = SubscriptionBatcher(
+        sender.send, batchSize=1, queueMaxSize=3, policy=policy
+    )
+
+    batcher.add('0', '"0-0"')
+    await asyncio.sleep(0.01)
+
+    dropped = []
+    for i in range(1, 6):
+        dropped.append(batcher.add(str(i), f'"{i}-0"'))
+
+    return sender, batcher, dropped
+
+
+async def drain(sender, batcher):
+    sender.blocked.set()
+    await asyncio.sleep(0.1)
+    batcher.close()
+
+    return [messages[0] for messages, _ in sender.batches]
+
+
+def test_slow_consumer_drop_oldest():
+    async def coroutine():
+        sender, batcher, dropped = await fillBlockedBatcher(policy='drop_oldest')
+        assert dropped == [0, 0, 0, 1, 1]
+        assert batcher.highWaterMark == 3
+
+        assert await drain(sender, batcher) == ['0', '3', '4', '5']
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+def test_slow_consumer_drop_newest():
+    async def coroutine():
+        sender, batcher, dropped = await fillBlockedBatcher(policy=DROP_NEWEST)
+        assert dropped == [0, 0, 0, 1, 1]
+        assert await drain(sender, batcher) == ['0', '1', '2', '3']
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+def test_slow_consumer_jump_to_head():
+    async def coroutine():
+        sender, batcher, dropped = await fillBlockedBatcher(policy=JUMP_TO_HEAD)
+        assert dropped == [0, 0, 0, 3, 0]
+        assert await drain(sender, batcher) == ['0', '4', '5']
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
+
+
+def test_slow_consumer_disconnect():
+    async def coroutine():
+        sender = Sender()
+        sender.blocked.clear()
+
+        batcher = SubscriptionBatcher(
+            sender.send, batchSize=1, queueMaxSize=3, policy=DISCONNECT
+        )
+
+        with pytest.raises(SlowConsumerError):
+            for i in range(5):
+                batcher.add(str(i), f'"{i}-0"')
+
+        batcher.close()
+
+    asyncio.get_event_loop().run_until_complete(coroutine())
@@ -18,10 +18,18 @@ def getFreePort():
 
 
 def makeRunner(
-    debugMemory=False, enableStats=False, redisUrls=None, probeRedisOnStartup=True
+    debugMemory=False,
+    enableStats=False,
+    redisUrls=None,
+    probeRedisOnStartup=True,
+    port=None,
+    appsConfigPath=None,
+    **kwargs,
 ):
+    '''Extra keyword arguments are passed to AppRunner'''
     host = 'localhost'
-    port = getFreePort()
+    if port is None:
+        port = getFreePort()
     redisPassword = None
     maxSubscriptions = -1
     idleTimeout = 10  # after 10 seconds it's a lost cause / FIXME(unused)
@@ -36,9 +44,10 @@ def makeRunner(
         else:
             redisUrls = 'redis://localhost'
 
-    appsConfigPath = tempfile.mktemp()
-    appsConfig = AppsConfig(appsConfigPath)
-    appsConfig.generateDefaultConfig()
+    if appsConfigPath is None:
+        appsConfigPath = tempfile.mktemp()
+        appsConfig = AppsConfig(appsConfigPath)
+        appsConfig.generateDefaultConfig()
     os.environ['COBRA_APPS_CONFIG'] = appsConfigPath
 
     runner = AppRunner(
@@ -57,6 +66,7 @@ def makeRunner(
         probeRedisOnStartup,
         redisStartupProbingTimeout=5,
         messageMaxSize=getDefaultMessageMaxSize(),
+        **kwargs,
     )
     asyncio.get_event_loop().run_until_complete(runner.setup())
     return runner, appsConfigPath
@@ -0,0 +1,102 @@
+'''Test the multi-process mode helpers
+
+Copyright (c) 2020 Machine Zone, Inc. All rights reserved.
+'''
+
+import asyncio
+import os
+
+import pytest
+
+from cobras.client.connection import Connection
+from cobras.client.credentials import (
+    createCredentials,
+    getDefaultRoleForApp,
+    getDefaultSecretForApp,
+)
+from cobras.client.health_check import getDefaultHealthCheckUrl
+from cobras.server.workers import mergeStats
+
+from .test_utils import makeRunner
+
+
+def test_merge_stats():
+    first = {
+        'cobra': {
+            'published_count': {'a': 1, 'b': 2},
+            'subscription_queue_high_water_mark': 10,
+        },
+        'system': {'connections': 3, 'uptime': '0:01:00', 'uptime_minutes': 1},
+    }
+    second = {
+        'cobra': {
+            'published_count': {'b': 3, 'c': 4},
+            'subscription_queue_high_water_mark': 7,
+        },
+        'system': {'connections': 5, 'uptime': '0:02:00', 'uptime_minutes': 2},
+    }
+
+    assert mergeStats([first, second]) == {
+        'cobra': {
+            'published_count': {'a': 1, 'b': 5, 'c': 4},
+            'subscription_queue_high_water_mark': 10,
+        },
+        'system': {'connections': 8, 'uptime': '0:01:00', 'uptime_minutes': 2},
+    }
+
+    # The inputs are left untouched
+    assert first['cobra']['published_count'] == {'a': 1, 'b': 2}
+
+
+@pytest.fixture()
+def runners():
+    '''Two workers sharing a port'''
+    first, appsConfigPath = makeRunner(reusePort=True, workerId=0, workerCount=2)
+    second, _ = makeRunner(
+        port=first.port,
+        appsConfigPath=appsConfigPath,
+        reusePort=True,
+        workerId=1,
+        workerCount=2,
+    )
+    yield first, second
+
+    first.terminate()
+    second.terminate()
+    os.unlink(appsConfigPath)
+
+
+async def clientCoroutine(connections, registry):
+    for connection in connections:
+        await connection.connect()
+
+    # Let the workers publish their state
+    await asyncio.sleep(1.5)
+
+    # Connection lists are fetched on demand, only counts are published
+    workers = await registry.getWorkers()
+    assert list(workers) == [1]
+    assert 'connections' not in workers[1]
+    assert workers[1]['connection_count'] + len(registry.connections) == len(
+        connections
+    )
+
+    for connection in connections:
+        openedConnections = await connection.adminGetConnections()
+        assert sorted(openedConnections) == sorted(set(openedConnections))
+        assert len(openedConnections) == len(connections)
+
+    for connection in connections:
+        await connection.close()
+
+
+def test_get_connections_across_workers(runners):
+    url = getDefaultHealthCheckUrl(None, runners[0].port)
+    role = getDefaultRoleForApp('health')
+    secret = getDefaultSecretForApp('health')
+    creds = createCredentials(role, secret)
+
+    connections = [Connection(url, creds) for _ in range(4)]
+
+    registry = runners[0].app['worker_registry']
+    asyncio.get_event_loop().run_until_complete(clientCoroutine(connections, registry))
@@ -0,0 +1,69 @@
+'''Measure the json backends on realistic pdus.
+
+python tools/bench_json.py
+'''
+
+import json
+import timeit
+
+from cobras.common import fast_json
+
+MESSAGE = {
+    'id': 'engine_fps_id',
+    'device': {
+        'game': 'ody',
+        'os_name': 'Android',
+        'android_id': 'e8e2d3c3f2c5a1b4',
+        'app': {'version': 12, 'build': 'release'},
+    },
+    'data': {'fps': 60, 'frame_time_ms': 16.6, 'scene': 'menu'},
+}
+
+PDUS = {
+    'publish': {
+        'action': 'rtm/publish',
+        'id': 12,
+        'body': {'channel': 'engine_fps_id', 'message': MESSAGE},
+    },
+    'subscription data': {
+        'action': 'rtm/subscription/data',
+        'id': 42,
+        'body': {
+            'subscription_id': 'engine_fps_id',
+            'messages': [MESSAGE] * 10,
+            'position': '1591838273452-0',
+        },
+    },
+}
+
+COUNT = 100000
+
+
+def measure(func, count=COUNT):
+    return timeit.timeit(func, number=count) / count * 1e9
+
+
+def main():
+    backends = [('json', fast_json.stdlibLoads, json.dumps)]
+    if fast_json.orjson is not None:
+        backends.append(('orjson', fast_json.orjsonLoads, fast_json.orjsonDumps))
+
+    print(f'default backend: {fast_json.BACKEND}')
+
+    for name, pdu in PDUS.items():
+        text = json.dumps(pdu)
+        frame = text.encode()
+
+        print(f'{name} ({len(frame)} bytes)')
+        for backend, loads, dumps in backends:
+            decodeThenLoads = measure(lambda: loads(frame.decode()))
+            loadsBytes = measure(lambda: loads(frame))
+            encode = measure(lambda: dumps(pdu))
+
+            print(f'  {backend:6} loads(frame.decode()) {decodeThenLoads:8.0f} ns')
+            print(f'  {backend:6} loads(frame)          {loadsBytes:8.0f} ns')
+            print(f'  {backend:6} dumps                 {encode:8.0f} ns')
+
+
+if __name__ == '__main__':
+    main()
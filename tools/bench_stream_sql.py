@@ -0,0 +1,62 @@
+'''Measure the cost of StreamSQL filters, per message and per subscribe.
+
+python tools/bench_stream_sql.py
+'''
+
+import timeit
+
+from cobras.server.stream_sql import StreamSqlFilter, match_stream_sql_filter
+
+FILTERS = [
+    "SELECT * FROM engine_fps_id WHERE device.game = 'ody'",
+    "SELECT device.game, data.fps AS fps FROM engine_fps_id "
+    "WHERE device.game = 'ody' AND data.fps > 30",
+    "SELECT * FROM engine_fps_id WHERE device.os_name LIKE 'And%' "
+    "OR device.app.version = 12",
+]
+
+MESSAGE = {
+    'id': 'engine_fps_id',
+    'device': {
+        'game': 'ody',
+        'os_name': 'Android',
+        'android_id': 'e8e2d3c3f2c5a1b4',
+        'app': {'version': 12, 'build': 'release'},
+    },
+    'data': {'fps': 60, 'frame_time_ms': 16.6, 'scene': 'menu'},
+}
+
+COUNT = 200000
+BATCH_SIZE = 100
+
+
+def main():
+    for sqlFilter in FILTERS:
+        streamSqlFilter = StreamSqlFilter(sqlFilter)
+
+        duration = timeit.timeit(lambda: streamSqlFilter.match(MESSAGE), number=COUNT)
+        perMessage = duration / COUNT * 1e9
+
+        duration = timeit.timeit(lambda: StreamSqlFilter(sqlFilter), number=COUNT // 10)
+        perCompile = duration / (COUNT // 10) * 1e9
+
+        duration = timeit.timeit(
+            lambda: match_stream_sql_filter(sqlFilter, MESSAGE), number=COUNT
+        )
+        perCachedCall = duration / COUNT * 1e9
+
+        batch = [MESSAGE] * BATCH_SIZE
+        duration = timeit.timeit(
+            lambda: streamSqlFilter.matchBatch(batch), number=COUNT // BATCH_SIZE
+        )
+        perBatchedMessage = duration / COUNT * 1e9
+
+        print(sqlFilter)
+        print(f'  match            {perMessage:8.0f} ns/message')
+        print(f'  match (batched)  {perBatchedMessage:8.0f} ns/message')
+        print(f'  parse            {perCompile:8.0f} ns/filter')
+        print(f'  match (by text)  {perCachedCall:8.0f} ns/message')
+
+
+if __name__ == '__main__':
+    main()